@@ -0,0 +1,300 @@
+# main/async_views.py
+
+import json
+import math
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse, QueryDict
+from django.http.multipartparser import MultiPartParser, MultiPartParserError
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import (
+    APIException, NotAuthenticated, NotFound, ParseError, UnsupportedMediaType, ValidationError,
+)
+from rest_framework.settings import api_settings
+
+from .authentication import LazyTokenUser, TokenUserAuthentication
+from .cache import login_method_cache, profile_cache
+from .conditional import version_state
+from .hashers import HashQueueFull, acheck_password, ahash_dummy_password
+from .login_tracking import record_login_method
+from .routers import pin_to_primary
+from .models import LoginMethod, Profile, UserIdentifier
+from .serializers import LoginMethodSerializer, ProfileSerializer, TokenCredentialsSerializer
+from .throttling import login_throttle
+from .tokens import UserRefreshToken
+from .uploads import AvatarUploadHandler
+
+
+class AsyncAPIView(View):
+    """
+    View แบบ async สำหรับรันบน ASGI โดยไม่ต้องผ่าน thread pool ของ sync view
+    ตรวจ access token แบบ stateless (ไม่ query) แปลง body เป็น dict และแปลง APIException
+    เป็น JSON response ในรูปแบบเดียวกับ DRF
+    งานที่ต้องใช้ transaction หรือ signal (การบันทึก) ยังรันผ่าน sync_to_async
+    """
+    authentication = TokenUserAuthentication(verify_epoch=False)
+    authentication_required = True
+    upload_handler_class = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # ยืนยันตัวตนด้วย token ใน header ซึ่ง browser ไม่ได้แนบให้เอง จึงไม่ต้องตรวจ CSRF (เหมือน APIView ของ DRF)
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            if self.authentication_required:
+                request.user = await self.authenticate(request)
+                await self.authentication.acheck_epoch(request.user)
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            return self.handle_exception(exc)
+        except HashQueueFull:
+            response = JsonResponse({'detail': 'Server is busy, please retry.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response['Retry-After'] = '1'
+            return response
+
+    async def authenticate(self, request):
+        """
+        ตรวจ token บน event loop (ไม่ query) ยกเว้น token ที่ไม่มี claim ครบ ซึ่งต้องโหลด CustomUser ใน thread
+        """
+        authentication = self.authentication
+        header = authentication.get_header(request)
+        raw_token = authentication.get_raw_token(header) if header is not None else None
+        if raw_token is None:
+            raise NotAuthenticated()
+        validated_token = authentication.get_validated_token(raw_token)
+        if LazyTokenUser(validated_token).stateless:
+            return authentication.get_user(validated_token)
+        return await sync_to_async(self._load_user)(validated_token)
+
+    def _load_user(self, validated_token):
+        user = self.authentication.get_user(validated_token)
+        if isinstance(user, LazyTokenUser):
+            user.instance  # โหลดไว้ก่อน attribute อื่นจะได้ไม่ query บน event loop
+        return user
+
+    def handle_exception(self, exc):
+        detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+        response = JsonResponse(detail, status=exc.status_code, safe=False)
+        if exc.status_code == status.HTTP_401_UNAUTHORIZED:
+            response['WWW-Authenticate'] = self.authentication.authenticate_header(request=None)
+        if getattr(exc, 'wait', None) is not None:
+            response['Retry-After'] = str(math.ceil(exc.wait))
+        return response
+
+    async def parse(self, request):
+        """
+        อ่าน body ตาม Content-Type (JSON, multipart หรือ form) ไฟล์ใน multipart ถูกอ่านใน thread แยก
+        """
+        content_type = request.content_type
+        if content_type == 'multipart/form-data':
+            return await sync_to_async(self._parse_multipart, thread_sensitive=False)(request)
+        body = request.body
+        if not body:
+            return {}
+        if content_type == 'application/json':
+            try:
+                return json.loads(body)
+            except ValueError as exc:
+                raise ParseError(f'JSON parse error - {exc}')
+        if content_type == 'application/x-www-form-urlencoded':
+            return QueryDict(body, encoding=request.encoding)
+        raise UnsupportedMediaType(content_type)
+
+    def _parse_multipart(self, request):
+        handler = None
+        if self.upload_handler_class is not None:
+            handler = self.upload_handler_class(request)
+            request.upload_handlers.insert(0, handler)
+        try:
+            data, files = MultiPartParser(request.META, request, request.upload_handlers, request.encoding).parse()
+        except MultiPartParserError as exc:
+            raise ParseError(f'Multipart form parse error - {exc}')
+        if handler is not None:
+            handler.raise_for_error()
+        data = data.copy()
+        data.update(files)
+        return data
+
+
+def conditional_json(request, entry, status_code=status.HTTP_200_OK, check=True):
+    """
+    conditional_response สำหรับ async view: ตอบ 304/412 หรือ entry['data'] พร้อม ETag และ Last-Modified
+    check=False สำหรับผลของการบันทึกที่ตรวจเงื่อนไขไปแล้วก่อนบันทึก (ETag ใหม่ไม่ตรงกับ If-Match เดิมเสมอ)
+    """
+    response = None
+    if check:
+        response = get_conditional_response(request, etag=entry['etag'], last_modified=entry['last_modified'])
+    if response is None:
+        response = JsonResponse(entry['data'], status=status_code)
+    response['ETag'] = entry['etag']
+    if entry['last_modified'] is not None:
+        response['Last-Modified'] = http_date(entry['last_modified'])
+    return response
+
+
+class AsyncTokenObtainPairView(AsyncAPIView):
+    """
+    CustomTokenObtainPairView แบบ async: ค้นหาผู้ใช้ด้วย async ORM และ hash รหัสผ่านใน BoundedHashExecutor
+    """
+    authentication_required = False
+    login_type_mapping = {
+        'email': LoginMethod.EMAIL,
+        'national_id': LoginMethod.NATIONAL_ID,
+        'phone_number': LoginMethod.PHONE_NUMBER,
+    }
+
+    async def post(self, request, *args, **kwargs):
+        data = await self.parse(request)
+        serializer = TokenCredentialsSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        attrs = serializer.validated_data
+        identifier = serializer.identifier(attrs)
+        ip = login_throttle.client_ip(request)
+        await login_throttle.acheck(identifier, ip)
+
+        user = await UserIdentifier.objects.aresolve_login(identifier)
+        if user is None:
+            await ahash_dummy_password(attrs['password'])
+        if user is None or not await acheck_password(user, attrs['password']):
+            await login_throttle.afailed(ip)
+            raise ValidationError({api_settings.NON_FIELD_ERRORS_KEY: ["ชื่อผู้ใช้หรือรหัสผ่านไม่ถูกต้อง."]})
+        if not user.is_active:
+            raise ValidationError({api_settings.NON_FIELD_ERRORS_KEY: ["บัญชีผู้ใช้ถูกปิดใช้งาน."]})
+        await login_throttle.asucceeded(identifier)
+
+        login_type = self.login_type_mapping.get(next((key for key in data if key in self.login_type_mapping), None))
+        if not login_type:
+            return JsonResponse({'detail': 'Unsupported login type.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            await sync_to_async(record_login_method)(user, login_type, data.get(login_type))
+        except IntegrityError:
+            return JsonResponse(
+                {'detail': 'This identifier is already associated with another user.'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if settings.DATABASE_REPLICAS:
+            await sync_to_async(pin_to_primary)(user.pk)
+
+        refresh = UserRefreshToken.for_user(user)
+        return JsonResponse({'refresh': str(refresh), 'access': str(refresh.access_token)})
+
+
+class AsyncProfileDetail(AsyncAPIView):
+    """
+    ProfileDetail แบบ async: ดู (จาก cache พร้อม ETag) และแก้ไข profile ของผู้ใช้ที่ล็อกอินอยู่
+    """
+    upload_handler_class = AvatarUploadHandler
+
+    async def get_object(self, request):
+        try:
+            return await Profile.objects.aget(user_id=request.user.id)
+        except Profile.DoesNotExist:
+            raise NotFound("Profile not found. Please create one.")
+
+    async def get(self, request, *args, **kwargs):
+        async def build():
+            profile = await self.get_object(request)
+            etag, last_modified = version_state([profile])
+            data = dict(ProfileSerializer(profile, context={'request': request}).data)
+            return {'etag': etag, 'last_modified': last_modified, 'data': data}
+
+        entry = await profile_cache.aget_or_set(request.user.id, build, variant='detail')
+        return conditional_json(request, entry)
+
+    async def put(self, request, *args, **kwargs):
+        return await self.update(request, partial=False)
+
+    async def patch(self, request, *args, **kwargs):
+        return await self.update(request, partial=True)
+
+    async def update(self, request, partial):
+        data = await self.parse(request)
+        await self.get_object(request)
+        entry = await sync_to_async(self._save)(request, data, partial)
+        return conditional_json(request, entry, check=False) if 'data' in entry else entry['response']
+
+    def _save(self, request, data, partial):
+        # ล็อกแถวระหว่างตรวจ If-Match / If-Unmodified-Since และบันทึก เหมือน ConditionalRetrieveMixin.update
+        with transaction.atomic():
+            profile = Profile.objects.select_for_update().get(user_id=request.user.id)
+            etag, last_modified = version_state([profile])
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is not None:
+                return {'response': response}
+            serializer = ProfileSerializer(profile, data=data, partial=partial, context={'request': request})
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+        profile.refresh_from_db(fields=['row_version', 'updated_at'])
+        etag, last_modified = version_state([profile])
+        return {'etag': etag, 'last_modified': last_modified, 'data': serializer.data}
+
+
+class AsyncLoginMethodList(AsyncAPIView):
+    """
+    LoginMethodList แบบ async: list จาก cache ชุดเดียวกับ LoginMethodViewSet และสร้าง LoginMethod ใหม่
+    """
+
+    async def get(self, request, *args, **kwargs):
+        async def build():
+            objects = [method async for method in LoginMethod.objects.filter(user_id=request.user.id)]
+            return {'data': list(LoginMethodSerializer(objects, many=True).data)}
+
+        entry = await login_method_cache.aget_or_set(request.user.id, build)
+        return JsonResponse(entry['data'], safe=False)
+
+    async def post(self, request, *args, **kwargs):
+        data = await self.parse(request)
+        return JsonResponse(await sync_to_async(self._create)(request, data), status=status.HTTP_201_CREATED)
+
+    def _create(self, request, data):
+        serializer = LoginMethodSerializer(data=data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        serializer.save(user_id=request.user.id)
+        return serializer.data
+
+
+class AsyncLoginMethodDetail(AsyncAPIView):
+    """
+    LoginMethodDetail แบบ async: ดู แก้ไข และลบ LoginMethod ของผู้ใช้ที่ล็อกอินอยู่
+    """
+
+    async def get_object(self, request, pk):
+        try:
+            return await LoginMethod.objects.aget(pk=pk, user_id=request.user.id)
+        except LoginMethod.DoesNotExist:
+            raise NotFound()
+
+    async def get(self, request, pk, *args, **kwargs):
+        return JsonResponse(LoginMethodSerializer(await self.get_object(request, pk)).data)
+
+    async def put(self, request, pk, *args, **kwargs):
+        return await self.update(request, pk, partial=False)
+
+    async def patch(self, request, pk, *args, **kwargs):
+        return await self.update(request, pk, partial=True)
+
+    async def delete(self, request, pk, *args, **kwargs):
+        method = await self.get_object(request, pk)
+        await method.adelete()
+        return HttpResponse(status=status.HTTP_204_NO_CONTENT)
+
+    async def update(self, request, pk, partial):
+        data = await self.parse(request)
+        method = await self.get_object(request, pk)
+        return JsonResponse(await sync_to_async(self._save)(method, data, partial))
+
+    def _save(self, method, data, partial):
+        serializer = LoginMethodSerializer(method, data=data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return serializer.data
@@ -0,0 +1,141 @@
+# main/authentication.py
+
+from django.contrib.auth import get_user_model
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from .cache import token_epochs
+
+
+class LazyTokenUser(TokenUser):
+    """
+    User ที่สร้างจาก claim ใน access token
+    id, is_active, is_staff และ is_superuser อ่านจาก token โดยตรง
+    ส่วน attribute อื่นๆ จะดึงแถว CustomUser จากฐานข้อมูลเมื่อถูกเรียกใช้ครั้งแรกเท่านั้น
+    """
+
+    @property
+    def stateless(self):
+        """
+        False สำหรับ token ที่ออกก่อนมี claim perms_version ซึ่ง is_active ฯลฯ ต้องอ่านจากฐานข้อมูล
+        """
+        return 'perms_version' in self.token
+
+    def _claim(self, name, default):
+        # token ที่ออกก่อนมี claim นี้ ให้ใช้ค่าจากฐานข้อมูลแทน
+        if name in self.token:
+            return self.token[name]
+        if not self.stateless:
+            return getattr(self.instance, name)
+        return default
+
+    @cached_property
+    def is_active(self):
+        return self._claim('is_active', True)
+
+    @cached_property
+    def is_staff(self):
+        return self._claim('is_staff', False)
+
+    @cached_property
+    def is_superuser(self):
+        return self._claim('is_superuser', False)
+
+    @cached_property
+    def instance(self):
+        """
+        แถว CustomUser ของ token นี้ (query เมื่อถูกเรียกใช้ครั้งแรก)
+        """
+        User = get_user_model()
+        try:
+            user = User.objects.get(**{api_settings.USER_ID_FIELD: self.id})
+        except User.DoesNotExist:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        version = self.token.get('perms_version')
+        if version is not None and version != user.perms_version:
+            raise AuthenticationFailed(_("User permissions have changed."), code="permissions_changed")
+        return user
+
+    def __str__(self):
+        return str(self.instance)
+
+    def __eq__(self, other):
+        if isinstance(other, get_user_model()):
+            return str(self.id) == str(other.pk)
+        return super().__eq__(other)
+
+    def __hash__(self):
+        return super().__hash__()
+
+    @property
+    def groups(self):
+        return self.instance.groups
+
+    @property
+    def user_permissions(self):
+        return self.instance.user_permissions
+
+    def get_group_permissions(self, obj=None):
+        return self.instance.get_group_permissions(obj)
+
+    def get_all_permissions(self, obj=None):
+        return self.instance.get_all_permissions(obj)
+
+    def has_perm(self, perm, obj=None):
+        return self.instance.has_perm(perm, obj)
+
+    def has_perms(self, perm_list, obj=None):
+        return self.instance.has_perms(perm_list, obj)
+
+    def has_module_perms(self, module):
+        return self.instance.has_module_perms(module)
+
+    def check_password(self, raw_password):
+        return self.instance.check_password(raw_password)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        if attr in self.token:
+            return self.token[attr]
+        return getattr(self.instance, attr)
+
+
+class TokenUserAuthentication(JWTStatelessUserAuthentication):
+    """
+    JWT authentication ที่ไม่ query ผู้ใช้จากฐานข้อมูลในทุก request
+    คืนค่า LazyTokenUser ซึ่งจะโหลด CustomUser เฉพาะเมื่อ view ต้องการข้อมูลเต็ม
+    token ที่ token_epoch ไม่ตรงกับของผู้ใช้ (อ่านจาก token_epochs ที่ cache ไว้) ถือว่าถูกเพิกถอน
+    verify_epoch=False ข้ามการตรวจนี้ (สำหรับผู้เรียกใน event loop ที่ตรวจเองด้วย acheck_epoch)
+    """
+
+    def __init__(self, *args, verify_epoch=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.verify_epoch = verify_epoch
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            return super().get_user(validated_token)
+        user = LazyTokenUser(validated_token)
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if self.verify_epoch:
+            self.check_epoch(validated_token, token_epochs.get(user.id))
+        return user
+
+    async def acheck_epoch(self, user):
+        self.check_epoch(user.token, await token_epochs.aget(user.id))
+
+    @staticmethod
+    def check_epoch(validated_token, epoch):
+        # token ที่ออกก่อนมี claim นี้ถือเป็น epoch 0
+        if epoch != validated_token.get('token_epoch', 0):
+            raise AuthenticationFailed(_("Token has been revoked"), code="token_revoked")
@@ -0,0 +1,109 @@
+# main/avatars.py
+
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from PIL import Image, ImageOps
+
+from .cache import profile_cache
+from .models import Profile
+from .storage import release_files
+
+logger = logging.getLogger(__name__)
+
+_FORMATS = {
+    'WEBP': ('webp', {'quality': 80, 'method': 4}),
+    'JPEG': ('jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.AVATAR_WORKERS, thread_name_prefix='avatar-variants')
+    return _executor
+
+
+def render_variant(image, size, fmt):
+    """
+    ครอปภาพเป็นสี่เหลี่ยมจัตุรัสขนาด size พิกเซลแล้ว encode ตาม fmt คืนค่าเป็น bytes
+    """
+    extension, options = _FORMATS[fmt]
+    variant = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    if fmt == 'JPEG' and variant.mode not in ('RGB', 'L'):
+        variant = variant.convert('RGB')
+    buffer = io.BytesIO()
+    variant.save(buffer, format=fmt, **options)
+    return buffer.getvalue()
+
+
+def _store(contents, extension, storage):
+    """
+    บันทึกไฟล์ภาพย่อ (ชื่อ -> bytes) ลง storage ของ avatar ตั้งชื่อจาก hash ของเนื้อหา ไฟล์ที่มีอยู่แล้วจะไม่ถูกเขียนซ้ำ
+    storage.save นับการอ้างอิงให้หนึ่งครั้งต่อไฟล์ เนื้อหาที่ซ้ำกันจึงถูกบันทึกเพียงครั้งเดียว
+    """
+    stored = {}
+    for content in contents.values():
+        if content not in stored:
+            stored[content] = storage.save(f"{settings.AVATAR_VARIANT_DIR}/variant.{extension}", ContentFile(content))
+    return {key: stored[content] for key, content in contents.items()}
+
+
+def generate_avatar_variants(profile_id, avatar_name):
+    """
+    สร้างภาพย่อทุกขนาดใน AVATAR_VARIANT_SIZES ของ avatar_name และบันทึกลง Profile.avatar_variants
+    หาก avatar ถูกเปลี่ยนระหว่างนี้ ผลลัพธ์จะถูกทิ้งไป
+    """
+    storage = Profile._meta.get_field('avatar').storage
+    with storage.open(avatar_name, 'rb') as source:
+        image = Image.open(source)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    fmt = settings.AVATAR_VARIANT_FORMAT
+    extension = _FORMATS[fmt][0]
+    variants = _store(
+        {str(size): render_variant(image, size, fmt) for size in settings.AVATAR_VARIANT_SIZES}, extension, storage
+    )
+
+    with transaction.atomic():
+        previous = Profile.objects.select_for_update().filter(pk=profile_id, avatar=avatar_name).values_list(
+            'avatar_variants', flat=True
+        ).first()
+        if previous is None:
+            # avatar ถูกเปลี่ยนหรือ Profile ถูกลบระหว่างนี้ ปล่อยภาพย่อที่เพิ่งสร้าง (ลบทิ้งหากไม่มีใครใช้)
+            release_files(list(variants.values()))
+            return None
+        Profile.objects.filter(pk=profile_id).update(avatar_variants=variants, row_version=F('row_version') + 1)
+        release_files(list(previous.values()))
+    profile_cache.invalidate(Profile.objects.filter(pk=profile_id).values_list('user_id', flat=True).first())
+    return variants
+
+
+def _run(profile_id, avatar_name):
+    close_old_connections()
+    try:
+        generate_avatar_variants(profile_id, avatar_name)
+    except Exception:
+        logger.exception(f"Failed to generate avatar variants for profile {profile_id}")
+    finally:
+        close_old_connections()
+
+
+def schedule_avatar_variants(profile):
+    """
+    ส่งงานสร้างภาพย่อเข้า worker pool หลัง transaction commit เพื่อให้การอัปโหลดตอบกลับทันที
+    AVATAR_PROCESSING_MODE: 'async' (ค่าเริ่มต้น) หรือ 'inline'
+    """
+    profile_id, avatar_name = profile.pk, profile.avatar.name
+    if settings.AVATAR_PROCESSING_MODE == 'inline':
+        transaction.on_commit(lambda: _run(profile_id, avatar_name))
+    else:
+        transaction.on_commit(lambda: _get_executor().submit(_run, profile_id, avatar_name))
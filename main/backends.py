@@ -2,7 +2,8 @@
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
-from .models import LoginMethod
+from .models import UserIdentifier
+from .hashers import hash_dummy_password
 from rest_framework.exceptions import AuthenticationFailed
 import logging
 
@@ -13,19 +14,13 @@ User = get_user_model()
 
 class CustomAuthBackend(ModelBackend):
     def authenticate(self, request, username=None, password=None, **kwargs):
-        try:
-            # ลองค้นหาผู้ใช้ใน LoginMethod ก่อน
-            login_method = LoginMethod.objects.get(identifier=username)
-            user = login_method.user
-            logger.info(f"User {user} attempted login using {login_method.login_type}.") 
-        except LoginMethod.DoesNotExist:
-            # ถ้าไม่พบใน LoginMethod ให้ลองค้นหาด้วย email
-            try:
-                user = User.objects.get(email=username)
-                logger.info(f"User {user} attempted login using email.") 
-            except User.DoesNotExist:
-                logger.warning(f"Authentication failed: User with identifier '{username}' not found.")
-                raise AuthenticationFailed("Invalid credentials.")  # ส่งคืน error message หากไม่พบผู้ใช้
+        # ค้นหาผู้ใช้จาก UserIdentifier index (ครอบคลุมทั้ง LoginMethod, email, national_id และ phone_number)
+        user = UserIdentifier.objects.resolve_login(username)
+        if user is None:
+            hash_dummy_password(password)
+            logger.warning(f"Authentication failed: User with identifier '{username}' not found.")
+            raise AuthenticationFailed("Invalid credentials.")  # ส่งคืน error message หากไม่พบผู้ใช้
+        logger.info(f"User {user} attempted login.")
 
         if not user.is_active:
             logger.warning(f"Authentication failed: User {user} is inactive.")
@@ -0,0 +1,191 @@
+# main/cache.py
+
+import threading
+import time
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import router
+
+from .routers import primary_reads
+
+
+def sync_to_coroutine(func):
+    async def call(*args, **kwargs):
+        return func(*args, **kwargs)
+    return call
+
+
+class CacheMetrics:
+    """
+    ตัวนับ hit/miss ของ cache ในแต่ละ process แยกตาม namespace
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def record(self, namespace, outcome):
+        with self._lock:
+            self._counts[(namespace, outcome)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {f'{namespace}.{outcome}': count for (namespace, outcome), count in sorted(self._counts.items())}
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+metrics = CacheMetrics()
+
+
+class UserPayloadCache:
+    """
+    Read-through cache ของ payload ที่ serialize แล้วต่อผู้ใช้ บน cache alias ที่กำหนดใน API_CACHE_ALIAS
+    การ invalidate ใช้การเพิ่ม generation ของผู้ใช้แทนการลบ key ทำให้ค่าที่ถูกเขียนจาก request
+    ที่อ่านข้อมูลก่อนการแก้ไขจะไม่ถูกอ่านอีก (ไม่มี stale read หลังการอัปเดต)
+    build() อ่านจาก primary เสมอ: payload ที่สร้างจาก replica ที่ยังไม่เห็นการแก้ไขจะถูกเก็บไว้ใน generation ใหม่
+    และถูกส่งให้ทุก request จนหมดอายุ
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+
+    @property
+    def cache(self):
+        return caches[settings.API_CACHE_ALIAS]
+
+    def _generation_key(self, user_id):
+        return f'{self.namespace}:{user_id}:gen'
+
+    def _payload_key(self, user_id, generation, variant):
+        return f'{self.namespace}:{user_id}:{generation}:{variant}'
+
+    def _generation(self, user_id):
+        # generation ใหม่ (เช่นหลัง key ถูก evict) ต้องไม่ซ้ำกับค่าที่เคยใช้ มิฉะนั้น payload เก่าที่ยังค้างอยู่
+        # ใน cache จะกลับมาถูกใช้ได้ จึงเริ่มจากเวลาปัจจุบันแทน 0
+        key = self._generation_key(user_id)
+        generation = self.cache.get(key)
+        if generation is None:
+            generation = time.time_ns()
+            if not self.cache.add(key, generation, None):
+                generation = self.cache.get(key, generation)
+        return generation
+
+    def get_or_set(self, user_id, build, variant='default'):
+        """
+        คืน payload จาก cache หรือเรียก build() แล้วเก็บผลลัพธ์ไว้
+        """
+        generation = self._generation(user_id)
+        key = self._payload_key(user_id, generation, variant)
+        payload = self.cache.get(key)
+        if payload is not None:
+            metrics.record(self.namespace, 'hit')
+            return payload
+
+        metrics.record(self.namespace, 'miss')
+        with primary_reads():
+            payload = build()
+        self.cache.set(key, payload, settings.API_CACHE_TIMEOUT)
+        return payload
+
+    async def aget_or_set(self, user_id, build, variant='default'):
+        """
+        get_or_set สำหรับ async view โดย build เป็น coroutine function
+        LocMemCache ไม่บล็อก จึงเรียกแบบ sync ได้เลยโดยไม่ต้องสลับไป thread pool
+        """
+        cache = self.cache
+        if isinstance(cache, LocMemCache):
+            aget, aset, aadd = sync_to_coroutine(cache.get), sync_to_coroutine(cache.set), sync_to_coroutine(cache.add)
+        else:
+            aget, aset, aadd = cache.aget, cache.aset, cache.aadd
+        generation_key = self._generation_key(user_id)
+        generation = await aget(generation_key)
+        if generation is None:
+            generation = time.time_ns()
+            if not await aadd(generation_key, generation, None):
+                generation = await aget(generation_key, generation)
+        key = self._payload_key(user_id, generation, variant)
+        payload = await aget(key)
+        if payload is not None:
+            metrics.record(self.namespace, 'hit')
+            return payload
+
+        metrics.record(self.namespace, 'miss')
+        with primary_reads():
+            payload = await build()
+        await aset(key, payload, settings.API_CACHE_TIMEOUT)
+        return payload
+
+    def invalidate(self, user_id):
+        key = self._generation_key(user_id)
+        # add ไม่เขียนทับถ้ามี key อยู่แล้ว จากนั้น incr แบบ atomic (บน backend ที่รองรับ)
+        # ค่าเริ่มต้นเป็นเวลาปัจจุบัน ไม่ใช่ 0 เพื่อไม่ให้ generation ซ้ำกับก่อนที่ key จะถูก evict
+        self.cache.add(key, time.time_ns(), None)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # key หายไประหว่าง add และ incr (เช่นถูก evict)
+            self.cache.set(key, time.time_ns(), None)
+
+
+profile_cache = UserPayloadCache('profile')
+login_method_cache = UserPayloadCache('login-methods')
+
+
+class TokenEpochCache:
+    """
+    token_epoch ปัจจุบันของผู้ใช้ สำหรับตรวจ token ทุก request โดยไม่ต้อง query (บน API_CACHE_ALIAS)
+    การเพิ่ม epoch เขียนค่าใหม่ทับทันที ส่วนการเติมค่าหลัง cache miss ใช้ add
+    จึงไม่มีทางเขียนค่าเก่าที่อ่านมาก่อนการเพิกถอนทับค่าใหม่ได้
+    """
+    namespace = 'token-epoch'
+
+    @property
+    def cache(self):
+        return caches[settings.API_CACHE_ALIAS]
+
+    def _key(self, user_id):
+        return f'{self.namespace}:{user_id}'
+
+    def _load(self, user_id):
+        from .models import CustomUser
+
+        # อ่านจาก primary เสมอ replica ที่ล่าช้าอาจยังไม่เห็นการเพิกถอนหรือผู้ใช้ที่เพิ่งสร้าง
+        users = CustomUser.objects.using(router.db_for_write(CustomUser))
+        return users.filter(pk=user_id).values_list('token_epoch', flat=True).first()
+
+    def get(self, user_id):
+        """
+        epoch ของผู้ใช้ หรือ None ถ้าไม่มีผู้ใช้นี้
+        """
+        key = self._key(user_id)
+        epoch = self.cache.get(key)
+        if epoch is not None:
+            return epoch
+        epoch = self._load(user_id)
+        if epoch is not None:
+            self.cache.add(key, epoch, settings.TOKEN_EPOCH_CACHE_TIMEOUT)
+        return epoch
+
+    async def aget(self, user_id):
+        cache = self.cache
+        key = self._key(user_id)
+        epoch = cache.get(key) if isinstance(cache, LocMemCache) else await cache.aget(key)
+        if epoch is not None:
+            return epoch
+        return await sync_to_async(self.get)(user_id)
+
+    def set(self, user_id, epoch):
+        self.cache.set(self._key(user_id), epoch, settings.TOKEN_EPOCH_CACHE_TIMEOUT)
+
+    def forget(self, user_id):
+        self.cache.delete(self._key(user_id))
+
+
+token_epochs = TokenEpochCache()
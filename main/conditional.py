@@ -0,0 +1,74 @@
+# main/conditional.py
+
+import hashlib
+import json
+
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def version_state(objects):
+    """
+    คำนวณ (ETag, Last-Modified timestamp) จาก row_version และ updated_at ของ objects
+    """
+    objects = list(objects)
+    digest = hashlib.md5(usedforsecurity=False)
+    for obj in objects:
+        digest.update(f'|{obj.pk}:{obj.row_version}'.encode())
+    last_modified = max((obj.updated_at for obj in objects), default=None)
+    return f'"{digest.hexdigest()}"', int(last_modified.timestamp()) if last_modified else None
+
+
+def content_etag(data):
+    """
+    ETag จากข้อมูลที่ serialize แล้ว สำหรับ response ที่รวมหลายตาราง (row_version ของแถวหลักแถวเดียวไม่พอ)
+    """
+    payload = json.dumps(data, cls=JSONEncoder, sort_keys=True, separators=(',', ':')).encode()
+    return f'"{hashlib.md5(payload, usedforsecurity=False).hexdigest()}"'
+
+
+def conditional_response(request, etag, last_modified, build):
+    """
+    ตอบ 304/412 ตาม If-None-Match, If-Modified-Since, If-Match และ If-Unmodified-Since
+    โดยไม่ต้องเรียก build() (serialize) ถ้าไม่จำเป็น
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = Response(build())
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+class ConditionalRetrieveMixin:
+    """
+    retrieve ที่รองรับ conditional GET และ update ที่ตรวจ If-Match / If-Unmodified-Since
+    ก่อนบันทึก โดยล็อกแถวไว้ระหว่างตรวจและบันทึกเพื่อป้องกันการเขียนทับกัน
+    """
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        etag, last_modified = version_state([instance])
+        return conditional_response(request, etag, last_modified, lambda: self.get_serializer(instance).data)
+
+    def update(self, request, *args, **kwargs):
+        if 'HTTP_IF_MATCH' not in request.META and 'HTTP_IF_UNMODIFIED_SINCE' not in request.META:
+            return super().update(request, *args, **kwargs)
+
+        with transaction.atomic():
+            instance = self.get_object()
+            instance = type(instance).objects.select_for_update().get(pk=instance.pk)
+            etag, last_modified = version_state([instance])
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is not None:
+                return response
+            response = super().update(request, *args, **kwargs)
+
+        instance.refresh_from_db(fields=['row_version', 'updated_at'])
+        response['ETag'], last_modified = version_state([instance])
+        response['Last-Modified'] = http_date(last_modified)
+        return response
@@ -0,0 +1,106 @@
+# main/exporters.py
+
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+
+from .models import CustomUser, LoginMethod
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+
+def _profile_value(name):
+    def get(user):
+        profile = getattr(user, 'profile', None)  # ผู้ใช้บางคนอาจไม่มี Profile
+        if profile is None:
+            return None
+        value = getattr(profile, name)
+        if name == 'avatar':
+            return value.name or None
+        return value
+    return get
+
+
+def _login_methods(user):
+    return [{'login_type': method.login_type, 'identifier': method.identifier} for method in user.login_methods.all()]
+
+
+# ฟิลด์ที่ส่งออกได้: ชื่อ -> ฟังก์ชันดึงค่าจาก CustomUser
+EXPORT_FIELDS = {
+    'id': lambda user: user.id,
+    'email': lambda user: user.email,
+    'national_id': lambda user: user.national_id,
+    'phone_number': lambda user: str(user.phone_number) if user.phone_number else None,
+    'first_name': lambda user: user.first_name,
+    'last_name': lambda user: user.last_name,
+    'is_active': lambda user: user.is_active,
+    'is_staff': lambda user: user.is_staff,
+    'date_joined': lambda user: user.date_joined,
+    'bio': _profile_value('bio'),
+    'birth_date': _profile_value('birth_date'),
+    'avatar': _profile_value('avatar'),
+    'login_methods': _login_methods,
+}
+PROFILE_EXPORT_FIELDS = ('bio', 'birth_date', 'avatar')
+
+
+def parse_export_fields(value):
+    """
+    แปลงค่า fields ที่คั่นด้วย comma เป็นรายการฟิลด์ (ค่าว่างหมายถึงทุกฟิลด์)
+    """
+    if not value:
+        return list(EXPORT_FIELDS)
+    fields = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in EXPORT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown export field(s): {', '.join(unknown)}")
+    return fields
+
+
+def iter_export_rows(fields, chunk_size=2000):
+    """
+    ไล่อ่านผู้ใช้ทีละชุดด้วย iterator() (server-side cursor บน PostgreSQL)
+    โดย join Profile และ prefetch LoginMethod เฉพาะเมื่อถูกเลือก เพื่อให้หน่วยความจำคงที่
+    """
+    queryset = CustomUser.objects.order_by('id')
+    if set(fields) & set(PROFILE_EXPORT_FIELDS):
+        queryset = queryset.select_related('profile')
+    if 'login_methods' in fields:
+        queryset = queryset.prefetch_related(
+            Prefetch('login_methods', queryset=LoginMethod.objects.order_by('id').only('user_id', 'login_type', 'identifier'))
+        )
+    getters = [(name, EXPORT_FIELDS[name]) for name in fields]
+    for user in queryset.iterator(chunk_size=chunk_size):
+        yield {name: get(user) for name, get in getters}
+
+
+def render_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+class _Echo:
+    """
+    Pseudo-buffer สำหรับ csv.writer ที่คืนค่าแถวแทนการเขียนลงไฟล์
+    """
+
+    def write(self, value):
+        return value
+
+
+def render_csv(rows, fields):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        if 'login_methods' in row:
+            row['login_methods'] = ';'.join(f"{item['login_type']}:{item['identifier']}" for item in row['login_methods'])
+        yield writer.writerow(['' if row[name] is None else row[name] for name in fields])
+
+
+def render_export(fmt, fields, chunk_size=2000):
+    rows = iter_export_rows(fields, chunk_size=chunk_size)
+    if fmt == 'csv':
+        return render_csv(rows, fields)
+    return render_ndjson(rows)
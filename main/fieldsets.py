@@ -0,0 +1,143 @@
+# main/fieldsets.py
+
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import ValidationError
+
+from .conditional import conditional_response, content_etag
+
+
+def parse_names(value):
+    """
+    แยกรายชื่อที่คั่นด้วย , เช่น ?fields=id,email (ตัดช่องว่างและชื่อซ้ำ เรียงตามที่ส่งมา)
+    """
+    return tuple(dict.fromkeys(name for name in (part.strip() for part in (value or '').split(',')) if name))
+
+
+class ExpandableSerializerMixin:
+    """
+    Mixin ของ serializer ที่เลือกฟิลด์ได้ (fields=) และฝังความสัมพันธ์ได้ (expand=)
+
+    - expandable_fields: ชื่อ -> (ชื่อ serializer ในโมดูลเดียวกัน, kwargs) ฟิลด์ที่ฝังแทนที่ฟิลด์ชื่อเดียวกัน (ถ้ามี)
+    - field_dependencies: ฟิลด์ที่ไม่ได้อ่านคอลัมน์ชื่อเดียวกัน (เช่น SerializerMethodField) -> คอลัมน์ที่ต้องโหลด
+    """
+    expandable_fields = {}
+    field_dependencies = {}
+
+    def __init__(self, *args, fields=None, expand=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        for name in expand:
+            serializer_name, options = self.expandable_fields[name]
+            serializer_class = import_string(f'{type(self).__module__}.{serializer_name}')
+            self.fields[name] = serializer_class(read_only=True, **options)
+        if fields is not None:
+            for name in set(self.fields) - set(fields) - set(expand):
+                self.fields.pop(name)
+
+    @classmethod
+    def readable_fields(cls):
+        return [name for name, field in cls().fields.items() if not field.write_only]
+
+    @classmethod
+    def columns(cls, model, fields):
+        """
+        คอลัมน์ของ model ที่ต้องโหลดเพื่อ serialize ฟิลด์เหล่านี้ (สำหรับ QuerySet.only)
+        """
+        concrete = {field.name for field in model._meta.concrete_fields}
+        serializer_fields = cls().fields
+        columns = set()
+        for name in fields:
+            if name in cls.field_dependencies:
+                columns.update(cls.field_dependencies[name])
+            elif name in serializer_fields:
+                source = serializer_fields[name].source.split('.')[0]
+                if source in concrete:
+                    columns.add(source)
+        return columns
+
+
+class SparseFieldsetMixin:
+    """
+    ?fields=a,b และ ?expand=x,y สำหรับ list และ retrieve ของ ViewSet ที่ serializer ใช้ ExpandableSerializerMixin
+    โหลดเฉพาะคอลัมน์ที่ใช้ด้วย .only() และ select_related/prefetch_related เฉพาะความสัมพันธ์ที่ขอ
+
+    - expansions: ชื่อ -> ('select' หรือ 'prefetch', lookup)
+    - required_fields: คอลัมน์ที่ต้องโหลดเสมอ (ที่ from_db, ETag หรือ pagination อ่าน)
+      คอลัมน์ที่ถูก defer แล้วถูกอ่านภายหลังจะเกิด query ต่อแถว
+    - response ที่เลือกฟิลด์หรือฝังความสัมพันธ์ใช้ ETag จากเนื้อหา และไม่มี Last-Modified
+      (row_version ของแถวหลักไม่เปลี่ยนเมื่อข้อมูลที่ฝังเปลี่ยน)
+    """
+    expansions = {}
+    required_fields = ('id',)
+    sparse_actions = ('list', 'retrieve')
+
+    @cached_property
+    def fieldset(self):
+        """
+        (ฟิลด์ที่เลือกหรือ None เมื่อไม่ได้ระบุ, ความสัมพันธ์ที่ฝัง) ของ request นี้
+        """
+        if self.action not in self.sparse_actions:
+            return None, ()
+        params = self.request.query_params
+        expand = parse_names(params.get('expand'))
+        unknown = set(expand) - set(self.expansions)
+        if unknown:
+            raise ValidationError({'expand': f"Unknown expansion(s): {', '.join(sorted(unknown))}."})
+        if 'fields' not in params:
+            return None, expand
+        fields = parse_names(params['fields'])
+        if not fields:
+            raise ValidationError({'fields': 'At least one field is required.'})
+        unknown = set(fields) - set(self.get_serializer_class().readable_fields()) - set(expand)
+        if unknown:
+            raise ValidationError({'fields': f"Unknown field(s): {', '.join(sorted(unknown))}."})
+        return fields, expand
+
+    @property
+    def sparse(self):
+        fields, expand = self.fieldset
+        return fields is not None or bool(expand)
+
+    def get_serializer(self, *args, **kwargs):
+        fields, expand = self.fieldset
+        if fields is not None:
+            kwargs.setdefault('fields', fields)
+        if expand:
+            kwargs.setdefault('expand', expand)
+        return super().get_serializer(*args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        fields, expand = self.fieldset
+        for name in expand:
+            kind, lookup = self.expansions[name]
+            queryset = queryset.select_related(lookup) if kind == 'select' else queryset.prefetch_related(lookup)
+        if fields is not None:
+            columns = self.get_serializer_class().columns(queryset.model, fields)
+            # foreign key ที่ select_related หรือ prefetch_related ต่อจากมันต้องถูกโหลดด้วย
+            concrete = {field.name for field in queryset.model._meta.concrete_fields}
+            columns.update(
+                root for root in (self.expansions[name][1].split('__')[0] for name in expand) if root in concrete
+            )
+            queryset = queryset.only(*self.required_fields, *columns)
+        return queryset
+
+    def retrieve(self, request, *args, **kwargs):
+        if not self.sparse:
+            return super().retrieve(request, *args, **kwargs)
+        data = self.get_serializer(self.get_object()).data
+        return conditional_response(request, content_etag(data), None, lambda: data)
+
+    def payload_variant(self):
+        """
+        ชื่อ variant ของ payload ที่ cache ไว้ (CachedListMixin) แยกตามฟิลด์และความสัมพันธ์ที่ขอ
+        """
+        if not self.sparse:
+            return super().payload_variant()
+        fields, expand = self.fieldset
+        return f"fields={','.join(fields) if fields is not None else '*'};expand={','.join(expand)}"
+
+    def payload_version(self, objects, data):
+        if not self.sparse:
+            return super().payload_version(objects, data)
+        return content_etag(data), None
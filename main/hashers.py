@@ -0,0 +1,183 @@
+# main/hashers.py
+
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.contrib.auth.hashers import make_password
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class HashCost:
+    """
+    ค่า cost ของ hasher ที่อ่านจาก PASSWORD_HASH_PROFILES ตาม PASSWORD_HASH_PROFILE ที่ใช้งานอยู่
+    หากโปรไฟล์ไม่ได้กำหนดค่าไว้จะใช้ค่า default ของ Django
+    """
+
+    def __init__(self, default):
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        profile = settings.PASSWORD_HASH_PROFILES.get(settings.PASSWORD_HASH_PROFILE, {})
+        return profile.get(owner.algorithm, {}).get(self.name, self.default)
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    iterations = HashCost(hashers.PBKDF2PasswordHasher.iterations)
+
+
+class ScryptPasswordHasher(hashers.ScryptPasswordHasher):
+    work_factor = HashCost(hashers.ScryptPasswordHasher.work_factor)
+    block_size = HashCost(hashers.ScryptPasswordHasher.block_size)
+    parallelism = HashCost(hashers.ScryptPasswordHasher.parallelism)
+    maxmem = HashCost(hashers.ScryptPasswordHasher.maxmem)
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    """
+    ต้องติดตั้ง argon2-cffi หากต้องการใช้ (Django จะ import library เมื่อถูกใช้งานเท่านั้น)
+    """
+    time_cost = HashCost(hashers.Argon2PasswordHasher.time_cost)
+    memory_cost = HashCost(hashers.Argon2PasswordHasher.memory_cost)
+    parallelism = HashCost(hashers.Argon2PasswordHasher.parallelism)
+
+
+_rehash_executor = None
+
+
+def _get_rehash_executor():
+    global _rehash_executor
+    if _rehash_executor is None:
+        _rehash_executor = ThreadPoolExecutor(
+            max_workers=settings.PASSWORD_REHASH_WORKERS,
+            thread_name_prefix='password-rehash',
+        )
+    return _rehash_executor
+
+
+def _rehash(user_model, user_id, old_encoded, raw_password):
+    try:
+        # อัปเดตเฉพาะเมื่อ hash ยังเป็นค่าเดิม ถ้าผู้ใช้เปลี่ยนรหัสผ่านระหว่างนี้จะไม่เขียนทับ
+        user_model._default_manager.filter(pk=user_id, password=old_encoded).update(
+            password=make_password(raw_password)
+        )
+    except Exception:
+        logger.exception(f"Failed to upgrade password hash for user {user_id}")
+
+
+def _rehash_in_background(*args):
+    # connection ของ thread ใน pool ไม่ได้ถูกจัดการโดย request cycle จึงต้องปิดเอง
+    # (ห้ามเรียกใน thread ของ request เพราะจะปิด connection ที่ request ยังใช้อยู่)
+    close_old_connections()
+    try:
+        _rehash(*args)
+    finally:
+        close_old_connections()
+
+
+def schedule_rehash(user, raw_password):
+    """
+    อัปเกรด hash ที่ใช้พารามิเตอร์เก่าหลังจาก login สำเร็จ
+    PASSWORD_REHASH_MODE: 'async' ทำใน background thread, 'inline' ทำทันที, 'off' ไม่อัปเกรด
+    """
+    mode = settings.PASSWORD_REHASH_MODE
+    if mode == 'off':
+        return None
+    if mode == 'inline':
+        return _rehash(type(user), user.pk, user.password, raw_password)
+    return _get_rehash_executor().submit(_rehash_in_background, type(user), user.pk, user.password, raw_password)
+
+
+class HashQueueFull(Exception):
+    """
+    มีงานตรวจรหัสผ่านรออยู่เต็ม PASSWORD_HASH_QUEUE_SIZE แล้ว
+    """
+
+
+class BoundedHashExecutor:
+    """
+    Thread pool สำหรับงาน hash รหัสผ่าน (ใช้ CPU สูง) จาก async view เพื่อไม่ให้ event loop ถูกบล็อก
+    จำกัดจำนวนงานที่รอได้ งานที่เกินจะถูกปฏิเสธทันทีแทนที่จะต่อคิวไม่สิ้นสุด
+    """
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self._pending >= self.queue_size:
+                raise HashQueueFull()
+            self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def map(self, func, items):
+        """
+        สำหรับงานแบบ sync จำนวนมาก (เช่นการนำเข้าผู้ใช้) ใน pool เดียวกัน โดยมีงานค้างในคิวไม่เกินจำนวน worker
+        งาน hash ของ login ที่เข้ามาระหว่างนั้นจึงรอไม่เกินหนึ่งรอบ แทนที่จะต่อท้ายงานนำเข้าทั้งชุด
+        """
+        results, pending = [], deque()
+        for item in items:
+            if len(pending) >= self.workers:
+                results.append(pending.popleft().result())
+            pending.append(self._executor.submit(func, item))
+        results.extend(future.result() for future in pending)
+        return results
+
+
+_hash_executor = None
+
+
+def get_hash_executor():
+    global _hash_executor
+    if _hash_executor is None:
+        _hash_executor = BoundedHashExecutor(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_QUEUE_SIZE)
+    return _hash_executor
+
+
+def _verify(raw_password, encoded):
+    # คืน (ถูกต้องหรือไม่, ต้องอัปเกรด hash หรือไม่) โดยไม่แตะฐานข้อมูล
+    outdated = []
+    valid = hashers.check_password(raw_password, encoded, setter=lambda raw: outdated.append(True))
+    return valid, bool(outdated)
+
+
+def hash_dummy_password(raw_password):
+    """
+    hash รหัสผ่านด้วย cost เดียวกับการตรวจจริง สำหรับ login ที่ไม่พบผู้ใช้
+    เพื่อไม่ให้เวลาตอบบอกได้ว่า identifier มีอยู่ในระบบหรือไม่
+    """
+    make_password(raw_password)
+
+
+async def ahash_dummy_password(raw_password):
+    await get_hash_executor().run(make_password, raw_password)
+
+
+async def acheck_password(user, raw_password):
+    """
+    CustomUser.check_password สำหรับ async view: hash ใน BoundedHashExecutor
+    และส่ง hash ที่ล้าสมัยเข้าคิว rehash เหมือนเวอร์ชัน sync
+    """
+    valid, outdated = await get_hash_executor().run(_verify, raw_password, user.password)
+    if valid and outdated:
+        await sync_to_async(schedule_rehash)(user, raw_password)
+    return valid
@@ -0,0 +1,269 @@
+# main/identifier_filter.py
+
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """
+    Bloom filter ของสตริง: ไม่มี false negative ส่วน false positive ประมาณ error_rate เมื่อมีสมาชิกไม่เกิน capacity
+    ตำแหน่งบิตทั้ง k ตำแหน่งคำนวณจาก blake2b ครั้งเดียว (double hashing)
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = max(capacity, 1)
+        self.size = max(int(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / self.capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        positions = self._positions(value)
+        bits = self.bits
+        if all(bits[position >> 3] & (1 << (position & 7)) for position in positions):
+            return  # มีอยู่แล้ว (หรือ false positive) ไม่นับซ้ำ
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class IdentifierFilter:
+    """
+    Bloom filter ของ identifier ทั้งหมดใน UserIdentifier (canonical แล้ว) ของ process นี้
+    identifier ที่อยู่ใน filter ต้องค้นหาต่อตามปกติ ส่วนที่ไม่อยู่ใน filter ตอบว่าไม่มีได้จากหน่วยความจำ
+    เว้นแต่ filter อาจยังไม่เห็นแถวใหม่ (ดู _due) ซึ่งจะ sync แบบเพิ่มเติมหนึ่งครั้งก่อนตอบ
+
+    - สร้างจากฐานข้อมูลเมื่อถูกใช้ครั้งแรก และเพิ่ม identifier ใหม่ทันทีผ่าน signal ของ CustomUser/LoginMethod
+      และหลัง commit ของ UserImporter
+    - ผู้เขียนเพิ่ม generation กลางใน cache ของ API (API_CACHE_ALIAS) หลัง commit process ที่เห็น generation
+      เปลี่ยนจะ sync ก่อนตอบว่าไม่มี บน cache แบบแยก process (locmem) process อื่นจะเห็นแถวใหม่ภายใน
+      IDENTIFIER_FILTER_SYNC_INTERVAL วินาที ซึ่งเป็นช่วงเวลาสูงสุดที่ identifier ใหม่อาจถูกตอบว่าไม่มี
+    - sync แบบเพิ่มเติมอ่านแถวที่ id สูงกว่าที่เคยเห็น และแถวใน "ช่องว่าง" ของ id ที่ยังไม่เคยเห็น
+      (id ที่ถูกจองโดย transaction ที่ยังไม่ commit เช่นการนำเข้าขนาดใหญ่) ช่องว่างถูกตรวจซ้ำทุกครั้ง
+      จนกว่าจะเจอแถวหรือเกิน IDENTIFIER_FILTER_GAP_TIMEOUT วินาที (id ของ transaction ที่ rollback หรือแถวที่ถูกลบ)
+    - sync ทำได้ทีละ thread และไม่ถือ _lock ระหว่าง query: thread อื่นที่ต้องการ sync ระหว่างนั้นไม่รอ
+      แต่ตอบว่าอาจมี (ให้การค้นหาตามปกติตัดสิน)
+    - การลบทำไม่ได้ใน Bloom filter identifier ที่ถูกลบจึงเหลือเป็น false positive (แค่ query ตามปกติ)
+      จนกว่า filter จะถูกสร้างใหม่เมื่อจำนวนที่ถูกลบหรือจำนวนสมาชิกเกินกำหนด
+    """
+    # จำนวนช่องว่างสูงสุดที่ติดตาม (เก็บช่วงที่ id สูงที่สุด ซึ่งเป็นของ transaction ล่าสุด)
+    MAX_GAPS = 100
+    GENERATION_KEY = 'identifier-filter:generation'
+
+    def __init__(self):
+        self._lock = threading.Lock()  # สถานะในหน่วยความจำเท่านั้น ห้าม query ระหว่างถือ
+        self._sync_lock = threading.Lock()  # sync ทีละ thread
+        self.reset()
+
+    def reset(self):
+        self._bloom = None
+        self._max_id = 0
+        self._gaps = []  # [(id แรก, id สุดท้าย, เวลาที่พบ)]
+        self._removed = 0
+        self._synced = None  # time.monotonic() ตอนเริ่ม sync ล่าสุดที่เสร็จแล้ว
+        self._generation = None  # generation กลางที่ sync ล่าสุดเห็น
+        self._pending = None  # identifier ที่ถูกเพิ่มระหว่างสร้าง filter ใหม่
+
+    @property
+    def cache(self):
+        return caches[settings.API_CACHE_ALIAS]
+
+    def _shared_generation(self):
+        return self.cache.get(self.GENERATION_KEY)
+
+    async def _ashared_generation(self):
+        cache = self.cache
+        return cache.get(self.GENERATION_KEY) if isinstance(cache, LocMemCache) else await cache.aget(self.GENERATION_KEY)
+
+    def publish(self):
+        """
+        แจ้งทุก process ว่ามี identifier ใหม่ถูก commit แล้ว
+        """
+        self.cache.add(self.GENERATION_KEY, 0, None)
+        try:
+            self.cache.incr(self.GENERATION_KEY)
+        except ValueError:
+            # key หายไประหว่าง add และ incr (เช่นถูก evict)
+            self.cache.set(self.GENERATION_KEY, time.time_ns(), None)
+
+    def _stale(self):
+        bloom = self._bloom
+        return (
+            bloom is None
+            or bloom.count > bloom.capacity
+            or self._removed > bloom.count * settings.IDENTIFIER_FILTER_REBUILD_RATIO
+        )
+
+    def _due(self, generation):
+        """
+        True เมื่อ filter อาจยังไม่เห็น identifier ที่ถูก commit แล้ว (ต้อง sync ก่อนตอบว่าไม่มี)
+        """
+        return (
+            self._stale()
+            or generation != self._generation
+            or time.monotonic() - self._synced >= settings.IDENTIFIER_FILTER_SYNC_INTERVAL
+        )
+
+    def _missing(self, low, high, ids, found_at):
+        # ช่วงของ id ใน [low, high] ที่ไม่อยู่ใน ids (เรียงแล้ว)
+        gaps = []
+        for pk in ids:
+            if pk > low:
+                gaps.append((low, pk - 1, found_at))
+            low = pk + 1
+        if low <= high:
+            gaps.append((low, high, found_at))
+        return gaps
+
+    def sync(self):
+        """
+        สร้าง filter ใหม่ทั้งหมด (ครั้งแรก หรือเมื่อเต็ม/มีการลบมาก) หรือเพิ่มเฉพาะแถวใหม่และแถวในช่องว่าง
+        คืน False โดยไม่รอเมื่อ thread อื่นกำลัง sync อยู่
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return False
+        try:
+            self._sync()
+        finally:
+            self._sync_lock.release()
+        return True
+
+    def _sync(self):
+        from django.db.models import Q
+
+        from .models import UserIdentifier
+
+        now = time.monotonic()
+        # อ่านก่อน query: การเขียนที่ commit หลังจากนี้จะทำให้ sync อีกครั้ง
+        generation = self._shared_generation()
+        with self._lock:
+            rebuild = self._stale()
+            if rebuild:
+                self._pending, removed = [], self._removed
+            else:
+                bloom, max_id, gaps = self._bloom, self._max_id, self._gaps
+
+        if rebuild:
+            total = UserIdentifier.objects.count()
+            logger.info(f"Building identifier filter for {total} identifiers")
+            bloom = BloomFilter(max(settings.IDENTIFIER_FILTER_CAPACITY, 2 * total), settings.IDENTIFIER_FILTER_ERROR_RATE)
+            rows = UserIdentifier.objects.order_by('id').values_list('id', 'identifier').iterator(chunk_size=10000)
+            max_id, gaps = 0, []
+        else:
+            timeout = settings.IDENTIFIER_FILTER_GAP_TIMEOUT
+            gaps = [gap for gap in gaps if now - gap[2] < timeout]
+            condition = Q(id__gt=max_id)
+            for low, high, _ in gaps:
+                condition |= Q(id__range=(low, high))
+            rows = UserIdentifier.objects.filter(condition).order_by('id').values_list('id', 'identifier')
+
+        previous, fresh, filled, identifiers = max_id, deque(maxlen=self.MAX_GAPS), [], []
+        for pk, identifier in rows:
+            if rebuild:
+                bloom.add(identifier)  # filter ใหม่ยังไม่มี thread อื่นเห็น
+            else:
+                identifiers.append(identifier)
+            if pk <= max_id:
+                filled.append(pk)
+                continue
+            if pk > previous + 1:
+                fresh.append((previous + 1, pk - 1, now))  # ช่องว่างใหม่ระหว่าง id ที่เพิ่งอ่าน
+            previous = pk
+        # ช่องว่างเดิมที่ยังไม่เจอแถว คงเวลาที่พบครั้งแรกไว้
+        remaining = list(fresh)
+        for low, high, found_at in gaps:
+            remaining += self._missing(low, high, [pk for pk in filled if low <= pk <= high], found_at)
+
+        with self._lock:
+            if rebuild:
+                # identifier ที่ถูกเพิ่มและถูกลบระหว่างสร้าง ยังต้องนับรวม
+                identifiers, self._pending = self._pending, None
+                self._removed -= removed
+            for identifier in identifiers:
+                bloom.add(identifier)
+            self._bloom, self._max_id, self._gaps = bloom, previous, sorted(remaining)[-self.MAX_GAPS:]
+            self._synced, self._generation = now, generation
+
+    def _contains(self, identifiers, generation):
+        # identifier ที่อาจมีอยู่ หรือ None เมื่อต้อง sync ก่อนตอบ
+        bloom = self._bloom
+        if bloom is None:
+            return None
+        found = {identifier for identifier in identifiers if identifier in bloom}
+        if len(found) < len(identifiers) and self._due(generation):
+            return None
+        return found
+
+    def might_contain_many(self, identifiers):
+        """
+        identifier ที่อาจมีอยู่ในระบบ ใช้ sync ไม่เกินหนึ่งครั้งสำหรับทุกตัวที่ไม่อยู่ใน filter
+        """
+        identifiers = set(identifiers)
+        if not settings.IDENTIFIER_FILTER_ENABLED or not identifiers:
+            return identifiers
+        found = self._contains(identifiers, self._shared_generation())
+        if found is not None:
+            return found
+        if not self.sync():
+            return identifiers  # thread อื่นกำลัง sync ให้การค้นหาตามปกติตัดสิน
+        bloom = self._bloom
+        return {identifier for identifier in identifiers if identifier in bloom}
+
+    def might_contain(self, identifier):
+        """
+        False เมื่อแน่ใจว่าไม่มี identifier (canonical) นี้ในระบบ (ภายในขอบเขตของ IDENTIFIER_FILTER_SYNC_INTERVAL)
+        """
+        return bool(self.might_contain_many([identifier]))
+
+    async def amight_contain(self, identifier):
+        if not settings.IDENTIFIER_FILTER_ENABLED:
+            return True
+        found = self._contains({identifier}, await self._ashared_generation())
+        if found is not None:
+            return bool(found)
+        if not await sync_to_async(self.sync)():
+            return True
+        return identifier in self._bloom
+
+    def add(self, identifiers):
+        """
+        เพิ่ม identifier ที่เพิ่งเขียนลง filter ของ process นี้ทันที และแจ้ง process อื่นหลัง commit
+        """
+        identifiers = [identifier for identifier in identifiers if identifier]
+        if not identifiers:
+            return
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(identifiers)
+            if self._bloom is not None:
+                for identifier in identifiers:
+                    self._bloom.add(identifier)
+        transaction.on_commit(self.publish)
+
+    def discard(self, count=1):
+        self._removed += count
+
+
+identifier_filter = IdentifierFilter()
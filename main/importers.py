@@ -0,0 +1,190 @@
+# main/importers.py
+
+import csv
+import io
+import json
+import logging
+from dataclasses import dataclass, field
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+from rest_framework import serializers
+from rest_framework.validators import UniqueValidator
+
+from .hashers import get_hash_executor
+from .identifier_filter import identifier_filter
+from .models import CustomUser, LoginMethod, Profile, UserIdentifier, canonical_identifier
+from .serializers import CustomUserSerializer
+
+logger = logging.getLogger(__name__)
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+
+
+class UserImportRowSerializer(CustomUserSerializer):
+    """
+    ตรวจสอบข้อมูลผู้ใช้หนึ่งแถวจากไฟล์นำเข้า
+    การตรวจสอบค่าซ้ำทำทีละชุดใน UserImporter แทน UniqueValidator ที่ query ทีละแถว
+    """
+    password = serializers.CharField(max_length=128, write_only=True, required=False)
+    identifier_fields = ()  # ตรวจทีละชุดใน UserImporter._check_unique
+
+    class Meta(CustomUserSerializer.Meta):
+        fields = ['email', 'national_id', 'phone_number', 'first_name', 'last_name', 'password']
+
+    def get_fields(self):
+        fields = super().get_fields()
+        for serializer_field in fields.values():
+            serializer_field.validators = [
+                validator for validator in serializer_field.validators if not isinstance(validator, UniqueValidator)
+            ]
+        return fields
+
+    def validate(self, attrs):
+        if not any(attrs.get(name) for name in CustomUser.IDENTIFIER_FIELDS):
+            raise serializers.ValidationError("At least one of email, national_id or phone_number is required.")
+        return attrs
+
+
+def iter_rows(stream, fmt):
+    """
+    อ่านแถวจาก stream (binary หรือ text) ทีละแถว คืนค่า (หมายเลขบรรทัด, dict)
+    ค่าว่างจะถูกตัดออกเพื่อให้ฟิลด์ unique ที่ไม่ได้กรอกเป็น NULL
+    """
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"Unsupported import format: {fmt}")
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {key: value for key, value in row.items() if key and value not in ('', None)}
+        return
+
+    for line_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_no, e
+            continue
+        if not isinstance(row, dict):
+            yield line_no, ValueError("Each line must be a JSON object.")
+            continue
+        yield line_no, {key: value for key, value in row.items() if value not in ('', None)}
+
+
+@dataclass
+class ImportResult:
+    created: int = 0
+    errors: list = field(default_factory=list)
+
+    def add_error(self, line, detail):
+        self.errors.append({'line': line, 'errors': detail})
+
+    def as_dict(self):
+        return {'created': self.created, 'failed': len(self.errors), 'errors': self.errors}
+
+
+class UserImporter:
+    """
+    นำเข้าผู้ใช้จำนวนมาก: ตรวจสอบทีละชุด, hash รหัสผ่านใน BoundedHashExecutor (pool เดียวกับ async login)
+    และสร้าง CustomUser, Profile, LoginMethod และ UserIdentifier ด้วย bulk_create ใน transaction ต่อชุด
+    แถวที่ผิดพลาดจะถูกรายงานใน ImportResult โดยไม่หยุดการนำเข้าแถวอื่น
+    """
+
+    def __init__(self, chunk_size=1000, executor=None):
+        self.chunk_size = chunk_size
+        self.executor = executor
+
+    def run(self, rows):
+        result = ImportResult()
+        rows = iter(rows)
+        executor = self.executor or get_hash_executor()
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            self._import_chunk(chunk, executor, result)
+        return result
+
+    def _import_chunk(self, chunk, executor, result):
+        valid = self._validate(chunk, result)
+        if not valid:
+            return
+
+        passwords = [data.pop('password', None) for _, data in valid]
+        hashed = executor.map(make_password, passwords)
+        users = [(line, CustomUser(password=encoded, **data)) for (line, data), encoded in zip(valid, hashed)]
+
+        try:
+            with transaction.atomic():
+                self._insert([user for _, user in users])
+            result.created += len(users)
+        except IntegrityError:
+            # มีแถวชนกับข้อมูลที่ถูกเพิ่มระหว่างนำเข้า ลองใหม่ทีละแถวเพื่อหาแถวที่ผิดพลาด
+            for line, user in users:
+                user.pk = None
+                try:
+                    with transaction.atomic():
+                        self._insert([user])
+                    result.created += 1
+                except IntegrityError as e:
+                    result.add_error(line, {'non_field_errors': [str(e)]})
+
+    def _validate(self, chunk, result):
+        parsed = []
+        for line, data in chunk:
+            if isinstance(data, Exception):
+                result.add_error(line, {'non_field_errors': [str(data)]})
+            else:
+                parsed.append((line, data))
+
+        # ใช้ serializer ตัวเดียวทั้งชุด ฟิลด์จะถูกสร้างเพียงครั้งเดียว
+        serializer = UserImportRowSerializer()
+        checked = []
+        for line, data in parsed:
+            try:
+                checked.append((line, dict(serializer.run_validation(data))))
+            except serializers.ValidationError as e:
+                result.add_error(line, e.detail)
+        return self._check_unique(checked, result)
+
+    def _check_unique(self, rows, result):
+        identifiers = {
+            line: [canonical_identifier(data[name]) for name in CustomUser.IDENTIFIER_FIELDS if data.get(name)]
+            for line, data in rows
+        }
+        taken = set(UserIdentifier.objects.filter(
+            identifier__in=[value for values in identifiers.values() for value in values]
+        ).values_list('identifier', flat=True))
+
+        unique = []
+        for line, data in rows:
+            duplicates = [value for value in identifiers[line] if value in taken]
+            if duplicates:
+                result.add_error(line, {'non_field_errors': [f"Identifier already in use: {', '.join(duplicates)}"]})
+                continue
+            taken.update(identifiers[line])
+            unique.append((line, data))
+        return unique
+
+    def _insert(self, users):
+        CustomUser.objects.bulk_create(users)
+        Profile.objects.bulk_create([Profile(user_id=user.pk) for user in users])
+
+        login_methods, index = [], []
+        for user in users:
+            for login_type in CustomUser.IDENTIFIER_FIELDS:
+                value = getattr(user, login_type)
+                if value:
+                    login_methods.append(LoginMethod(user_id=user.pk, login_type=login_type, identifier=str(value)))
+                    index.append(UserIdentifier(user_id=user.pk, identifier=canonical_identifier(value)))
+        LoginMethod.objects.bulk_create(login_methods)
+        UserIdentifier.objects.bulk_create(index)
+        # bulk_create ไม่ส่ง signal จึงต้องเพิ่ม identifier ลง filter ของ process นี้เอง (หลัง commit)
+        identifiers = [row.identifier for row in index]
+        transaction.on_commit(lambda: identifier_filter.add(identifiers))
@@ -0,0 +1,247 @@
+# main/instrumentation.py
+
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+from .cache import metrics as cache_metrics
+
+logger = logging.getLogger(__name__)
+
+# RequestMetrics ของ request ที่กำลังทำงาน (ตามไปถึง thread ของ sync_to_async ด้วย contextvars)
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    View ใช้ query เกิน query_budgets ที่ประกาศไว้ (raise เฉพาะเมื่อ QUERY_BUDGET_ENFORCE=True)
+    """
+
+
+class RequestMetrics:
+    __slots__ = ('queries', 'db_time', 'serializer_time', 'serializing')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializing = False
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    execute_wrapper ที่นับ query และเวลาใน DB ให้ request ปัจจุบัน (ไม่ทำอะไรถ้าไม่มี request)
+    """
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_time += time.perf_counter() - started
+        metrics.queries += 1
+
+
+def install_query_recorder(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class TimedRepresentationMixin:
+    """
+    Mixin ของ serializer ที่จับเวลา to_representation ระดับนอกสุดเป็น serializer time ของ request
+    """
+
+    def to_representation(self, instance):
+        metrics = _current.get()
+        if metrics is None or metrics.serializing:
+            return super().to_representation(instance)
+        metrics.serializing = True
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            metrics.serializer_time += time.perf_counter() - started
+            metrics.serializing = False
+
+
+def query_budget(match, method):
+    """
+    Query budget ของ view ที่ resolve ได้: query_budgets บน view class ใช้ชื่อ action ของ ViewSet
+    (เช่น 'list', 'retrieve') หรือชื่อ method (เช่น 'post') เป็น key
+    """
+    if match is None:
+        return None
+    func = match.func
+    view_class = getattr(func, 'cls', None) or getattr(func, 'view_class', None)
+    budgets = getattr(view_class, 'query_budgets', None)
+    if not budgets:
+        return None
+    method = method.lower()
+    return budgets.get((getattr(func, 'actions', None) or {}).get(method, method))
+
+
+class MetricsRegistry:
+    """
+    สถิติสะสมต่อ view ใน process นี้ สำหรับ endpoint แบบ Prometheus
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._requests = defaultdict(int)
+            self._durations = defaultdict(lambda: [0] * (len(DURATION_BUCKETS) + 1) + [0.0])
+            self._totals = defaultdict(float)
+
+    def observe(self, view, method, status, total, metrics, over_budget):
+        with self._lock:
+            self._requests[(view, method, str(status))] += 1
+            histogram = self._durations[(view, method)]
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if total <= bound:
+                    histogram[index] += 1
+            histogram[len(DURATION_BUCKETS)] += 1
+            histogram[-1] += total
+            self._totals[('db_queries_total', view)] += metrics.queries
+            self._totals[('db_duration_seconds_total', view)] += metrics.db_time
+            self._totals[('serializer_duration_seconds_total', view)] += metrics.serializer_time
+            if over_budget:
+                self._totals[('query_budget_exceeded_total', view)] += 1
+
+    def total(self, name):
+        """
+        ผลรวมของตัวนับ (เช่น 'db_queries_total') ทุก view
+        """
+        with self._lock:
+            return sum(value for (metric, _), value in self._totals.items() if metric == name)
+
+    def render(self):
+        """
+        สถิติในรูปแบบ Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            lines += ['# HELP msoapi_requests_total Requests handled per view.', '# TYPE msoapi_requests_total counter']
+            for (view, method, status), count in sorted(self._requests.items()):
+                lines.append(f'msoapi_requests_total{{view="{view}",method="{method}",status="{status}"}} {count}')
+
+            lines += ['# HELP msoapi_request_duration_seconds Request latency per view.',
+                      '# TYPE msoapi_request_duration_seconds histogram']
+            for (view, method), histogram in sorted(self._durations.items()):
+                labels = f'view="{view}",method="{method}"'
+                for bound, count in zip(DURATION_BUCKETS, histogram):
+                    lines.append(f'msoapi_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'msoapi_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram[len(DURATION_BUCKETS)]}')
+                lines.append(f'msoapi_request_duration_seconds_sum{{{labels}}} {histogram[-1]:.6f}')
+                lines.append(f'msoapi_request_duration_seconds_count{{{labels}}} {histogram[len(DURATION_BUCKETS)]}')
+
+            names = sorted({name for name, _ in self._totals})
+            for name in names:
+                lines.append(f'# TYPE msoapi_{name} counter')
+                for (metric, view), value in sorted(self._totals.items()):
+                    if metric == name:
+                        lines.append(f'msoapi_{name}{{view="{view}"}} {value:g}')
+
+        lines.append('# TYPE msoapi_cache_events_total counter')
+        for key, count in cache_metrics.snapshot().items():
+            namespace, outcome = key.rsplit('.', 1)
+            lines.append(f'msoapi_cache_events_total{{namespace="{namespace}",outcome="{outcome}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class InstrumentationMiddleware:
+    """
+    วัด query count, เวลาใน DB, เวลา serialize และเวลารวมของแต่ละ request
+    ส่งกลับเป็น header Server-Timing และสะสมไว้ใน registry ตรวจ query_budgets ของ view ด้วย
+    เมื่อ INSTRUMENTATION_ENABLED=False middleware นี้จะถูกถอดออกจาก chain ทั้งหมด (ไม่มี overhead)
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.INSTRUMENTATION_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics, token, started = self.enter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.leave(request, response, metrics, started)
+
+    async def __acall__(self, request):
+        metrics, token, started = self.enter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.leave(request, response, metrics, started)
+
+    def enter(self):
+        for connection in connections.all():
+            install_query_recorder(connection)
+        metrics = RequestMetrics()
+        return metrics, _current.set(metrics), time.perf_counter()
+
+    def leave(self, request, response, metrics, started):
+        total = time.perf_counter() - started
+        match = request.resolver_match
+        view = (match.view_name or match.route) if match else 'unresolved'
+        budget = query_budget(match, request.method)
+        over_budget = budget is not None and metrics.queries > budget
+
+        registry.observe(view, request.method, response.status_code, total, metrics, over_budget)
+        response['Server-Timing'] = (
+            f'db;dur={metrics.db_time * 1000:.2f};desc="{metrics.queries} queries", '
+            f'serializer;dur={metrics.serializer_time * 1000:.2f}, '
+            f'total;dur={total * 1000:.2f}'
+        )
+        if over_budget:
+            message = f"{request.method} {view} ran {metrics.queries} queries (budget {budget})"
+            if settings.QUERY_BUDGET_ENFORCE:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+
+def metrics_view(request):
+    """
+    สถิติของ process นี้ในรูปแบบ Prometheus (อนุญาตเฉพาะ IP ใน METRICS_ALLOWED_IPS)
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def enforce_query_budgets():
+    """
+    สำหรับใช้ในเทสต์ (decorator หรือ context manager): เปิด instrumentation และให้ request
+    ที่ใช้ query เกิน query_budgets raise QueryBudgetExceeded สร้าง client ภายในขอบเขตนี้
+    เพื่อให้ middleware ถูกโหลดใหม่ตาม setting
+    """
+    from django.test.utils import override_settings
+
+    return override_settings(INSTRUMENTATION_ENABLED=True, QUERY_BUDGET_ENFORCE=True)
@@ -0,0 +1,188 @@
+# main/keyring.py
+
+import base64
+import hashlib
+import json
+import threading
+
+import jwt
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.translation import gettext_lazy as _
+from jwt import ExpiredSignatureError, InvalidAlgorithmError, InvalidTokenError
+from rest_framework_simplejwt.backends import TokenBackend
+from rest_framework_simplejwt.exceptions import TokenBackendError, TokenBackendExpiredToken
+from rest_framework_simplejwt.settings import api_settings
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class SigningKey:
+    """
+    กุญแจหนึ่งชุดใน key ring: private key (None สำหรับกุญแจเก่าที่เหลือแค่ public key),
+    public key ที่ parse แล้ว, JWK สาธารณะ และ kid (JWK thumbprint ตาม RFC 7638 จึงไม่ต้องตั้งชื่อเอง)
+    """
+    # สมาชิกที่ใช้คำนวณ thumbprint ของ JWK แต่ละชนิด
+    THUMBPRINT_MEMBERS = {'RSA': ('e', 'kty', 'n'), 'OKP': ('crv', 'kty', 'x')}
+
+    def __init__(self, private_key, public_key):
+        from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+        if isinstance(public_key, rsa.RSAPublicKey):
+            self.algorithm = 'RS256'
+            jwk = jwt.algorithms.RSAAlgorithm.to_jwk(public_key, as_dict=True)
+        elif isinstance(public_key, ed25519.Ed25519PublicKey):
+            self.algorithm = 'EdDSA'
+            jwk = jwt.algorithms.OKPAlgorithm.to_jwk(public_key, as_dict=True)
+        else:
+            raise ValueError("Only RSA and Ed25519 keys are supported")
+        self.private_key = private_key
+        self.public_key = public_key
+        members = {name: jwk[name] for name in self.THUMBPRINT_MEMBERS[jwk['kty']]}
+        digest = hashlib.sha256(json.dumps(members, separators=(',', ':'), sort_keys=True).encode()).digest()
+        self.kid = _b64url(digest)
+        self.jwk = {**jwk, 'kid': self.kid, 'alg': self.algorithm, 'use': 'sig'}
+
+    @classmethod
+    def from_pem(cls, data):
+        from cryptography.hazmat.primitives import serialization
+
+        if b'PRIVATE KEY' in data:
+            private_key = serialization.load_pem_private_key(data, password=None)
+            return cls(private_key, private_key.public_key())
+        return cls(None, serialization.load_pem_public_key(data))
+
+
+class KeyRing:
+    """
+    กุญแจสำหรับลงชื่อ JWT จาก JWT_KEY_FILES: ไฟล์แรกคือกุญแจที่ใช้ลงชื่อ ไฟล์ที่เหลือคือกุญแจเก่า
+    ที่ยังใช้ตรวจ token ที่ออกไปแล้วได้ (ใส่แค่ public key ได้)
+    กุญแจถูก parse และเอกสาร JWKS ถูกสร้างครั้งเดียวเมื่อใช้ครั้งแรก เปลี่ยนกุญแจด้วยการ deploy ใหม่
+    ถ้าไม่ได้ตั้ง JWT_KEY_FILES จะใช้ ALGORITHM/SIGNING_KEY ของ SIMPLE_JWT ตามเดิม (active เป็น None)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._state = None
+
+    def _load(self):
+        keys = []
+        for path in settings.JWT_KEY_FILES:
+            with open(path, 'rb') as f:
+                keys.append(SigningKey.from_pem(f.read()))
+        if keys and keys[0].private_key is None:
+            raise ValueError(f"The active signing key {settings.JWT_KEY_FILES[0]} has no private key")
+        jwks = json.dumps({'keys': [key.jwk for key in keys]}, separators=(',', ':')).encode()
+        return {
+            'active': keys[0] if keys else None,
+            'keys': {key.kid: key for key in keys},
+            'jwks': jwks,
+            'etag': f'"{hashlib.sha256(jwks).hexdigest()[:32]}"',
+        }
+
+    @property
+    def state(self):
+        state = self._state
+        if state is None:
+            with self._lock:
+                if self._state is None:
+                    self._state = self._load()
+                state = self._state
+        return state
+
+    @property
+    def active(self):
+        return self.state['active']
+
+    def get(self, kid):
+        return self.state['keys'].get(kid)
+
+
+key_ring = KeyRing()
+
+
+class KeyRingTokenBackend(TokenBackend):
+    """
+    TokenBackend ที่ลงชื่อด้วยกุญแจ active ของ key ring พร้อม header kid
+    และตรวจด้วย public key ที่ parse ไว้แล้วตาม kid ของ token (ไม่ parse PEM ต่อ request)
+    token ที่ไม่มี kid (HS256 เดิม) ยอมรับเฉพาะเมื่อ JWT_ACCEPT_LEGACY_HS256=True ระหว่างการย้าย
+    """
+
+    def __init__(self, key_ring):
+        super().__init__(
+            api_settings.ALGORITHM,
+            api_settings.SIGNING_KEY,
+            api_settings.VERIFYING_KEY,
+            api_settings.AUDIENCE,
+            api_settings.ISSUER,
+            api_settings.JWK_URL,
+            api_settings.LEEWAY,
+            api_settings.JSON_ENCODER,
+        )
+        self.key_ring = key_ring
+
+    def encode(self, payload):
+        key = self.key_ring.active
+        if key is None:
+            return super().encode(payload)
+        payload = payload.copy()
+        if self.audience is not None:
+            payload['aud'] = self.audience
+        if self.issuer is not None:
+            payload['iss'] = self.issuer
+        return jwt.encode(
+            payload, key.private_key, algorithm=key.algorithm, headers={'kid': key.kid}, json_encoder=self.json_encoder,
+        )
+
+    def decode(self, token, verify=True):
+        if self.key_ring.active is None:
+            return super().decode(token, verify)
+        try:
+            header = jwt.get_unverified_header(token)
+        except InvalidTokenError as e:
+            raise TokenBackendError(_("Token is invalid")) from e
+        key = self.key_ring.get(header.get('kid'))
+        if key is None:
+            if 'kid' not in header and settings.JWT_ACCEPT_LEGACY_HS256:
+                return super().decode(token, verify)
+            raise TokenBackendError(_("Token is invalid"))
+
+        try:
+            return jwt.decode(
+                token,
+                key.public_key,
+                algorithms=[key.algorithm],
+                audience=self.audience,
+                issuer=self.issuer,
+                leeway=self.get_leeway(),
+                options={'verify_aud': self.audience is not None, 'verify_signature': verify},
+            )
+        except InvalidAlgorithmError as e:
+            raise TokenBackendError(_("Invalid algorithm specified")) from e
+        except ExpiredSignatureError as e:
+            raise TokenBackendExpiredToken(_("Token is expired")) from e
+        except InvalidTokenError as e:
+            raise TokenBackendError(_("Token is invalid")) from e
+
+
+token_backend = KeyRingTokenBackend(key_ring)
+
+
+def jwks_view(request):
+    """
+    JSON Web Key Set ของกุญแจทั้งหมดใน key ring ให้บริการอื่นตรวจ token เองได้โดยไม่ต้องเรียก API นี้
+    ตอบจากเอกสารที่สร้างไว้แล้ว พร้อม ETag และ Cache-Control
+    """
+    state = key_ring.state
+    response = get_conditional_response(request, etag=state['etag'])
+    if response is None:
+        response = HttpResponse(state['jwks'], content_type='application/json')
+    response['ETag'] = state['etag']
+    patch_cache_control(response, public=True, max_age=settings.JWKS_MAX_AGE)
+    return response
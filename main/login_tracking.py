@@ -0,0 +1,132 @@
+# main/login_tracking.py
+
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, close_old_connections
+from django.utils import timezone
+
+from .models import LoginMethod
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_key(user_id):
+    return f'login-methods:{user_id}'
+
+
+def known_login_methods(user_id):
+    """
+    ชุด (login_type, identifier) ของผู้ใช้ อ่านจาก cache ก่อน ถ้าไม่มีจึง query และเก็บลง cache
+    """
+    known = cache.get(_cache_key(user_id))
+    if known is None:
+        known = set(LoginMethod.objects.filter(user_id=user_id).values_list('login_type', 'identifier'))
+        cache.set(_cache_key(user_id), known, settings.LOGIN_METHOD_CACHE_TIMEOUT)
+    return known
+
+
+def forget_login_methods(user_id):
+    cache.delete(_cache_key(user_id))
+
+
+def record_login_method(user, login_type, identifier):
+    """
+    บันทึกวิธีการ login ที่ใช้สำเร็จ โดยเขียนลงฐานข้อมูลเฉพาะเมื่อมีการเปลี่ยนแปลง
+    LOGIN_METHOD_RECORDING='deferred' จะส่งเข้าคิวและบันทึกเป็นชุดพร้อมเวลาที่ใช้ล่าสุด
+    หาก identifier เป็นของผู้ใช้อื่นจะ raise IntegrityError (เฉพาะโหมด sync)
+    """
+    if settings.LOGIN_METHOD_RECORDING == 'deferred':
+        get_recorder().add(user.pk, login_type, identifier)
+        return
+    known = known_login_methods(user.pk)
+    if (login_type, identifier) in known:
+        return
+    LoginMethod.objects.update_or_create(
+        user_id=user.pk,
+        login_type=login_type,
+        defaults={'identifier': identifier},
+    )
+    # post_save ล้าง cache ไปแล้ว เก็บชุดที่อัปเดตแล้วกลับเข้าไปเพื่อไม่ต้อง query ใน login ครั้งถัดไป
+    known = {(known_type, value) for known_type, value in known if known_type != login_type}
+    known.add((login_type, identifier))
+    cache.set(_cache_key(user.pk), known, settings.LOGIN_METHOD_CACHE_TIMEOUT)
+
+
+class LoginMethodRecorder:
+    """
+    รวบรวมการใช้งาน LoginMethod ไว้ในหน่วยความจำแล้วบันทึกเป็นชุดจาก background thread
+    รายการซ้ำของผู้ใช้และ login_type เดียวกันจะถูกรวมเป็นรายการเดียว
+    """
+
+    def __init__(self, interval, batch_size, start=True):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        if start:
+            threading.Thread(target=self._run, name='login-method-recorder', daemon=True).start()
+            atexit.register(self.flush)
+
+    def add(self, user_id, login_type, identifier):
+        with self._lock:
+            self._pending[(user_id, login_type)] = (identifier, timezone.now())
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        existing = {
+            (method.user_id, method.login_type): method
+            for method in LoginMethod.objects.filter(user_id__in={user_id for user_id, _ in pending})
+        }
+        touched = []
+        for (user_id, login_type), (identifier, used_at) in pending.items():
+            method = existing.get((user_id, login_type))
+            if method is not None and method.identifier == identifier:
+                method.last_used = used_at
+                touched.append(method)
+                continue
+            try:
+                LoginMethod.objects.update_or_create(
+                    user_id=user_id,
+                    login_type=login_type,
+                    defaults={'identifier': identifier, 'last_used': used_at},
+                )
+            except IntegrityError:
+                logger.warning(f"Identifier '{identifier}' is already associated with another user; skipped for user {user_id}.")
+        LoginMethod.objects.bulk_update(touched, ['last_used'], batch_size=self.batch_size)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to record login methods")
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = LoginMethodRecorder(
+                    interval=settings.LOGIN_METHOD_FLUSH_INTERVAL,
+                    batch_size=settings.LOGIN_METHOD_FLUSH_BATCH_SIZE,
+                )
+    return _recorder
@@ -0,0 +1,577 @@
+# main/management/commands/benchmark.py
+
+import asyncio
+import http.client
+import itertools
+import json
+import platform
+import subprocess
+import threading
+import time
+import tracemalloc
+import uuid
+from base64 import b64encode
+from collections import namedtuple
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from unittest import mock
+from urllib.parse import quote, urlencode
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import connection, connections
+from django.test import AsyncClient
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from main import views
+from main.instrumentation import registry
+from main.models import CustomUser, LoginMethod, Profile, RevokedToken, UserIdentifier
+from main.tokens import UserRefreshToken
+
+
+def _db_authentication(stack):
+    """
+    สลับ view ทั้งหมดกลับไปใช้ JWTAuthentication เดิม (query ผู้ใช้ทุก request) เพื่อเปรียบเทียบ
+    """
+    for name in dir(views):
+        view = getattr(views, name)
+        if isinstance(view, type) and hasattr(view, 'authentication_classes') and view.__module__ == views.__name__:
+            stack.enter_context(mock.patch.object(view, 'authentication_classes', [JWTAuthentication]))
+
+
+def seed_users(count, batch_size=5000):
+    """
+    สร้างผู้ใช้จำนวนมากด้วย bulk_create พร้อมแถวใน UserIdentifier index, Profile และ LoginMethod
+    (ข้อมูลเดียวกันทุกครั้ง เพื่อให้ผลของแต่ละ commit เทียบกันได้)
+    """
+    password = make_password('benchpassword')
+    for start in range(0, count, batch_size):
+        stop = min(start + batch_size, count)
+        users = CustomUser.objects.bulk_create([
+            CustomUser(email=f'seed{i}@example.com', national_id=f'{i:013d}', password=password)
+            for i in range(start, stop)
+        ])
+        UserIdentifier.objects.bulk_create([
+            UserIdentifier(user_id=user.pk, identifier=value)
+            for user in users for value in (user.email, user.national_id)
+        ])
+        Profile.objects.bulk_create([Profile(user_id=user.pk, bio=f'seed {user.pk}') for user in users])
+        LoginMethod.objects.bulk_create([
+            LoginMethod(user_id=user.pk, login_type=login_type, identifier=value)
+            for user in users
+            for login_type, value in ((LoginMethod.EMAIL, user.email), (LoginMethod.NATIONAL_ID, user.national_id))
+        ])
+
+
+def seed_revoked_tokens(count, batch_size=10000):
+    """
+    เติม denylist ด้วย jti ที่ยังไม่หมดอายุ เพื่อวัด refresh เมื่อมี token ค้างอยู่จำนวนมาก
+    """
+    expires_at = timezone.now() + timedelta(days=1)
+    for start in range(0, count, batch_size):
+        RevokedToken.objects.bulk_create([
+            RevokedToken(jti=uuid.uuid4().hex, expires_at=expires_at) for _ in range(start, min(start + batch_size, count))
+        ])
+
+
+def scenario_profile(client, user, options):
+    token = UserRefreshToken.for_user(user).access_token
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+    return lambda: client.get('/api/profile/')
+
+
+def scenario_user_list(client, user, options):
+    admin = CustomUser.objects.filter(is_staff=True).first() or CustomUser.objects.create_superuser(
+        email='bench-admin@example.com', password='benchpassword'
+    )
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(admin).access_token}')
+    # หน้ากลางตารางผ่าน cursor ของหน้าแรก เพื่อให้เห็นว่าไม่ขึ้นกับตำแหน่ง
+    middle = CustomUser.objects.order_by('id').values_list('id', flat=True)[max(options['users'] // 2, 0):][:1]
+    cursor = f'?cursor={encode_cursor(middle[0])}' if middle else ''
+    return lambda: client.get(f'/api/users/{cursor}')
+
+
+def scenario_user_export(client, user, options):
+    admin = CustomUser.objects.filter(is_staff=True).first() or CustomUser.objects.create_superuser(
+        email='bench-admin@example.com', password='benchpassword'
+    )
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(admin).access_token}')
+
+    def send():
+        response = client.get('/api/users/export/?output=ndjson')
+        for _ in getattr(response, 'streaming_content', ()):  # HTTPClient อ่าน body มาครบแล้ว
+            pass
+        return response
+
+    return send
+
+
+def scenario_user_lookup(client, user, options):
+    # ผู้ใช้ 100 คนใน request เดียว (แทนการเรียก /api/users/{id}/ ทีละคน)
+    admin = CustomUser.objects.filter(is_staff=True).first() or CustomUser.objects.create_superuser(
+        email='bench-admin@example.com', password='benchpassword'
+    )
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(admin).access_token}')
+    users = list(CustomUser.objects.order_by('-id').values_list('id', 'email')[:100])
+    data = {'ids': [pk for pk, _ in users[::2]], 'identifiers': [email for _, email in users[1::2]]}
+    return lambda: client.post('/api/users/lookup/?expand=profile', data, format='json')
+
+
+def scenario_login(client, user, options):
+    data = {'email': user.email, 'password': 'benchpassword'}
+    return lambda: client.post('/api/token/', data, format='json')
+
+
+def scenario_stuffing(client, user, options):
+    # credential stuffing: identifier ที่ไม่มีในระบบเกือบทั้งหมด
+    sequence = itertools.count()
+    prefix = f'{threading.get_ident()}-{time.monotonic_ns()}'
+
+    def send():
+        email = f'stuffing-{prefix}-{next(sequence)}@example.com'
+        return client.post('/api/token/', {'email': email, 'password': 'guess'}, format='json')
+
+    return send
+
+
+scenario_stuffing.expected_status = 400
+
+
+def scenario_refresh(client, user, options):
+    # แต่ละ worker ใช้ refresh token ล่าสุดที่ได้รับ (token เดิมถูกเพิกถอนทุกครั้ง)
+    state = {'refresh': str(UserRefreshToken.for_user(user))}
+
+    def send():
+        response = client.post('/api/token/refresh/', {'refresh': state['refresh']}, format='json')
+        if response.status_code != 200:
+            raise RuntimeError(f"refresh failed with {response.status_code}")
+        state['refresh'] = json.loads(response.content)['refresh']
+        return response
+
+    return send
+
+
+def scenario_register(client, user, options):
+    sequence = itertools.count()
+    prefix = f'{threading.get_ident()}-{time.monotonic_ns()}'
+
+    def send():
+        email = f'register-{prefix}-{next(sequence)}@example.com'
+        return client.post('/api/users/', {'email': email, 'password': 'benchpassword'}, format='json')
+
+    return send
+
+
+def scenario_identifier_lookup(client, user, options):
+    count = max(options['users'], 1)
+    state = {'i': 0}
+
+    def send():
+        state['i'] = (state['i'] * 7919 + 1) % count
+        UserIdentifier.objects.resolve(f'{state["i"]:013d}')
+
+    return send
+
+
+def scenario_import(client, user, options):
+    # นำเข้าผู้ใช้ใหม่ --import-rows แถวต่อ request ผ่าน /api/users/import/ (UserImporter)
+    admin = CustomUser.objects.filter(is_staff=True).first() or CustomUser.objects.create_superuser(
+        email='bench-admin@example.com', password='benchpassword'
+    )
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(admin).access_token}')
+    sequence = itertools.count()
+    prefix = f'{threading.get_ident()}-{time.monotonic_ns()}'
+
+    def send():
+        batch = next(sequence)
+        lines = ['email,national_id,password'] + [
+            f'import-{prefix}-{batch}-{i}@example.com,,benchpassword' for i in range(options['import_rows'])
+        ]
+        upload = SimpleUploadedFile('users.csv', '\n'.join(lines).encode(), content_type='text/csv')
+        response = client.post('/api/users/import/', {'file': upload}, format='multipart')
+        if response.status_code == 200 and response.data['errors']:
+            raise RuntimeError(f"import rejected {len(response.data['errors'])} row(s)")
+        return response
+
+    return send
+
+
+scenario_import.rows_option = 'import_rows'
+
+
+def async_scenario_profile(client, user, options):
+    headers = {'authorization': f'Bearer {UserRefreshToken.for_user(user).access_token}'}
+    return lambda: client.get('/api/async/profile/', headers=headers)
+
+
+def async_scenario_login(client, user, options):
+    data = {'email': user.email, 'password': 'benchpassword'}
+    return lambda: client.post('/api/async/token/', data, content_type='application/json')
+
+
+def async_scenario_login_methods(client, user, options):
+    headers = {'authorization': f'Bearer {UserRefreshToken.for_user(user).access_token}'}
+    return lambda: client.get('/api/async/login/', headers=headers)
+
+
+def scenario_login_methods(client, user, options):
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(user).access_token}')
+    return lambda: client.get('/api/login/')
+
+
+HTTPResponse = namedtuple('HTTPResponse', ['status_code', 'content'])
+
+
+class HTTPClient:
+    """
+    client ที่มี interface เดียวกับ APIClient (credentials/get/post) สำหรับ scenario เดิม
+    แต่ส่ง request ผ่าน HTTP จริง (keep-alive ต่อ worker) ไปยัง server ของ --interface http
+    """
+
+    def __init__(self, address):
+        self.connection = http.client.HTTPConnection(*address, timeout=60)
+        self.headers = {}
+
+    def credentials(self, **kwargs):
+        self.headers = {name[5:].replace('_', '-').title(): value for name, value in kwargs.items()}
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, data=None, format='json'):
+        return self.request('POST', path, json.dumps(data or {}), {'Content-Type': 'application/json'})
+
+    def request(self, method, path, body=None, headers=None):
+        self.connection.request(method, path, body, {**self.headers, **(headers or {})})
+        response = self.connection.getresponse()
+        return HTTPResponse(response.status, response.read())
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    disable_nagle_algorithm = True  # ส่ง header และ body ทันที ไม่รอ delayed ACK ของ client
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BenchmarkServer:
+    """
+    WSGI server แบบ thread ต่อ connection (ตัวเดียวกับ runserver) บนพอร์ตว่างของ 127.0.0.1
+    รันใน thread ของ process นี้ จึงใช้ฐานข้อมูลทดสอบเดียวกับ scenario
+    """
+
+    def __init__(self):
+        self.server = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler, allow_reuse_address=False)
+        self.server.set_app(WSGIHandler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def percentile(fraction):
+        return round(latencies[min(int(count * fraction), count - 1)] * 1000, 3)
+
+    return {
+        'requests': count,
+        'errors': len(errors),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(count / elapsed, 1),
+        'latency_ms': {
+            'mean': round(sum(latencies) / count * 1000, 3),
+            'min': percentile(0),
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': percentile(1),
+        },
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True, cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def concurrency_levels(value):
+    try:
+        levels = [int(level) for level in value.split(',')]
+    except ValueError:
+        raise CommandError(f"Invalid concurrency levels: {value}")
+    if not levels or min(levels) < 1:
+        raise CommandError(f"Invalid concurrency levels: {value}")
+    return levels
+
+
+def encode_cursor(position):
+    return quote(b64encode(urlencode({'p': position}).encode('ascii')).decode('ascii'))
+
+
+SCENARIOS = {
+    'profile': scenario_profile,
+    'login': scenario_login,
+    'identifier_lookup': scenario_identifier_lookup,
+    'user_list': scenario_user_list,
+    'user_export': scenario_user_export,
+    'user_lookup': scenario_user_lookup,
+    'login_methods': scenario_login_methods,
+    'register': scenario_register,
+    'stuffing': scenario_stuffing,
+    'refresh': scenario_refresh,
+    'import': scenario_import,
+}
+
+# scenario ที่ส่งผ่าน HTTP ได้ (identifier_lookup เรียก ORM โดยตรง ไม่มี endpoint และ HTTPClient ส่ง multipart ไม่ได้)
+HTTP_SCENARIOS = {name: factory for name, factory in SCENARIOS.items() if name not in ('identifier_lookup', 'import')}
+
+# scenario ที่มี view แบบ async (main/async_views.py) สำหรับ --interface asgi
+ASYNC_SCENARIOS = {
+    'profile': async_scenario_profile,
+    'login': async_scenario_login,
+    'login_methods': async_scenario_login_methods,
+}
+
+
+class Command(BaseCommand):
+    help = ("วัด throughput และ latency ของ API endpoint (in-process หรือผ่าน HTTP server ในเครื่อง) "
+            "บนฐานข้อมูลทดสอบแยกต่างหาก และบันทึกผลเป็น JSON เพื่อเทียบระหว่าง commit")
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', help=f"scenario ที่จะรัน ({', '.join(SCENARIOS)})")
+        parser.add_argument('--requests', type=int, default=500, help="จำนวน request ต่อ scenario")
+        parser.add_argument('--concurrency', type=concurrency_levels, default=[1],
+                            help="จำนวน thread (หรือ coroutine) ที่ส่ง request พร้อมกัน คั่นด้วย , เพื่อวัดหลายระดับ เช่น 1,8,32")
+        parser.add_argument('--interface', choices=['wsgi', 'asgi', 'http'], default='wsgi',
+                            help="wsgi: sync view ผ่าน thread pool, asgi: async view ผ่าน ASGIHandler บน event loop เดียว, "
+                                 "http: sync view ผ่าน WSGI server จริงบน 127.0.0.1")
+        parser.add_argument('--login-recording', choices=['sync', 'deferred'], default=settings.LOGIN_METHOD_RECORDING,
+                            help="โหมดการบันทึก LoginMethod ตอน login")
+        parser.add_argument('--trace-memory', action='store_true', help="วัดหน่วยความจำสูงสุดระหว่างรัน (ช้าลง)")
+        parser.add_argument('--users', type=int, default=0, help="จำนวนผู้ใช้ (พร้อม Profile และ LoginMethod) ที่ seed ก่อนวัดผล")
+        parser.add_argument('--revoked', type=int, default=0, help="จำนวน refresh token ใน denylist ที่ seed ก่อนวัดผล")
+        parser.add_argument('--import-rows', type=int, default=1000,
+                            help="จำนวนแถวต่อ request ของ scenario import (เช่น --import-rows 100000 --requests 1)")
+        parser.add_argument('--queries', action='store_true',
+                            help="นับ query ต่อ request ผ่าน InstrumentationMiddleware (ช้าลงเล็กน้อย)")
+        parser.add_argument('--login-throttle', action='store_true',
+                            help="เปิด LoginThrottle (ปิดไว้โดยปริยาย เพราะ request จากเครื่องเดียวจะถูกจำกัดเร็ว)")
+        parser.add_argument('--output', help="ไฟล์ JSON สำหรับบันทึกผล")
+        parser.add_argument('--compare', help="ไฟล์ JSON ผลครั้งก่อน แสดงการเปลี่ยนแปลงของ throughput และ p99")
+        parser.add_argument('--auth', choices=['token', 'db'], default='token',
+                            help="token: TokenUserAuthentication, db: JWTAuthentication เดิม")
+        parser.add_argument('--test-db', help="ไฟล์ฐานข้อมูลทดสอบของ SQLite (ค่าเริ่มต้นอยู่ในหน่วยความจำ) "
+                                                  "ใช้เทียบ DB_PROFILE=sqlite กับ sqlite-wal")
+        parser.add_argument('--hash-profile', choices=sorted(settings.PASSWORD_HASH_PROFILES),
+                            default=settings.PASSWORD_HASH_PROFILE, help="โปรไฟล์ cost ของ password hasher")
+
+    def handle(self, *args, **options):
+        available = {'wsgi': SCENARIOS, 'asgi': ASYNC_SCENARIOS, 'http': HTTP_SCENARIOS}[options['interface']]
+        names = options['scenarios'] or list(available)
+        unknown = set(names) - set(available)
+        if unknown:
+            raise CommandError(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+
+        baseline = self._load(options['compare']) if options['compare'] else None
+
+        setup_test_environment()
+        if options['test_db']:
+            connection.settings_dict['TEST']['NAME'] = options['test_db']
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        results = []
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(override_settings(
+                    PASSWORD_HASH_PROFILE=options['hash_profile'],
+                    LOGIN_METHOD_RECORDING=options['login_recording'],
+                    LOGIN_THROTTLE_ENABLED=options['login_throttle'],
+                    INSTRUMENTATION_ENABLED=options['queries'],
+                ))
+                if options['auth'] == 'db':
+                    _db_authentication(stack)
+                if options['interface'] == 'http':
+                    options['address'] = stack.enter_context(BenchmarkServer()).address
+                seed_users(options['users'])
+                seed_revoked_tokens(options['revoked'])
+                for name in names:
+                    results += self._run(name, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if baseline is not None:
+            self._compare(baseline, results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'meta': self._meta(options), 'results': results}, f, indent=2)
+                f.write('\n')
+
+    def _meta(self, options):
+        return {
+            'revision': git_revision(),
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'db_profile': settings.DB_PROFILE,
+            'hash_profile': options['hash_profile'],
+            'auth': options['auth'],
+            'login_recording': options['login_recording'],
+            'login_throttle': options['login_throttle'],
+            'identifier_filter': settings.IDENTIFIER_FILTER_ENABLED,
+            'users': options['users'],
+            'revoked': options['revoked'],
+            'import_rows': options['import_rows'],
+            'requests': options['requests'],
+        }
+
+    def _load(self, path):
+        try:
+            with open(path) as f:
+                return {(row['scenario'], row['interface'], row['concurrency']): row for row in json.load(f)['results']}
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f"Cannot read benchmark results from {path}: {e}")
+
+    def _compare(self, baseline, results):
+        self.stdout.write(f"\ncompared with {len(baseline)} previous result(s):")
+        for row in results:
+            previous = baseline.get((row['scenario'], row['interface'], row['concurrency']))
+            if previous is None:
+                continue
+            change = (row['throughput_rps'] / previous['throughput_rps'] - 1) * 100 if previous['throughput_rps'] else 0.0
+            self.stdout.write(
+                f"{row['scenario']:<20} {row['interface']:<4} c={row['concurrency']:<3} "
+                f"{previous['throughput_rps']:10.1f} -> {row['throughput_rps']:10.1f} req/s ({change:+6.1f}%)  "
+                f"p99 {previous['latency_ms']['p99']:8.3f} -> {row['latency_ms']['p99']:8.3f} ms"
+            )
+
+    def _run(self, name, options):
+        user = CustomUser.objects.create_user(email=f'bench-{name}@example.com', password='benchpassword')
+        measure = {'wsgi': self._measure_wsgi, 'asgi': self._measure_asgi, 'http': self._measure_http}[options['interface']]
+
+        results = []
+        for concurrency in options['concurrency']:
+            if options['trace_memory']:
+                tracemalloc.start()
+            latencies, errors, elapsed = measure(name, user, options, concurrency)
+            row = {'scenario': name, 'interface': options['interface'], 'concurrency': concurrency,
+                   **summarize(latencies, errors, elapsed)}
+            rows = ''
+            rows_option = getattr(SCENARIOS.get(name), 'rows_option', None)
+            if rows_option is not None:
+                row['rows_per_s'] = round(len(latencies) * options[rows_option] / elapsed, 1)
+                rows = f"  rows/s={row['rows_per_s']:10.1f}"
+            queries = ''
+            if options['queries']:
+                row['queries_per_request'] = round(registry.total('db_queries_total') / max(row['requests'], 1), 2)
+                queries = f"  queries/req={row['queries_per_request']:6.2f}"
+            memory = ''
+            if options['trace_memory']:
+                row['peak_kib'] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+                memory = f"  peak={row['peak_kib']:10.1f} KiB"
+                tracemalloc.stop()
+
+            latency = row['latency_ms']
+            self.stdout.write(f"{name:<20} {options['interface']:<4} db={settings.DB_PROFILE:<17} auth={options['auth']:<6} hash={options['hash_profile']:<10} "
+                              f"c={concurrency:<3} {row['throughput_rps']:10.1f} req/s  p50={latency['p50']:8.3f} ms  "
+                              f"p99={latency['p99']:8.3f} ms  errors={row['errors']}{rows}{queries}{memory}")
+            results.append(row)
+        return results
+
+    def _measure_http(self, name, user, options, concurrency):
+        address = options['address']
+        return self._measure_threads(name, user, options, concurrency, HTTP_SCENARIOS[name], lambda: HTTPClient(address))
+
+    def _measure_wsgi(self, name, user, options, concurrency):
+        return self._measure_threads(name, user, options, concurrency, SCENARIOS[name], APIClient)
+
+    def _measure_threads(self, name, user, options, concurrency, factory, make_client):
+        response = factory(make_client(), user, options)()
+        if response is not None and response.status_code >= 400 and response.status_code != getattr(factory, 'expected_status', None):
+            raise CommandError(f"{name}: warm-up request failed with {response.status_code}")
+        registry.reset()
+
+        per_worker = max(options['requests'] // concurrency, 1)
+        latencies, errors = [], []
+
+        def worker():
+            send = factory(make_client(), user, options)
+            local = []
+            try:
+                for _ in range(per_worker):
+                    started = time.perf_counter()
+                    try:
+                        response = send()
+                    except Exception as e:
+                        errors.append(type(e).__name__)
+                        continue
+                    finally:
+                        local.append(time.perf_counter() - started)
+                    if response is not None and response.status_code >= 500:
+                        errors.append(response.status_code)
+            finally:
+                latencies.extend(local)
+                connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(worker) for _ in range(concurrency)]:
+                future.result()
+        return latencies, errors, time.perf_counter() - start
+
+    def _measure_asgi(self, name, user, options, concurrency):
+        factory = ASYNC_SCENARIOS[name]
+        per_worker = max(options['requests'] // concurrency, 1)
+        latencies, errors = [], []
+
+        async def worker():
+            send = factory(AsyncClient(), user, options)
+            for _ in range(per_worker):
+                started = time.perf_counter()
+                try:
+                    response = await send()
+                except Exception as e:
+                    errors.append(type(e).__name__)
+                    continue
+                finally:
+                    latencies.append(time.perf_counter() - started)
+                if response.status_code >= 500:
+                    errors.append(response.status_code)
+
+        async def run():
+            response = await factory(AsyncClient(), user, options)()
+            if response.status_code >= 400:
+                raise CommandError(f"{name}: warm-up request failed with {response.status_code}")
+            latencies.clear()
+            registry.reset()
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return time.perf_counter() - start
+
+        elapsed = asyncio.run(run())
+        return latencies, errors, elapsed
@@ -0,0 +1,89 @@
+# main/management/commands/benchmark_avatars.py
+
+import io
+import json
+import platform
+import time
+
+import PIL
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from PIL import Image
+
+from main.avatars import _FORMATS, render_variant
+from main.management.commands.benchmark import git_revision
+
+
+def synthetic_image(size):
+    """
+    สร้างภาพทดสอบขนาด size x size ที่ได้ผลเหมือนเดิมทุกครั้ง (gradient + mandelbrot ไม่มีค่าสุ่ม)
+    เพื่อให้ขนาดไฟล์และเวลา decode เทียบข้าม commit ได้
+    """
+    extent = (-2.0, -1.25, 0.75, 1.25)
+    bands = (
+        Image.linear_gradient('L').resize((size, size)),
+        Image.effect_mandelbrot((size, size), extent, 64),
+        Image.radial_gradient('L').resize((size, size)),
+    )
+    return Image.merge('RGB', bands)
+
+
+def decode_ms(data, repeat):
+    """เวลาเฉลี่ย (ms) ในการ decode bytes ของภาพจนได้ pixel ครบ"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+class Command(BaseCommand):
+    help = "วัดขนาดไฟล์และเวลา decode ของภาพย่อ avatar แต่ละขนาดเทียบกับภาพต้นฉบับ จากภาพสังเคราะห์ที่คงที่"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=2048, help="ความกว้าง/สูงของภาพต้นฉบับ (pixels)")
+        parser.add_argument('--formats', default=','.join(_FORMATS),
+                            help=f"format ของภาพย่อ คั่นด้วย , ({', '.join(_FORMATS)})")
+        parser.add_argument('--repeat', type=int, default=20, help="จำนวนรอบ decode ต่อภาพ")
+        parser.add_argument('--output', help="ไฟล์ JSON สำหรับบันทึกผล")
+
+    def handle(self, *args, **options):
+        formats = options['formats'].split(',')
+        unknown = [fmt for fmt in formats if fmt not in _FORMATS]
+        if unknown:
+            raise CommandError(f"Unknown format(s): {', '.join(unknown)}")
+        image = synthetic_image(options['size'])
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=90)
+        original = buffer.getvalue()
+        original_ms = decode_ms(original, options['repeat'])
+
+        results = [{'format': 'JPEG', 'size': options['size'], 'original': True, 'bytes': len(original),
+                    'decode_ms': round(original_ms, 3)}]
+        self.stdout.write(f"{'original JPEG':<14} {options['size']:>5}px  {len(original):>9} bytes  "
+                          f"decode={original_ms:8.3f} ms")
+        for fmt in formats:
+            for size in settings.AVATAR_VARIANT_SIZES:
+                started = time.perf_counter()
+                data = render_variant(image, size, fmt)
+                render_ms = (time.perf_counter() - started) * 1000
+                variant_ms = decode_ms(data, options['repeat'])
+                results.append({'format': fmt, 'size': size, 'original': False, 'bytes': len(data),
+                                'render_ms': round(render_ms, 3), 'decode_ms': round(variant_ms, 3)})
+                self.stdout.write(f"{fmt:<14} {size:>5}px  {len(data):>9} bytes ({len(data) / len(original):6.1%})  "
+                                  f"decode={variant_ms:8.3f} ms ({variant_ms / original_ms:6.1%})  "
+                                  f"render={render_ms:8.3f} ms")
+
+        if options['output']:
+            meta = {
+                'revision': git_revision(),
+                'timestamp': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'pillow': PIL.__version__,
+                'size': options['size'],
+                'repeat': options['repeat'],
+            }
+            with open(options['output'], 'w') as f:
+                json.dump({'meta': meta, 'results': results}, f, indent=2)
+                f.write('\n')
@@ -0,0 +1,15 @@
+# main/management/commands/collect_avatars.py
+
+from django.core.management.base import BaseCommand
+
+from main.models import StoredFile
+from main.storage import collect_files
+
+
+class Command(BaseCommand):
+    help = "ลบไฟล์ avatar และภาพย่อที่ไม่มี Profile ใดอ้างอิงแล้ว (เช่นค้างจาก worker ที่หยุดกลางคัน)"
+
+    def handle(self, *args, **options):
+        names = list(StoredFile.objects.filter(ref_count__lte=0).values_list('name', flat=True))
+        removed = collect_files(names)
+        self.stdout.write(f"Removed {len(removed)} orphaned file(s)")
@@ -0,0 +1,31 @@
+# main/management/commands/export_users.py
+
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.exporters import EXPORT_FIELDS, EXPORT_FORMATS, parse_export_fields, render_export
+
+
+class Command(BaseCommand):
+    help = "ส่งออกผู้ใช้พร้อม Profile และ LoginMethod เป็น NDJSON หรือ CSV แบบ streaming"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+        parser.add_argument('--fields', help=f"ฟิลด์ที่ต้องการ คั่นด้วย comma ({', '.join(EXPORT_FIELDS)})")
+        parser.add_argument('--output', default='-', help="ไฟล์ปลายทาง หรือ '-' สำหรับ stdout")
+        parser.add_argument('--chunk-size', type=int, default=settings.USER_EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            fields = parse_export_fields(options['fields'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        chunks = render_export(options['format'], fields, chunk_size=options['chunk_size'])
+        if options['output'] == '-':
+            sys.stdout.writelines(chunks)
+            return
+        with open(options['output'], 'w', encoding='utf-8', newline='') as stream:
+            stream.writelines(chunks)
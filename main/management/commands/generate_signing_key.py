@@ -0,0 +1,35 @@
+# main/management/commands/generate_signing_key.py
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.keyring import SigningKey
+
+
+class Command(BaseCommand):
+    help = "สร้าง private key สำหรับลงชื่อ JWT (ใช้กับ JWT_KEY_FILES) และแสดง kid ของกุญแจ"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="ไฟล์ PEM ที่จะเขียน (ต้องยังไม่มีอยู่)")
+        parser.add_argument('--algorithm', choices=['RS256', 'EdDSA'], default='EdDSA')
+        parser.add_argument('--rsa-bits', type=int, default=3072)
+
+    def handle(self, *args, **options):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+        if options['algorithm'] == 'RS256':
+            private_key = rsa.generate_private_key(public_exponent=65537, key_size=options['rsa_bits'])
+        else:
+            private_key = ed25519.Ed25519PrivateKey.generate()
+        pem = private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+        )
+        try:
+            fd = os.open(options['path'], os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            raise CommandError(f"{options['path']} already exists")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pem)
+        self.stdout.write(f"Wrote {options['algorithm']} key {SigningKey.from_pem(pem).kid} to {options['path']}")
@@ -0,0 +1,42 @@
+# main/management/commands/import_users.py
+
+import json
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.hashers import BoundedHashExecutor
+from main.importers import IMPORT_FORMATS, UserImporter, iter_rows
+
+
+class Command(BaseCommand):
+    help = "นำเข้าผู้ใช้จำนวนมากจากไฟล์ CSV หรือ JSON Lines (ใช้ '-' เพื่ออ่านจาก stdin)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="ไฟล์ที่จะนำเข้า หรือ '-' สำหรับ stdin")
+        parser.add_argument('--format', choices=IMPORT_FORMATS, help="รูปแบบไฟล์ (เดาจากนามสกุลหากไม่ระบุ)")
+        parser.add_argument('--chunk-size', type=int, default=settings.USER_IMPORT_CHUNK_SIZE)
+        parser.add_argument('--workers', type=int, default=settings.PASSWORD_HASH_WORKERS,
+                            help="จำนวน thread สำหรับ hash รหัสผ่าน")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        if path == '-' and not options['format']:
+            raise CommandError("--format is required when reading from stdin.")
+
+        executor = BoundedHashExecutor(options['workers'], settings.PASSWORD_HASH_QUEUE_SIZE)
+        importer = UserImporter(chunk_size=options['chunk_size'], executor=executor)
+        if path == '-':
+            result = importer.run(iter_rows(sys.stdin.buffer, fmt))
+        else:
+            try:
+                with open(path, 'rb') as stream:
+                    result = importer.run(iter_rows(stream, fmt))
+            except FileNotFoundError:
+                raise CommandError(f"File not found: {path}")
+
+        for error in result.errors:
+            self.stderr.write(json.dumps(error, ensure_ascii=False))
+        self.stdout.write(self.style.SUCCESS(f"Imported {result.created} user(s), {len(result.errors)} row(s) failed."))
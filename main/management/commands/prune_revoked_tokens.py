@@ -0,0 +1,16 @@
+# main/management/commands/prune_revoked_tokens.py
+
+from django.core.management.base import BaseCommand
+
+from main.models import RevokedToken
+
+
+class Command(BaseCommand):
+    help = "ลบ refresh token ที่หมดอายุแล้วออกจาก denylist (RevokedToken) ทีละ batch ควรรันเป็นงานตามเวลา เช่น cron รายชั่วโมง"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help="จำนวนแถวที่ลบต่อหนึ่งคำสั่ง DELETE")
+
+    def handle(self, *args, **options):
+        deleted = RevokedToken.objects.prune(batch_size=options['batch_size'])
+        self.stdout.write(f"Removed {deleted} expired revoked token(s)")
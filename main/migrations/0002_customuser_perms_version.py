@@ -0,0 +1,18 @@
+# Generated by Django 4.2.14 on 2026-10-17 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='perms_version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='permissions version'),
+        ),
+    ]
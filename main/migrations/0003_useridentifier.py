@@ -0,0 +1,46 @@
+# Generated by Django 4.2.14 on 2026-10-17 17:23
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_identifiers(apps, schema_editor):
+    from main.models import canonical_identifier
+
+    CustomUser = apps.get_model('main', 'CustomUser')
+    LoginMethod = apps.get_model('main', 'LoginMethod')
+    UserIdentifier = apps.get_model('main', 'UserIdentifier')
+
+    rows = {}
+    for user_id, identifier in LoginMethod.objects.values_list('user_id', 'identifier').iterator():
+        rows.setdefault(canonical_identifier(identifier), user_id)
+    for user_id, *values in CustomUser.objects.values_list('id', 'email', 'national_id', 'phone_number').iterator():
+        for value in values:
+            if value:
+                rows.setdefault(canonical_identifier(value), user_id)
+    rows.pop('', None)
+
+    UserIdentifier.objects.bulk_create(
+        [UserIdentifier(identifier=identifier, user_id=user_id) for identifier, user_id in rows.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_customuser_perms_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserIdentifier',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identifier', models.CharField(max_length=255, unique=True, verbose_name='identifier')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='identifiers', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(backfill_identifiers, migrations.RunPython.noop),
+    ]
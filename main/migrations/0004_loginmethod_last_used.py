@@ -0,0 +1,18 @@
+# Generated by Django 4.2.14 on 2026-10-17 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_useridentifier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loginmethod',
+            name='last_used',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='last used'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.14 on 2026-10-17 17:49
+
+from django.db import migrations, models
+import main.storage
+
+
+def backfill_stored_files(apps, schema_editor):
+    Profile = apps.get_model('main', 'Profile')
+    StoredFile = apps.get_model('main', 'StoredFile')
+
+    counts = {}
+    for avatar, variants in Profile.objects.values_list('avatar', 'avatar_variants').iterator():
+        for name in [avatar, *(variants or {}).values()]:
+            if name:
+                counts[name] = counts.get(name, 0) + 1
+
+    StoredFile.objects.bulk_create(
+        [StoredFile(name=name, ref_count=count) for name, count in counts.items()],
+        batch_size=1000,
+    )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_profile_avatar_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='name')),
+                ('ref_count', models.IntegerField(default=0, verbose_name='reference count')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='avatar',
+            field=models.ImageField(blank=True, null=True, storage=main.storage.ContentAddressedStorage(), upload_to='avatars/'),
+        ),
+        migrations.RunPython(backfill_stored_files, migrations.RunPython.noop),
+    ]
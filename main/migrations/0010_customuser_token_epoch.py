@@ -0,0 +1,18 @@
+# Generated by Django 4.2.14 on 2026-10-17 18:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_revoked_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='token_epoch',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='token epoch'),
+        ),
+    ]
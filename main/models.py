@@ -1,17 +1,30 @@
 # main/models.py
 
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
 from django.utils import timezone
-from django.contrib.auth.hashers import make_password
+from django.contrib.auth.hashers import make_password, check_password
 from phonenumber_field.modelfields import PhoneNumberField
 from django.utils.translation import gettext_lazy as _
-from django.db.models import Q
 from django.core.validators import RegexValidator
+from .storage import avatar_storage
+from .identifier_filter import identifier_filter
 
 # custom validator for username
 alphanumeric = RegexValidator(r'^[0-9a-zA-Z]*$', 'Only alphanumeric characters are allowed.')
 
+def canonical_identifier(value):
+    """
+    Normalize a login identifier (email, national ID or phone number) for the identifier index.
+    """
+    value = str(value or '').strip()
+    if '@' in value:
+        return value.lower()
+    compact = ''.join(ch for ch in value if ch not in ' -().')
+    return compact.upper()
+
+
 class CustomUserManager(BaseUserManager):
     """
     Custom user manager for managing CustomUser model.
@@ -24,7 +37,9 @@ class CustomUserManager(BaseUserManager):
             email = self.normalize_email(email)
         user = self.model(email=email, national_id=national_id, phone_number=phone_number, **extra_fields)
         user.set_password(password)
-        user.save(using=self._db)
+        # index ของ identifier ถูกเพิ่มโดย signal ใน transaction เดียวกัน ถ้าชนกับผู้ใช้อื่นจะไม่เหลือผู้ใช้ที่ login ไม่ได้
+        with transaction.atomic(using=self._db):
+            user.save(using=self._db)
         return user
 
     def create_superuser(self, email, password=None, **extra_fields):
@@ -43,13 +58,48 @@ class CustomUserManager(BaseUserManager):
         """
         Retrieve a user by their username (email, national_id, or phone_number).
         """
-        return self.get(
-            Q(email=username) |
-            Q(national_id=username) |
-            Q(phone_number=username)
-        )
+        return self.get(identifiers__identifier=canonical_identifier(username))
+
+    def revoke_tokens(self, user_id):
+        """
+        Invalidate every token issued to the user so far ("log out everywhere") with a single row update.
+        Returns the new token epoch, or None if the user does not exist.
+        """
+        from .cache import token_epochs
+
+        with transaction.atomic():
+            if not self.filter(pk=user_id).update(token_epoch=F('token_epoch') + 1):
+                return None
+            epoch = self.filter(pk=user_id).values_list('token_epoch', flat=True).get()
+        token_epochs.set(user_id, epoch)
+        return epoch
+
+class VersionedModel(models.Model):
+    """
+    Abstract model keeping a row version and modification time for ETag / Last-Modified handling.
+    """
+    row_version = models.PositiveIntegerField(_("row version"), default=0, editable=False)
+    updated_at = models.DateTimeField(_("updated at"), auto_now=True)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        # Increment in the UPDATE itself so that concurrent saves never write the same version.
+        # The new value is left deferred and is read back only when something needs it.
+        if self._state.adding:
+            self.row_version += 1
+        else:
+            self.row_version = F('row_version') + 1
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'row_version', 'updated_at'}
+        super().save(*args, **kwargs)
+        if not isinstance(self.row_version, int):
+            del self.__dict__['row_version']
 
-class CustomUser(AbstractBaseUser, PermissionsMixin):
+
+class CustomUser(VersionedModel, AbstractBaseUser, PermissionsMixin):
     """
     Custom user model with email, national ID, or phone number as username.
     """
@@ -61,9 +111,27 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     is_active = models.BooleanField(_("active"), default=True)
     is_staff = models.BooleanField(_("staff status"), default=False)
     date_joined = models.DateTimeField(_("date joined"), default=timezone.now)
+    perms_version = models.PositiveIntegerField(_("permissions version"), default=0, editable=False)
+    # ทุก token ฝัง epoch ตอนออก token ไว้ เพิ่มค่านี้เพื่อยกเลิก token ทั้งหมดของผู้ใช้ (เปลี่ยนรหัสผ่าน, ปิดบัญชี)
+    token_epoch = models.PositiveIntegerField(_("token epoch"), default=0, editable=False)
 
     objects = CustomUserManager()
 
+    # ฟิลด์ที่ถูกฝังอยู่ใน access token หากเปลี่ยนต้องเพิ่ม perms_version เพื่อให้ token เก่าใช้ไม่ได้
+    TOKEN_CLAIM_FIELDS = ('is_active', 'is_staff', 'is_superuser')
+    # ฟิลด์ที่ถูกเก็บใน UserIdentifier index
+    IDENTIFIER_FIELDS = ('email', 'national_id', 'phone_number')
+    # ฟิลด์ที่จำค่าตอนโหลดไว้เพื่อตรวจการเปลี่ยนแปลงตอนบันทึก
+    TRACKED_FIELDS = (*TOKEN_CLAIM_FIELDS, *IDENTIFIER_FIELDS, 'token_epoch')
+
+    class Meta:
+        indexes = [
+            # รองรับ cursor pagination และตัวกรองของหน้ารายชื่อผู้ใช้
+            models.Index(fields=['date_joined', 'id'], name='user_date_joined_idx'),
+            models.Index(fields=['is_active', 'id'], name='user_is_active_idx'),
+            models.Index(fields=['is_staff', 'id'], name='user_is_staff_idx'),
+        ]
+
     USERNAME_FIELD = 'email'  # สามารถเปลี่ยนเป็น 'national_id' หรือ 'phone_number' ได้ตามต้องการ
     REQUIRED_FIELDS = []
 
@@ -80,13 +148,99 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
         else:
             return "Unknown User"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded = {}
+        instance._snapshot()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        # ฟิลด์ที่ถูก defer แล้วถูกอ่านภายหลังจะโหลดผ่าน method นี้ (เก็บค่าที่โหลดมาไว้เทียบตอนบันทึก)
+        super().refresh_from_db(using=using, fields=fields)
+        if hasattr(self, '_loaded'):
+            self._snapshot(fields)
+
+    def _tracked_value(self, name):
+        value = getattr(self, name)
+        if name in self.IDENTIFIER_FIELDS:
+            return str(value) if value else None
+        return value
+
+    def _snapshot(self, fields=None):
+        """
+        Remember the loaded values of the tracked fields; deferred fields are skipped so that
+        taking the snapshot never triggers a query.
+        """
+        deferred = self.get_deferred_fields()
+        names = self.TRACKED_FIELDS if fields is None else [name for name in fields if name in self.TRACKED_FIELDS]
+        self._loaded.update({name: self._tracked_value(name) for name in names if name not in deferred})
+
+    def _changed_fields(self, names):
+        """
+        Tracked fields among names that differ from their loaded values. Fields that are still deferred
+        are unchanged; a field assigned without having been loaded counts as changed.
+        """
+        loaded = getattr(self, '_loaded', None)
+        if loaded is None:
+            return list(names)
+        deferred = self.get_deferred_fields()
+        return [
+            name for name in names
+            if name not in deferred and (name not in loaded or loaded[name] != self._tracked_value(name))
+        ]
+
+    def identifiers_changed(self):
+        """
+        Whether email, national_id or phone_number differ from the values last loaded or saved.
+        """
+        return bool(self._changed_fields(self.IDENTIFIER_FIELDS))
+
+    def token_epoch_changed(self):
+        """
+        Whether token_epoch differs from the value last loaded or saved (issued tokens have been revoked).
+        """
+        return hasattr(self, '_loaded') and bool(self._changed_fields(('token_epoch',)))
+
+    def save(self, *args, **kwargs):
+        """
+        Bump perms_version whenever a field carried inside issued tokens changes,
+        and token_epoch when the account is activated or deactivated.
+        """
+        update_fields = kwargs.get('update_fields')
+        changed = self._changed_fields(self.TOKEN_CLAIM_FIELDS) if hasattr(self, '_loaded') else []
+        if changed:
+            self.perms_version += 1
+            if 'is_active' in changed:
+                self.token_epoch += 1
+            if update_fields is not None:
+                kwargs['update_fields'] = update_fields = {*update_fields, 'perms_version'}
+        if update_fields is not None and self.token_epoch_changed():
+            kwargs['update_fields'] = {*update_fields, 'token_epoch'}
+        super().save(*args, **kwargs)
+        self._loaded = {}
+        self._snapshot()
+
     def set_password(self, raw_password):
         """
-        Hash the password before saving.
+        Hash the password before saving. Changing the password of an existing user revokes their tokens.
         """
         self.password = make_password(raw_password)
+        if not self._state.adding:
+            self.token_epoch += 1
         self._password = raw_password  # Store the unhashed password temporarily for validation
 
+    def check_password(self, raw_password):
+        """
+        Check the password; outdated hashes are upgraded by the rehash queue instead of inline.
+        """
+        from .hashers import schedule_rehash
+
+        def setter(raw_password):
+            schedule_rehash(self, raw_password)
+
+        return check_password(raw_password, self.password, setter)
+
 class LoginMethod(models.Model):
     """
     Model to store different login methods for a user.
@@ -103,19 +257,237 @@ class LoginMethod(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='login_methods')
     login_type = models.CharField(max_length=15, choices=LOGIN_TYPE_CHOICES)
     identifier = models.CharField(max_length=255, unique=True)
+    last_used = models.DateTimeField(_("last used"), null=True, blank=True)
 
     def __str__(self):
         return f"{self.user} - {self.get_login_type_display()}: {self.identifier}"
 
 
-class Profile(models.Model):
+class Profile(VersionedModel):
     """
     Model to store additional user profile information.
     """
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name='profile')
     bio = models.TextField(_("bio"), blank=True)
-    avatar = models.ImageField(upload_to='avatars/', null=True, blank=True)
+    avatar = models.ImageField(upload_to='avatars/', storage=avatar_storage, null=True, blank=True)
+    avatar_variants = models.JSONField(_("avatar variants"), default=dict, blank=True, editable=False)
     birth_date = models.DateField(_("birth date"), null=True, blank=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_avatar = instance.__dict__.get('avatar') or None
+        return instance
+
+    def avatar_changed(self):
+        """
+        Whether the avatar differs from the one last loaded or saved.
+        """
+        return getattr(self, '_loaded_avatar', None) != (self.avatar.name or None)
+
+    def stored_files(self):
+        """
+        Names of the avatar and variant files this profile holds a reference to.
+        """
+        return [name for name in [self.avatar.name, *self.avatar_variants.values()] if name]
+
+    def save(self, *args, **kwargs):
+        # ภาพย่อของ avatar เดิมใช้ไม่ได้แล้ว จะถูกสร้างใหม่โดย main.avatars หลังบันทึก
+        self._avatar_changed = self.avatar_changed()
+        # ไฟล์ที่อัปโหลดใหม่ถูกนับการอ้างอิงแล้วโดย ContentAddressedStorage.save ระหว่างบันทึก
+        self._avatar_retained = bool(self.avatar) and not self.avatar._committed
+        if self._avatar_changed:
+            self.avatar_variants = {}
+            # อ่านไฟล์เดิมจากฐานข้อมูล เพราะภาพย่ออาจถูกสร้างหลังจาก instance นี้ถูกโหลด
+            self._replaced_files = []
+            if not self._state.adding:
+                current = Profile.objects.filter(pk=self.pk).first()
+                if current is not None:
+                    self._replaced_files = current.stored_files()
+        super().save(*args, **kwargs)
+        self._loaded_avatar = self.avatar.name or None
+
     def __str__(self):
         return f"{self.user}'s profile"
+
+
+class UserIdentifierManager(models.Manager):
+    def resolve(self, value):
+        """
+        Return the user owning the identifier in a single indexed lookup, or None.
+        """
+        identifier = canonical_identifier(value)
+        if not identifier:
+            return None
+        row = self.select_related('user').filter(identifier=identifier).first()
+        return row.user if row else None
+
+    async def aresolve(self, value):
+        """
+        Async version of resolve() for async views.
+        """
+        identifier = canonical_identifier(value)
+        if not identifier:
+            return None
+        row = await self.select_related('user').filter(identifier=identifier).afirst()
+        return row.user if row else None
+
+    def resolve_login(self, value):
+        """
+        resolve() for login paths: identifiers the identifier filter has never seen return None without a query.
+        """
+        identifier = canonical_identifier(value)
+        if not identifier or not identifier_filter.might_contain(identifier):
+            return None
+        return self.resolve(identifier)
+
+    async def aresolve_login(self, value):
+        """
+        Async version of resolve_login() for async views.
+        """
+        identifier = canonical_identifier(value)
+        if not identifier or not await identifier_filter.amight_contain(identifier):
+            return None
+        return await self.aresolve(identifier)
+
+    def resolve_many(self, values):
+        """
+        Map canonical identifiers to user ids with a single query. Unknown identifiers are left out,
+        and when the identifier filter rules all of them out no query is made.
+        """
+        identifiers = identifier_filter.might_contain_many({canonical_identifier(value) for value in values} - {''})
+        if not identifiers:
+            return {}
+        return dict(self.filter(identifier__in=identifiers).values_list('identifier', 'user_id'))
+
+    def claimed(self, values, user_id=None):
+        """
+        Canonical forms of values already indexed for a user other than user_id.
+        """
+        identifiers = {canonical_identifier(value) for value in values} - {''}
+        if not identifiers:
+            return set()
+        rows = self.filter(identifier__in=identifiers)
+        if user_id is not None:
+            rows = rows.exclude(user_id=user_id)
+        return set(rows.values_list('identifier', flat=True))
+
+    def identifiers_for(self, user):
+        """
+        All canonical identifiers a user can log in with (user columns and LoginMethod rows).
+        """
+        values = [user.email, user.national_id, user.phone_number]
+        values += LoginMethod.objects.filter(user_id=user.pk).values_list('identifier', flat=True)
+        return {canonical_identifier(value) for value in values if value} - {''}
+
+    def add_for_new_user(self, user):
+        """
+        Index a freshly created user's identifiers without reading existing rows.
+        Raises IntegrityError when another user already holds one of them (e.g. an email differing only in case).
+        """
+        values = {canonical_identifier(value) for value in (user.email, user.national_id, user.phone_number) if value}
+        values.discard('')
+        self.bulk_create([self.model(user_id=user.pk, identifier=value) for value in values])
+
+    def sync_for_user(self, user):
+        """
+        Bring the index rows for a user in line with their current identifiers.
+        Raises IntegrityError when another user already holds a new one.
+        """
+        wanted = self.identifiers_for(user)
+        current = set(self.filter(user_id=user.pk).values_list('identifier', flat=True))
+        if current - wanted:
+            self.filter(user_id=user.pk, identifier__in=current - wanted).delete()
+            identifier_filter.discard(len(current - wanted))
+        if wanted - current:
+            self.bulk_create([self.model(user_id=user.pk, identifier=value) for value in wanted - current])
+
+
+class UserIdentifier(models.Model):
+    """
+    Normalized index of every login identifier, so each login path resolves a user with one lookup.
+    Kept in sync with CustomUser and LoginMethod by main.signals.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='identifiers')
+    identifier = models.CharField(_("identifier"), max_length=255, unique=True)
+
+    objects = UserIdentifierManager()
+
+    def __str__(self):
+        return f"{self.identifier} -> {self.user_id}"
+
+
+class StoredFileManager(models.Manager):
+    def retain(self, names):
+        """
+        Add one reference to each named file, creating its row on first use.
+        The update comes first so a row deleted by main.storage.collect_files in between is recreated, not missed.
+        """
+        for name in set(names):
+            while not self.filter(name=name).update(ref_count=F('ref_count') + 1):
+                try:
+                    with transaction.atomic():
+                        self.create(name=name, ref_count=1)
+                    break
+                except IntegrityError:
+                    continue
+
+    def release(self, names):
+        """
+        Drop one reference from each named file. Rows reaching zero are removed by main.storage.collect_files.
+        """
+        self.filter(name__in=set(names)).update(ref_count=F('ref_count') - 1)
+
+
+class StoredFile(models.Model):
+    """
+    Reference count for content-addressed files shared between profiles (avatars and their variants).
+    Kept in sync by main.signals and main.avatars.
+    """
+    name = models.CharField(_("name"), max_length=255, unique=True)
+    ref_count = models.IntegerField(_("reference count"), default=0)
+
+    objects = StoredFileManager()
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count})"
+
+
+class RevokedTokenManager(models.Manager):
+    def revoke(self, jti, expires_at):
+        """
+        Add a token to the denylist. Returns False when it was already revoked (e.g. a replayed refresh token),
+        so the insert doubles as the "is it revoked?" check.
+        """
+        try:
+            with transaction.atomic():
+                self.create(jti=jti, expires_at=expires_at)
+        except IntegrityError:
+            return False
+        return True
+
+    def prune(self, batch_size=10000, now=None):
+        """
+        Delete expired entries in batches of batch_size. Returns the number of rows deleted.
+        """
+        expired = self.filter(expires_at__lte=now or timezone.now())
+        deleted = 0
+        while True:
+            batch = list(expired.values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                return deleted
+            deleted += self.filter(pk__in=batch).delete()[0]
+
+
+class RevokedToken(models.Model):
+    """
+    Denylist of refresh tokens keyed by their jti. Entries are only needed until the token would have expired
+    anyway and are removed by the prune_revoked_tokens command.
+    """
+    jti = models.CharField(_("jti"), max_length=64, primary_key=True)
+    expires_at = models.DateTimeField(_("expires at"), db_index=True)
+
+    objects = RevokedTokenManager()
+
+    def __str__(self):
+        return self.jti
@@ -0,0 +1,27 @@
+# main/pagination.py
+
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class UserCursorPagination(CursorPagination):
+    """
+    Keyset (cursor) pagination สำหรับรายชื่อผู้ใช้ เรียงตาม id หรือ date_joined
+    เวลาตอบสนองไม่ขึ้นกับตำแหน่งหน้าเพราะใช้ WHERE บนคอลัมน์ที่มี index แทน OFFSET
+    """
+    page_size = settings.USER_LIST_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.USER_LIST_MAX_PAGE_SIZE
+    ordering = 'id'
+    ordering_param = 'ordering'
+    ordering_fields = ('id', 'date_joined')
+
+    def get_ordering(self, request, queryset, view):
+        value = request.query_params.get(self.ordering_param, self.ordering)
+        field = value.lstrip('-')
+        if field not in self.ordering_fields:
+            value, field = self.ordering, self.ordering.lstrip('-')
+        if field == 'id':
+            return (value,)
+        # ใช้ id เป็นตัวตัดสินเมื่อ date_joined ซ้ำกัน
+        return (value, '-id' if value.startswith('-') else 'id')
@@ -0,0 +1,191 @@
+# main/routers.py
+
+import contextlib
+import contextvars
+import itertools
+import logging
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# True ระหว่าง request ที่อ่านจาก replica ได้ (ตั้งโดย ReplicaRoutingMiddleware)
+# งานนอก request เช่น background thread และ management command จะใช้ primary เสมอ
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+
+
+@contextlib.contextmanager
+def primary_reads():
+    """
+    อ่านจาก primary ภายใน block นี้แม้ request จะอ่านจาก replica ได้
+    ใช้กับข้อมูลที่ถูกเก็บไว้ให้ผู้ใช้คนอื่นอ่านต่อ (เช่น payload ใน main.cache) ซึ่งต้องไม่มาจาก replica ที่ล่าช้า
+    """
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def _pin_key(user_id):
+    return f'db-pin:{user_id}'
+
+
+def pin_to_primary(user_id):
+    """
+    ให้ผู้ใช้อ่านจาก primary เป็นเวลา REPLICA_PIN_SECONDS หลังการเขียน (read-your-writes)
+    เก็บใน cache ของ API (API_CACHE_ALIAS) ซึ่งทุก worker เห็นเฉพาะเมื่อเป็น cache กลาง (เช่น redis)
+    ReplicaRoutingMiddleware จึงส่ง pin ไปกับ cookie REPLICA_PIN_COOKIE ด้วย
+    """
+    if user_id is not None and settings.DATABASE_REPLICAS:
+        caches[settings.API_CACHE_ALIAS].set(_pin_key(user_id), True, settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user_id):
+    return user_id is not None and caches[settings.API_CACHE_ALIAS].get(_pin_key(user_id)) is not None
+
+
+def replica_lag(alias):
+    """
+    ความล่าช้า (วินาที) ของ replica เทียบกับ primary ฐานข้อมูลที่วัดไม่ได้ (เช่น SQLite) คืน 0
+    """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )
+        return float(cursor.fetchone()[0])
+
+
+class ReplicaHealth:
+    """
+    เก็บผลการวัด lag ของแต่ละ replica ไว้ REPLICA_LAG_CHECK_INTERVAL วินาที
+    replica ที่ lag เกิน REPLICA_MAX_LAG หรือเชื่อมต่อไม่ได้จะไม่ถูกใช้จนกว่าจะวัดใหม่
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = {}
+
+    def healthy(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked.get(alias)
+        if checked is not None and now - checked[0] < settings.REPLICA_LAG_CHECK_INTERVAL:
+            return checked[1]
+        try:
+            healthy = replica_lag(alias) <= settings.REPLICA_MAX_LAG
+        except Exception:
+            logger.warning(f"Replica {alias} is unavailable, reading from primary", exc_info=True)
+            healthy = False
+        with self._lock:
+            self._checked[alias] = (now, healthy)
+        return healthy
+
+    def reset(self):
+        with self._lock:
+            self._checked.clear()
+
+
+health = ReplicaHealth()
+_rotation = itertools.count()
+
+
+class ReplicaRouter:
+    """
+    ส่งการอ่านของ request แบบ GET/HEAD/OPTIONS ไปยัง replica ใน DATABASE_REPLICAS แบบ round-robin
+    การเขียน, request อื่น, ผู้ใช้ที่เพิ่งเขียน และกรณีที่ replica ล่าช้า จะใช้ primary
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = settings.DATABASE_REPLICAS
+        if not replicas or not _replica_reads.get():
+            return DEFAULT_DB_ALIAS
+        start = next(_rotation)
+        for offset in range(len(replicas)):
+            alias = replicas[(start + offset) % len(replicas)]
+            if health.healthy(alias):
+                return alias
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replica เป็นสำเนาของ primary จึงอ้างอิงข้ามกันได้
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaRoutingMiddleware:
+    """
+    เปิดการอ่านจาก replica สำหรับ request แบบ safe method ใต้ REPLICA_PATH_PREFIXES ของผู้ใช้ที่ไม่ได้ถูก pin
+    และ pin ผู้ใช้ไว้กับ primary หลัง request ที่เขียนข้อมูลสำเร็จ
+    ผู้ใช้ระบุจาก access token (ตรวจแบบ stateless ไม่ query)
+    pin ถูกเก็บทั้งใน cache (pin_to_primary) และใน cookie อายุ REPLICA_PIN_SECONDS ที่ client ส่งกลับมา
+    request ถัดไปจึงอ่านจาก primary แม้จะไปถึง worker อื่นที่ไม่เห็น cache ของ worker ที่เขียน
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = self.enter(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _replica_reads.reset(token)
+        self.leave(request, response)
+        return response
+
+    async def __acall__(self, request):
+        token = self.enter(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _replica_reads.reset(token)
+        self.leave(request, response)
+        return response
+
+    def user_id(self, request):
+        from .authentication import TokenUserAuthentication
+
+        try:
+            result = TokenUserAuthentication(verify_epoch=False).authenticate(request)
+        except Exception:
+            return None
+        return result[0].id if result else None
+
+    def enter(self, request):
+        if not settings.DATABASE_REPLICAS or not request.path.startswith(settings.REPLICA_PATH_PREFIXES):
+            return _replica_reads.set(False)
+        request.replica_user_id = self.user_id(request)
+        if request.method not in SAFE_METHODS or settings.REPLICA_PIN_COOKIE in request.COOKIES:
+            return _replica_reads.set(False)
+        return _replica_reads.set(not is_pinned(request.replica_user_id))
+
+    def leave(self, request, response):
+        if settings.DATABASE_REPLICAS and request.method not in SAFE_METHODS and response.status_code < 400:
+            pin_to_primary(getattr(request, 'replica_user_id', None))
+            response.set_cookie(
+                settings.REPLICA_PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS,
+                secure=request.is_secure(), httponly=True, samesite='Lax',
+            )
@@ -1,21 +1,78 @@
 # main/serializers.py
 
 from rest_framework import serializers
-from .models import CustomUser, Profile, LoginMethod
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.utils import datetime_from_epoch
+from .models import CustomUser, Profile, LoginMethod, RevokedToken, UserIdentifier, canonical_identifier
+from django.conf import settings
+from .tokens import UserRefreshToken, recently_revoked
+from .instrumentation import TimedRepresentationMixin
+from .fieldsets import ExpandableSerializerMixin
+from .hashers import hash_dummy_password
 from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
 from django.utils import timezone
 
 
-class CustomUserSerializer(serializers.ModelSerializer):
+class UniqueIdentifierMixin:
+    """
+    Mixin ของ serializer ที่บันทึก identifier สำหรับ login (identifier_fields)
+    identifier ต้องไม่ซ้ำกับของผู้ใช้อื่นหลัง canonical_identifier (เช่น email ที่ต่างกันแค่ตัวพิมพ์)
+    ตรวจกับ UserIdentifier ก่อนบันทึก และบันทึกใน transaction เดียวกับ index (ที่อัปเดตโดย signal)
+    การชนกันที่เกิดพร้อมกันจึงได้ 400 แทนที่ผู้ใช้จะถูกสร้างโดย login ไม่ได้
+    """
+    identifier_fields = ()
+    identifier_taken_message = "This identifier is already in use."
+
+    def identifier_owner(self):
+        """
+        id ของผู้ใช้ที่จะเป็นเจ้าของ identifier (None สำหรับผู้ใช้ใหม่)
+        """
+        return None
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        values = {name: attrs[name] for name in self.identifier_fields if attrs.get(name)}
+        claimed = UserIdentifier.objects.claimed(values.values(), user_id=self.identifier_owner())
+        errors = {name: self.identifier_taken_message for name, value in values.items() if canonical_identifier(value) in claimed}
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    def save(self, **kwargs):
+        if not any(name in self.validated_data for name in self.identifier_fields):
+            return super().save(**kwargs)
+        try:
+            with transaction.atomic():
+                return super().save(**kwargs)
+        except IntegrityError:
+            names = [name for name in self.identifier_fields if name in self.validated_data] or ['non_field_errors']
+            raise serializers.ValidationError({name: self.identifier_taken_message for name in names})
+
+
+class CustomUserSerializer(UniqueIdentifierMixin, ExpandableSerializerMixin, TimedRepresentationMixin, serializers.ModelSerializer):
     """
     Serializer สำหรับโมเดล CustomUser 
     จัดการการสร้างผู้ใช้, การเข้ารหัสรหัสผ่าน, และไม่รวมฟิลด์ที่ละเอียดอ่อนจากการตอบสนอง
+    ฝัง Profile และ LoginMethod ได้ด้วย expand=('profile', 'login_methods')
     """
+    expandable_fields = {
+        'profile': ('ProfileSerializer', {'allow_null': True}),  # null เมื่อผู้ใช้ยังไม่มี Profile
+        'login_methods': ('LoginMethodSerializer', {'many': True}),
+    }
+
     class Meta:
         model = CustomUser
         fields = ['id', 'email', 'national_id', 'phone_number', 'first_name', 'last_name', 'password']
         extra_kwargs = {'password': {'write_only': True}}  # ซ่อน password ใน response
 
+    identifier_fields = CustomUser.IDENTIFIER_FIELDS
+
+    def identifier_owner(self):
+        return self.instance.pk if self.instance is not None else None
+
     def create(self, validated_data):
         """
         แทนที่เมธอด create เพื่อเข้ารหัสรหัสผ่านก่อนบันทึกผู้ใช้
@@ -39,18 +96,26 @@ class CustomUserSerializer(serializers.ModelSerializer):
         แทนที่ to_representation เพื่อไม่รวมฟิลด์ที่ละเอียดอ่อนเช่นรหัสผ่านออกจากการตอบสนอง
         """
         ret = super().to_representation(instance)
-        ret.pop('password')  # Remove password from the response
+        ret.pop('password', None)  # Remove password from the response
         return ret
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(ExpandableSerializerMixin, TimedRepresentationMixin, serializers.ModelSerializer):
     """
     Serializer สำหรับโมเดล Profile รวมถึง URL ของ avatar และตรวจสอบความถูกต้องของวันเกิด
+    ฝังผู้ใช้ (แทน id ในฟิลด์ user) และ LoginMethod ของผู้ใช้ได้ด้วย expand=('user', 'login_methods')
     """
+    expandable_fields = {
+        'user': ('CustomUserSerializer', {}),
+        'login_methods': ('LoginMethodSerializer', {'many': True, 'source': 'user.login_methods'}),
+    }
+    field_dependencies = {'avatar_url': ('avatar',), 'avatar_variants': ('avatar', 'avatar_variants')}
+
     avatar_url = serializers.SerializerMethodField()  # เพิ่ม SerializerMethodField สำหรับ URL ของรูปภาพ
+    avatar_variants = serializers.SerializerMethodField()  # URL ของภาพย่อแต่ละขนาด (ว่างจนกว่าจะสร้างเสร็จ)
 
     class Meta:
         model = Profile
-        fields = ['id', 'user', 'bio', 'avatar', 'avatar_url', 'birth_date']  # เพิ่ม 'avatar_url' ใน fields
+        fields = ['id', 'user', 'bio', 'avatar', 'avatar_url', 'avatar_variants', 'birth_date']  # เพิ่ม 'avatar_url' ใน fields
         read_only_fields = ['user']
 
     def get_avatar_url(self, obj):
@@ -61,6 +126,13 @@ class ProfileSerializer(serializers.ModelSerializer):
             return obj.avatar.url
         return None
     
+    def get_avatar_variants(self, obj):
+        """
+        รับ URL ของภาพย่อ avatar แยกตามขนาด เช่น {"64": "/media/avatars/variants/....webp"}
+        """
+        storage = obj.avatar.storage
+        return {size: storage.url(name) for size, name in obj.avatar_variants.items()}
+
     def validate_birth_date(self, value):
         """
         ตรวจสอบว่าวันเกิดไม่ได้อยู่ในอนาคต
@@ -69,15 +141,40 @@ class ProfileSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("วันเกิดไม่สามารถอยู่ในอนาคตได้ ")
         return value
 
-class LoginMethodSerializer(serializers.ModelSerializer):
+class LoginMethodSerializer(UniqueIdentifierMixin, TimedRepresentationMixin, serializers.ModelSerializer):
+    identifier_fields = ('identifier',)
+
     class Meta:
         model = LoginMethod
         fields = ['id', 'user', 'login_type', 'identifier']
         read_only_fields = ['user']  # Make 'user' field read-only
 
-class TokenObtainPairSerializer(serializers.Serializer):
+    def identifier_owner(self):
+        # LoginMethod ใหม่เป็นของผู้ใช้ที่ล็อกอินอยู่ (view ส่ง user_id ตอน save)
+        if self.instance is not None:
+            return self.instance.user_id
+        request = self.context.get('request')
+        return request.user.id if request is not None else None
+
+class UserLookupSerializer(serializers.Serializer):
     """
-    Serializer สำหรับโมเดล LoginMethod ฟิลด์ 'user' เป็นแบบอ่านอย่างเดียว
+    id และ/หรือ identifier (email, national_id, phone_number) ที่จะค้นหา รวมกันไม่เกิน USER_LOOKUP_MAX_ITEMS
+    """
+    # ไม่เกินช่วงของ primary key (BigAutoField) ค่าที่ใหญ่กว่านี้ฐานข้อมูลรับไม่ได้
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1, max_value=2 ** 63 - 1), required=False, default=list)
+    identifiers = serializers.ListField(child=serializers.CharField(max_length=255), required=False, default=list)
+
+    def validate(self, attrs):
+        total = len(attrs['ids']) + len(attrs['identifiers'])
+        if not total:
+            raise serializers.ValidationError("ต้องระบุ ids หรือ identifiers อย่างน้อยหนึ่งรายการ")
+        if total > settings.USER_LOOKUP_MAX_ITEMS:
+            raise serializers.ValidationError(f"ค้นหาได้ไม่เกิน {settings.USER_LOOKUP_MAX_ITEMS} รายการต่อครั้ง")
+        return attrs
+
+class TokenCredentialsSerializer(serializers.Serializer):
+    """
+    ตรวจรูปแบบข้อมูลที่ใช้ login โดยไม่ค้นหาผู้ใช้หรือตรวจรหัสผ่าน (ใช้ร่วมกับ async view)
     """
     email = serializers.EmailField(required=False)
     national_id = serializers.CharField(required=False)
@@ -85,21 +182,30 @@ class TokenObtainPairSerializer(serializers.Serializer):
     password = serializers.CharField(write_only=True)
 
     def validate(self, attrs):
-        """
-        ตรวจสอบข้อมูลประจำตัวการเข้าสู่ระบบและส่งคืนออบเจ็กต์ผู้ใช้หากสำเร็จ
-        """
         # Check if at least one identifier is provided
         if not any([attrs.get('email'), attrs.get('national_id'), attrs.get('phone_number')]):
             raise serializers.ValidationError("คุณต้องระบุตัวระบุอย่างน้อยหนึ่งรายการ (อีเมล์, หมายเลขบัตรประจำตัว, หรือ หมายเลขโทรศัพท์).")
+        return attrs
+
+    @staticmethod
+    def identifier(attrs):
+        return attrs.get('email') or attrs.get('national_id') or attrs.get('phone_number')
+
+class TokenObtainPairSerializer(TokenCredentialsSerializer):
+    """
+    Serializer สำหรับโมเดล LoginMethod ฟิลด์ 'user' เป็นแบบอ่านอย่างเดียว
+    """
+
+    def validate(self, attrs):
+        """
+        ตรวจสอบข้อมูลประจำตัวการเข้าสู่ระบบและส่งคืนออบเจ็กต์ผู้ใช้หากสำเร็จ
+        """
+        attrs = super().validate(attrs)
 
-        # Try to find the user based on the provided identifier
-        user = None
-        if attrs.get('email'):
-            user = CustomUser.objects.filter(email=attrs['email']).first()
-        elif attrs.get('national_id'):
-            user = CustomUser.objects.filter(national_id=attrs['national_id']).first()
-        elif attrs.get('phone_number'):
-            user = CustomUser.objects.filter(phone_number=attrs['phone_number']).first()
+        # Try to find the user based on the provided identifier (one indexed lookup, none for unknown identifiers)
+        user = UserIdentifier.objects.resolve_login(self.identifier(attrs))
+        if user is None:
+            hash_dummy_password(attrs['password'])
 
         if user and user.check_password(attrs['password']):
             if not user.is_active:
@@ -108,3 +214,38 @@ class TokenObtainPairSerializer(serializers.Serializer):
             return attrs
         else:
             raise serializers.ValidationError("ชื่อผู้ใช้หรือรหัสผ่านไม่ถูกต้อง.")  # ปรับปรุง error message
+
+
+class TokenRefreshSerializer(serializers.Serializer):
+    """
+    ขอ access token ใหม่ด้วย refresh token เมื่อ ROTATE_REFRESH_TOKENS จะออก refresh token ใหม่ด้วย
+    และเมื่อ BLACKLIST_AFTER_ROTATION refresh token เดิมจะถูกเพิ่มใน RevokedToken (ใช้ซ้ำไม่ได้)
+    """
+    refresh = serializers.CharField(write_only=True)
+
+    def validate(self, attrs):
+        refresh = UserRefreshToken(attrs['refresh'])
+        jti = refresh[jwt_settings.JTI_CLAIM]
+        if jti in recently_revoked:
+            raise InvalidToken("Token is blacklisted")
+
+        user = CustomUser.objects.filter(
+            **{jwt_settings.USER_ID_FIELD: refresh[jwt_settings.USER_ID_CLAIM]}, is_active=True
+        ).first()
+        if user is None:
+            raise AuthenticationFailed("No active account found for the given token.", code='no_active_account')
+        if refresh.get('token_epoch', 0) != user.token_epoch:
+            raise InvalidToken("Token has been revoked")
+
+        if jwt_settings.ROTATE_REFRESH_TOKENS and jwt_settings.BLACKLIST_AFTER_ROTATION:
+            # insert ที่ชนกับ primary key คือ token ที่ถูกเพิกถอนไปแล้ว (ตรวจและเพิกถอนในคำสั่งเดียว)
+            revoked = RevokedToken.objects.revoke(jti, datetime_from_epoch(refresh['exp']))
+            recently_revoked.add(jti)
+            if not revoked:
+                raise InvalidToken("Token is blacklisted")
+
+        new_refresh = UserRefreshToken.for_user(user)
+        data = {'access': str(new_refresh.access_token)}
+        if jwt_settings.ROTATE_REFRESH_TOKENS:
+            data['refresh'] = str(new_refresh)
+        return data
@@ -1,37 +1,186 @@
 # main/signals.py
 
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
+from django.db.backends.signals import connection_created
 from django.dispatch import receiver
-from .models import CustomUser, Profile
-from django.db import IntegrityError
+from django.conf import settings
+from .models import CustomUser, Profile, LoginMethod, UserIdentifier, StoredFile, canonical_identifier
+from .identifier_filter import identifier_filter
+from .login_tracking import forget_login_methods
+from .cache import profile_cache, login_method_cache, token_epochs
+from .avatars import schedule_avatar_variants
+from .storage import release_files
+from .instrumentation import install_query_recorder
+from django.db import IntegrityError, transaction
 import logging
 
 logger = logging.getLogger(__name__)  # สร้าง logger สำหรับบันทึกข้อผิดพลาด
 
 @receiver(post_save, sender=CustomUser)
-def create_user_profile(sender, instance, created, **kwargs):
+def create_user_profile(sender, instance, created, raw=False, **kwargs):
     """
-    สร้าง Profile object ใหม่เมื่อมีการสร้าง CustomUser object ใหม่
-    หากเกิดข้อผิดพลาด IntegrityError จะบันทึก log และข้ามการสร้าง Profile
+    สร้าง Profile object ใหม่เพียงครั้งเดียวเมื่อมีการสร้าง CustomUser object ใหม่
+    การบันทึก CustomUser ครั้งถัดไป (เช่นอัปเดต last_login) จะไม่แตะ Profile เลย
+    ข้ามเมื่อโหลดจาก fixture (raw) และหากเกิด IntegrityError จะบันทึก log และข้ามการสร้าง Profile
     """
-    if created:
-        try:
-            Profile.objects.create(user=instance)
-        except IntegrityError as e:
-            logger.error(f"Failed to create profile for user {instance.id}: {e}")
+    if not created or raw:
+        return
+    try:
+        Profile.objects.create(user=instance)
+    except IntegrityError as e:
+        logger.error(f"Failed to create profile for user {instance.id}: {e}")
 
 @receiver(post_save, sender=CustomUser)
-def save_user_profile(sender, instance, **kwargs):
+def sync_user_identifiers(sender, instance, created, update_fields=None, **kwargs):
+    """
+    อัปเดต UserIdentifier index เมื่อ email, national_id หรือ phone_number ของผู้ใช้เปลี่ยน
+    """
+    if update_fields is not None and not set(update_fields) & set(CustomUser.IDENTIFIER_FIELDS):
+        return
+    if created:
+        # ผู้ใช้ใหม่ยังไม่มี LoginMethod หรือแถวใน index จึงเพิ่มได้ทันทีโดยไม่ต้อง query
+        UserIdentifier.objects.add_for_new_user(instance)
+    elif instance.identifiers_changed():
+        UserIdentifier.objects.sync_for_user(instance)
+
+@receiver(post_save, sender=LoginMethod)
+@receiver(post_delete, sender=LoginMethod)
+def sync_login_method_identifiers(sender, instance, **kwargs):
     """
-    บันทึก Profile object เมื่อมีการบันทึก CustomUser object
-    หาก Profile ยังไม่ถูกสร้าง จะสร้าง Profile ใหม่
-    หากเกิดข้อผิดพลาด IntegrityError หรืออื่นๆ จะบันทึก log และข้ามการบันทึก
+    อัปเดต UserIdentifier index เมื่อมีการเพิ่ม แก้ไข หรือลบ LoginMethod
     """
     try:
-        instance.profile.save()
-    except Profile.DoesNotExist:
-        Profile.objects.create(user=instance)
-    except IntegrityError as e:
-        logger.error(f"Failed to save profile for user {instance.id}: {e}")
-    except Exception as e:
-        logger.error(f"An unexpected error occurred while saving profile for user {instance.id}: {e}")
+        user = CustomUser.objects.get(pk=instance.user_id)
+    except CustomUser.DoesNotExist:
+        # ผู้ใช้ถูกลบไปแล้ว (cascade) index จะถูกลบตามไปด้วย นับ identifier นี้ไว้สำหรับ identifier filter
+        identifier_filter.discard()
+        return
+    UserIdentifier.objects.sync_for_user(user)
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_save, sender=LoginMethod)
+def add_known_identifiers(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    เพิ่ม identifier ใหม่ลงใน identifier filter ของ process นี้ทันที (process อื่น sync เองหลัง commit)
+    """
+    if sender is LoginMethod:
+        values = [instance.identifier]
+    elif created or (
+        (update_fields is None or set(update_fields) & set(CustomUser.IDENTIFIER_FIELDS)) and instance.identifiers_changed()
+    ):
+        values = [getattr(instance, field) for field in CustomUser.IDENTIFIER_FIELDS]
+    else:
+        return
+    identifier_filter.add({canonical_identifier(value) for value in values if value})
+
+@receiver(post_delete, sender=CustomUser)
+def forget_known_identifiers(sender, instance, **kwargs):
+    """
+    Bloom filter ลบสมาชิกไม่ได้ จึงนับไว้เพื่อสร้าง filter ใหม่เมื่อถูกลบมากพอ
+    (identifier ที่ถูกลบเพราะเปลี่ยนหรือลบ LoginMethod นับใน UserIdentifierManager.sync_for_user)
+    """
+    identifier_filter.discard(sum(1 for field in CustomUser.IDENTIFIER_FIELDS if getattr(instance, field)))
+
+@receiver(post_save, sender=LoginMethod)
+@receiver(post_delete, sender=LoginMethod)
+def forget_cached_login_methods(sender, instance, **kwargs):
+    """
+    ล้าง cache ชุด LoginMethod ของผู้ใช้ที่ใช้ตรวจสอบตอน login
+    """
+    forget_login_methods(instance.user_id)
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def invalidate_profile_cache(sender, instance, **kwargs):
+    """
+    ล้าง payload ของ Profile ที่ cache ไว้เมื่อ Profile เปลี่ยน
+    """
+    profile_cache.invalidate(instance.user_id)
+
+@receiver(post_save, sender=LoginMethod)
+@receiver(post_delete, sender=LoginMethod)
+def invalidate_login_method_cache(sender, instance, **kwargs):
+    """
+    ล้าง payload ของ LoginMethod ที่ cache ไว้เมื่อ LoginMethod เปลี่ยน
+    รวมถึง payload ของ Profile ที่ฝัง LoginMethod ไว้ (?expand=login_methods)
+    """
+    login_method_cache.invalidate(instance.user_id)
+    profile_cache.invalidate(instance.user_id)
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_user_caches(sender, instance, created=False, **kwargs):
+    """
+    ล้าง payload ทั้งหมดของผู้ใช้เมื่อผู้ใช้ถูกแก้ไขหรือลบ
+    """
+    if created:
+        return
+    profile_cache.invalidate(instance.pk)
+    login_method_cache.invalidate(instance.pk)
+
+@receiver(post_save, sender=CustomUser)
+def publish_token_epoch(sender, instance, created, using=None, **kwargs):
+    """
+    เขียน token_epoch ลง cache เมื่อผู้ใช้ถูกสร้างหรือ token ถูกเพิกถอน (เปลี่ยนรหัสผ่าน, เปิด/ปิดบัญชี)
+    epoch ที่เพิ่มขึ้นเขียนหลัง transaction commit เท่านั้น ถ้า rollback ค่าใน cache จะไม่สูงกว่าในฐานข้อมูล
+    (มิฉะนั้น token ทุกอันรวมถึงที่เพิ่งออกจะถูกปฏิเสธจนค่าหมดอายุ) ส่วน epoch เริ่มต้นของผู้ใช้ใหม่เขียนได้ทันที
+    """
+    if created:
+        token_epochs.set(instance.pk, instance.token_epoch)
+    elif instance.token_epoch_changed():
+        user_id, epoch = instance.pk, instance.token_epoch
+        transaction.on_commit(lambda: token_epochs.set(user_id, epoch), using=using)
+
+@receiver(post_delete, sender=CustomUser)
+def forget_token_epoch(sender, instance, **kwargs):
+    """
+    ลบ token_epoch ที่ cache ไว้ token ของผู้ใช้ที่ถูกลบจะถูกปฏิเสธเมื่ออ่านจากฐานข้อมูลไม่พบ
+    """
+    token_epochs.forget(instance.pk)
+
+@receiver(post_save, sender=Profile)
+def process_avatar(sender, instance, raw=False, **kwargs):
+    """
+    ส่งงานสร้างภาพย่อของ avatar เข้าคิวเมื่อมีการอัปโหลด avatar ใหม่
+    """
+    if raw or not getattr(instance, '_avatar_changed', False) or not instance.avatar:
+        return
+    schedule_avatar_variants(instance)
+
+@receiver(post_save, sender=Profile)
+def track_avatar_files(sender, instance, raw=False, **kwargs):
+    """
+    นับการอ้างอิงไฟล์ avatar ใหม่ และปล่อยไฟล์ avatar/ภาพย่อเดิมเมื่อ avatar ถูกเปลี่ยน
+    """
+    if raw or not getattr(instance, '_avatar_changed', False):
+        return
+    if instance.avatar and not getattr(instance, '_avatar_retained', False):
+        StoredFile.objects.retain([instance.avatar.name])
+    release_files(getattr(instance, '_replaced_files', []))
+    instance._replaced_files = []
+
+@receiver(post_delete, sender=Profile)
+def release_avatar_files(sender, instance, **kwargs):
+    """
+    ปล่อยไฟล์ avatar และภาพย่อเมื่อ Profile ถูกลบ ไฟล์ที่ไม่มี Profile อื่นใช้จะถูกลบหลัง commit
+    """
+    release_files(instance.stored_files())
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """
+    ตั้ง pragma ใน SQLITE_PRAGMAS (เช่น journal_mode=WAL) ให้ทุก connection ใหม่ของ SQLite
+    """
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    """
+    ติดตั้งตัวนับ query ของ InstrumentationMiddleware ให้ connection ใหม่ (รวมถึง thread ของ async ORM)
+    """
+    if settings.INSTRUMENTATION_ENABLED:
+        install_query_recorder(connection)
@@ -0,0 +1,96 @@
+# main/storage.py
+
+import hashlib
+import logging
+import os
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.utils import validate_file_name
+from django.db import transaction
+from django.utils.deconstruct import deconstructible
+
+logger = logging.getLogger(__name__)
+
+
+@deconstructible(path='main.storage.ContentAddressedStorage')
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    FileSystemStorage ที่ตั้งชื่อไฟล์จาก sha256 ของเนื้อหา (คงโฟลเดอร์และนามสกุลเดิมไว้)
+    ไฟล์ที่มีเนื้อหาเดียวกันจึงได้ชื่อเดียวกันและถูกเก็บเพียงครั้งเดียว
+    เนื้อหาของชื่อหนึ่งไม่มีวันเปลี่ยน จึง cache URL ได้ตลอดไป
+
+    save() เพิ่มการอ้างอิง (StoredFile) ของชื่อให้ผู้เรียกก่อนตัดสินใจว่าจะข้ามการเขียนหรือไม่
+    collect_files จึงลบไฟล์ที่มีอยู่แล้วทิ้งระหว่างที่ผู้เรียกยังไม่ได้บันทึกการอ้างอิงไม่ได้
+    """
+    digest_length = 32
+
+    def hashed_name(self, name, content):
+        digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        return os.path.join(directory, digest.hexdigest()[:self.digest_length] + extension)
+
+    def save(self, name, content, max_length=None):
+        from .models import StoredFile
+
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.hashed_name(name, content)
+        validate_file_name(name, allow_relative_path=True)
+        with transaction.atomic():
+            # รอ collect_files ที่กำลังลบชื่อนี้อยู่ให้เสร็จก่อน แล้วจึงตรวจว่าไฟล์ยังอยู่หรือไม่
+            StoredFile.objects.retain([name])
+            if self.exists(name):
+                return name
+            saved = self._save(name, content)
+        if saved != name:
+            # มีผู้อื่นเขียนเนื้อหาเดียวกันเสร็จก่อน ใช้ไฟล์นั้นแทนสำเนาที่ได้ชื่อใหม่
+            self.delete(saved)
+        return name
+
+
+avatar_storage = ContentAddressedStorage()
+
+
+def release_files(names):
+    """
+    ลดจำนวนการอ้างอิงของไฟล์ และลบไฟล์ที่ไม่มีใครอ้างอิงแล้วหลัง transaction commit
+    """
+    from .models import StoredFile
+
+    names = [name for name in names if name]
+    if not names:
+        return
+    StoredFile.objects.release(names)
+    transaction.on_commit(lambda: collect_files(names))
+
+
+def collect_files(names, storage=avatar_storage):
+    """
+    ลบไฟล์ที่จำนวนการอ้างอิงเหลือศูนย์ คืนรายชื่อไฟล์ที่ถูกลบ
+    แถวที่ถูกอ้างอิงใหม่ระหว่างนี้ (ref_count > 0) จะไม่ถูกลบ
+    """
+    from .models import StoredFile
+
+    removed = []
+    for name in names:
+        # ลบไฟล์ระหว่างที่ยังล็อกแถวที่ ref_count เป็นศูนย์ไว้ ContentAddressedStorage.save จะรอจนลบเสร็จ
+        with transaction.atomic():
+            row = StoredFile.objects.select_for_update().filter(name=name, ref_count__lte=0).first()
+            if row is None:
+                continue
+            try:
+                storage.delete(name)
+            except OSError:
+                logger.exception(f"Failed to delete orphaned file {name}")
+                continue
+            row.delete()
+        removed.append(name)
+    return removed
@@ -1,14 +1,53 @@
 # main/tests.py
 
-from django.test import TestCase
+from django.test import AsyncClient, TestCase, override_settings
+from django.conf import settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.contrib.auth.hashers import identify_hasher, make_password
 from django.contrib.auth import get_user_model
 from rest_framework.test import APIClient
 from rest_framework_simplejwt.tokens import RefreshToken
-from .models import Profile, LoginMethod
-from django.core.files.uploadedfile import SimpleUploadedFile
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from .models import Profile, LoginMethod, RevokedToken, UserIdentifier, StoredFile
+from .backends import CustomAuthBackend
+from .authentication import LazyTokenUser
+from .tokens import UserRefreshToken, recently_revoked
+from .hashers import schedule_rehash
+from .login_tracking import LoginMethodRecorder, forget_login_methods
+from .importers import UserImporter, iter_rows
+from .pagination import UserCursorPagination
+from .exporters import parse_export_fields, render_export
+from .cache import metrics as cache_metrics, profile_cache, token_epochs
+from .serializers import ProfileSerializer
+from .uploads import AvatarUploadHandler
+from .hashers import BoundedHashExecutor
+from . import routers
+from .instrumentation import QueryBudgetExceeded, enforce_query_budgets, registry
+from .views import LoginMethodViewSet
+from .throttling import LocalCounterStore, login_throttle
+from .identifier_filter import BloomFilter, identifier_filter
+from .keyring import key_ring
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers, StopUpload
 from django.utils import timezone
-from django.db import IntegrityError
+from django.apps import apps
+from django.db import IntegrityError, connection, connections, transaction
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import caches
 import datetime , time
+import io
+import os
+import shutil
+import threading
+import struct
+import tempfile
+from PIL import Image
+import json
+from unittest import mock, skipUnless
+import jwt
+import zlib
+from asgiref.sync import sync_to_async
 
 User = get_user_model()
 
@@ -302,3 +341,1847 @@ class APIViewTestCase(TestCase):
         self.assertEqual(response.status_code, 204)  # No Content
         self.assertEqual(LoginMethod.objects.count(), 0)  # ไม่เหลือ login method ในระบบ
  
+
+
+class TokenUserAuthenticationTestCase(TestCase):
+    def setUp(self):
+        caches['api'].clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='tokenuser@example.com', password='testpassword')
+        self.token = UserRefreshToken.for_user(self.user).access_token
+
+    def test_profile_without_user_query(self):
+        """
+        ทดสอบว่า endpoint profile ไม่ query CustomUser (เหลือแค่ query Profile)
+        """
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/profile/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+
+    def test_token_claims(self):
+        """
+        ทดสอบว่า access token มี claim สำหรับ is_active, is_staff และ perms_version
+        """
+        self.assertTrue(self.token['is_active'])
+        self.assertFalse(self.token['is_staff'])
+        self.assertEqual(self.token['perms_version'], self.user.perms_version)
+
+    def test_admin_list_uses_staff_claim(self):
+        """
+        ทดสอบว่า IsAdminUser ใช้ claim is_staff จาก token
+        """
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(self.client.get('/api/users/').status_code, 403)
+
+        admin = User.objects.create_superuser(email='tokenadmin@example.com', password='adminpassword')
+        admin_token = UserRefreshToken.for_user(admin).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {admin_token}')
+        self.assertEqual(self.client.get('/api/users/').status_code, 200)
+
+    def test_permission_change_invalidates_full_user(self):
+        """
+        ทดสอบว่าเมื่อสิทธิ์เปลี่ยน perms_version จะเพิ่มขึ้นและ token เดิมโหลดผู้ใช้ไม่ได้
+        """
+        self.user.is_staff = True
+        self.user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.perms_version, 1)
+
+        token_user = LazyTokenUser(self.token)
+        with self.assertRaises(AuthenticationFailed):
+            token_user.instance
+
+    def test_deferred_loads_track_only_loaded_fields(self):
+        """
+        ทดสอบว่าการโหลดผู้ใช้แบบ defer ฟิลด์ไม่ query ซ้ำตอนสร้าง instance และยังตรวจการเปลี่ยนแปลงได้
+        """
+        with self.assertNumQueries(1):
+            user = User.objects.only('id').get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            User.objects.only('id', 'email').get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            profile = Profile.objects.select_related('user').only('id', 'user__email').get(user=self.user)
+        self.assertEqual(profile.user.email, 'tokenuser@example.com')
+        self.assertFalse(user.identifiers_changed())
+
+        # ฟิลด์ที่ถูก defer แล้วอ่านภายหลังยังถูกเทียบกับค่าที่โหลดมา
+        user.is_staff = not user.is_staff
+        user.save()
+        self.assertEqual(User.objects.get(pk=self.user.pk).perms_version, 1)
+
+        user = User.objects.only('id').get(pk=self.user.pk)
+        user.email = 'deferred@example.com'
+        self.assertTrue(user.identifiers_changed())
+        user.save()
+        self.assertTrue(UserIdentifier.objects.filter(identifier='deferred@example.com').exists())
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class PasswordRehashTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='rehash@example.com', password='testpassword')
+
+    def test_hash_uses_profile_cost(self):
+        """
+        ทดสอบว่า hash ใหม่ใช้ค่า iterations จากโปรไฟล์ที่เลือก
+        """
+        self.assertEqual(identify_hasher(self.user.password).decode(self.user.password)['iterations'], 1000)
+
+    @override_settings(PASSWORD_REHASH_MODE='async')
+    def test_outdated_hash_is_queued_not_saved_inline(self):
+        """
+        ทดสอบว่า hash ที่ล้าสมัยถูกส่งเข้าคิว ไม่ได้บันทึกระหว่าง login
+        """
+        old_password = self.user.password
+        with override_settings(PASSWORD_HASH_PROFILES={'test': {'pbkdf2_sha256': {'iterations': 2000}}}):
+            with mock.patch('main.hashers._get_rehash_executor') as executor:
+                with self.assertNumQueries(0):
+                    self.assertTrue(self.user.check_password('testpassword'))
+        executor.return_value.submit.assert_called_once()
+        self.assertEqual(User.objects.get(pk=self.user.pk).password, old_password)
+
+    @override_settings(PASSWORD_REHASH_MODE='inline')
+    def test_outdated_hash_is_upgraded(self):
+        """
+        ทดสอบว่า hash ที่ล้าสมัยถูกอัปเกรดเป็นพารามิเตอร์ใหม่
+        """
+        with override_settings(PASSWORD_HASH_PROFILES={'test': {'pbkdf2_sha256': {'iterations': 2000}}}):
+            self.assertTrue(self.user.check_password('testpassword'))
+            upgraded = User.objects.get(pk=self.user.pk)
+            self.assertEqual(identify_hasher(upgraded.password).decode(upgraded.password)['iterations'], 2000)
+            self.assertTrue(upgraded.check_password('testpassword'))
+
+    @override_settings(PASSWORD_REHASH_MODE='inline')
+    def test_inline_rehash_keeps_request_connection(self):
+        """
+        ทดสอบว่าการอัปเกรด hash แบบ inline ไม่ปิด connection ของ request
+        """
+        with override_settings(PASSWORD_HASH_PROFILES={'test': {'pbkdf2_sha256': {'iterations': 2000}}}):
+            with mock.patch('main.hashers.close_old_connections') as close:
+                self.assertTrue(self.user.check_password('testpassword'))
+        close.assert_not_called()
+
+    @override_settings(PASSWORD_REHASH_MODE='inline')
+    def test_rehash_does_not_overwrite_password_change(self):
+        """
+        ทดสอบว่าการอัปเกรด hash ไม่เขียนทับรหัสผ่านที่ถูกเปลี่ยนไปแล้ว
+        """
+        stale = User.objects.get(pk=self.user.pk)
+        self.user.set_password('newpassword')
+        self.user.save()
+        schedule_rehash(stale, 'testpassword')
+        self.assertTrue(User.objects.get(pk=self.user.pk).check_password('newpassword'))
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class UserIdentifierIndexTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='Index@Example.com', national_id='1234567890123', phone_number='+66812345678', password='testpassword'
+        )
+        identifier_filter.sync()  # สร้าง filter ก่อน เพื่อให้นับเฉพาะ query ของ login
+
+    def test_index_created_for_user_columns(self):
+        """
+        ทดสอบว่า identifier ทั้งสามของผู้ใช้ถูกเก็บใน index แบบ normalize แล้ว
+        """
+        self.assertEqual(
+            set(UserIdentifier.objects.filter(user=self.user).values_list('identifier', flat=True)),
+            {'index@example.com', '1234567890123', '+66812345678'},
+        )
+
+    def test_resolve_in_one_query(self):
+        """
+        ทดสอบว่าการค้นหาผู้ใช้ทุกรูปแบบใช้ query เดียว
+        """
+        for value in ('INDEX@example.com', '1234567890123', '+66 81-234-5678'):
+            with self.assertNumQueries(1):
+                self.assertEqual(UserIdentifier.objects.resolve(value), self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual(User.objects.get_by_natural_key('1234567890123'), self.user)
+
+    def test_backend_authenticate_in_one_query(self):
+        """
+        ทดสอบว่า CustomAuthBackend ค้นหาผู้ใช้ด้วย query เดียว
+        """
+        with self.assertNumQueries(1):
+            user = CustomAuthBackend().authenticate(None, username='+66812345678', password='testpassword')
+        self.assertEqual(user, self.user)
+
+    def test_index_follows_changes(self):
+        """
+        ทดสอบว่า index ถูกอัปเดตเมื่อ identifier ของผู้ใช้หรือ LoginMethod เปลี่ยน
+        """
+        self.user.email = 'changed@example.com'
+        self.user.save()
+        self.assertIsNone(UserIdentifier.objects.resolve('index@example.com'))
+        self.assertEqual(UserIdentifier.objects.resolve('changed@example.com'), self.user)
+
+        login_method = LoginMethod.objects.create(user=self.user, login_type=LoginMethod.EMAIL, identifier='alias@example.com')
+        self.assertEqual(UserIdentifier.objects.resolve('alias@example.com'), self.user)
+        login_method.delete()
+        self.assertIsNone(UserIdentifier.objects.resolve('alias@example.com'))
+
+    def test_identifiers_differing_only_in_case_are_rejected(self):
+        """
+        ทดสอบว่า identifier ที่ซ้ำกับของผู้ใช้อื่นหลัง normalize (เช่น email ต่างกันแค่ตัวพิมพ์) ถูกปฏิเสธ
+        ทั้งตอนสมัคร แก้ไขผู้ใช้ และเพิ่ม LoginMethod แทนที่จะสร้างผู้ใช้ที่ login ไม่ได้
+        """
+        client = APIClient()
+        response = client.post('/api/users/', {'email': 'index@example.com', 'password': 'testpassword'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('email', response.data)
+        self.assertFalse(User.objects.filter(email='index@example.com').exists())
+
+        other = User.objects.create_user(email='other@example.com', password='testpassword')
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(other).access_token}')
+        response = client.patch(f'/api/users/{other.id}/', {'email': 'INDEX@example.com'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('email', response.data)
+        response = client.post('/api/login/', {'login_type': LoginMethod.PHONE_NUMBER, 'identifier': '+66 81 234 5678'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('identifier', response.data)
+        self.assertEqual(UserIdentifier.objects.resolve('other@example.com'), other)
+
+    def test_index_conflict_is_not_swallowed(self):
+        """
+        ทดสอบว่าการชนกันใน index ที่ผ่านการตรวจของ serializer มาได้ (เช่นเกิดพร้อมกัน) ไม่เหลือผู้ใช้ที่ไม่มีใน index
+        """
+        with self.assertRaises(IntegrityError):
+            User.objects.create_user(email='INDEX@example.com', password='testpassword')
+        self.assertFalse(User.objects.filter(email='INDEX@example.com').exists())
+
+        with mock.patch.object(UserIdentifier.objects, 'claimed', return_value=set()):
+            response = APIClient().post('/api/users/', {'email': 'iNdEx@example.com', 'password': 'testpassword'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(User.objects.filter(email='iNdEx@example.com').exists())
+
+    def test_unrelated_save_skips_index(self):
+        """
+        ทดสอบว่าการบันทึกที่ไม่ได้เปลี่ยน identifier ไม่แตะ index
+        """
+        user = User.objects.get(pk=self.user.pk)
+        user.first_name = 'Index'
+        with mock.patch.object(UserIdentifier.objects, 'sync_for_user') as sync:
+            user.save()
+            user.save(update_fields=['first_name'])
+        sync.assert_not_called()
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class LoginMethodRecordingTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='recording@example.com', password='testpassword')
+        self.credentials = {'email': self.user.email, 'password': 'testpassword'}
+        identifier_filter.sync()  # สร้าง filter ก่อน เพื่อให้นับเฉพาะ query ของ login
+
+    def tearDown(self):
+        forget_login_methods(self.user.pk)
+
+    @override_settings(LOGIN_METHOD_RECORDING='sync')
+    def test_repeat_login_does_not_write(self):
+        """
+        ทดสอบว่า login ครั้งแรกบันทึก LoginMethod และครั้งถัดไปไม่เขียนฐานข้อมูลอีก
+        """
+        self.assertEqual(self.client.post('/api/token/', self.credentials).status_code, 200)
+        self.assertTrue(LoginMethod.objects.filter(user=self.user, identifier=self.user.email).exists())
+
+        with self.assertNumQueries(1):  # ค้นหาผู้ใช้จาก index เท่านั้น
+            self.assertEqual(self.client.post('/api/token/', self.credentials).status_code, 200)
+
+    @override_settings(LOGIN_METHOD_RECORDING='deferred')
+    def test_deferred_recording_is_batched(self):
+        """
+        ทดสอบว่าโหมด deferred ไม่เขียนระหว่าง request และบันทึก last_used เมื่อ flush
+        """
+        recorder = LoginMethodRecorder(interval=60, batch_size=100, start=False)
+        with mock.patch('main.login_tracking._recorder', recorder):
+            with self.assertNumQueries(1):
+                self.assertEqual(self.client.post('/api/token/', self.credentials).status_code, 200)
+            self.assertFalse(LoginMethod.objects.filter(user=self.user).exists())
+
+            recorder.flush()
+            method = LoginMethod.objects.get(user=self.user)
+            self.assertEqual(method.identifier, self.user.email)
+            first_used = method.last_used
+            self.assertIsNotNone(first_used)
+
+            self.client.post('/api/token/', self.credentials)
+            self.client.post('/api/token/', self.credentials)
+            with self.assertNumQueries(2):  # SELECT + bulk UPDATE รวมเป็นชุดเดียว
+                recorder.flush()
+            self.assertGreater(LoginMethod.objects.get(pk=method.pk).last_used, first_used)
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class UserImportTestCase(TestCase):
+    def setUp(self):
+        User.objects.create_user(email='existing@example.com', password='testpassword')
+
+    def _import(self, content, fmt):
+        return UserImporter(chunk_size=2).run(iter_rows(io.BytesIO(content.encode()), fmt))
+
+    def test_import_csv_reports_row_errors(self):
+        """
+        ทดสอบการนำเข้า CSV: แถวที่ถูกต้องถูกสร้าง แถวที่ผิดถูกรายงานโดยไม่หยุดการนำเข้า
+        """
+        content = (
+            'email,national_id,phone_number,first_name,password\n'
+            'one@example.com,,,One,password123\n'
+            'EXISTING@example.com,,,Dup,password123\n'
+            ',1234567890123,+66812345678,Three,password123\n'
+            'bad-email,,,Bad,password123\n'
+            ',,,Nobody,password123\n'
+            'one@example.com,,,Again,password123\n'
+        )
+        result = self._import(content, 'csv')
+        self.assertEqual(result.created, 2)
+        self.assertEqual([error['line'] for error in result.errors], [3, 5, 6, 7])
+
+        user = User.objects.get(national_id='1234567890123')
+        self.assertTrue(user.check_password('password123'))
+        self.assertTrue(Profile.objects.filter(user=user).exists())
+        self.assertEqual(
+            set(LoginMethod.objects.filter(user=user).values_list('login_type', flat=True)),
+            {LoginMethod.NATIONAL_ID, LoginMethod.PHONE_NUMBER},
+        )
+        self.assertEqual(UserIdentifier.objects.resolve('+66 81 234 5678'), user)
+
+    def test_import_jsonl(self):
+        """
+        ทดสอบการนำเข้า JSON Lines รวมถึงบรรทัดที่ไม่ใช่ JSON
+        """
+        content = '{"email": "json@example.com", "password": "password123"}\nnot json\n'
+        result = self._import(content, 'jsonl')
+        self.assertEqual(result.created, 1)
+        self.assertEqual(result.errors[0]['line'], 2)
+        self.assertTrue(User.objects.filter(email='json@example.com').exists())
+
+    def test_import_endpoint_requires_admin(self):
+        """
+        ทดสอบ endpoint นำเข้าผู้ใช้ (เฉพาะ admin)
+        """
+        client = APIClient()
+        upload = SimpleUploadedFile('users.csv', b'email,password\napi@example.com,password123\n', content_type='text/csv')
+        self.assertEqual(client.post('/api/users/import/', {'file': upload}).status_code, 401)
+
+        admin = User.objects.create_superuser(email='importadmin@example.com', password='adminpassword')
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(admin).access_token}')
+        upload.seek(0)
+        with mock.patch('main.hashers.BoundedHashExecutor.map', autospec=True, side_effect=BoundedHashExecutor.map) as hash_map:
+            response = client.post('/api/users/import/', {'file': upload})
+        hash_map.assert_called_once()  # hash ใน thread pool ที่มีขอบเขต ไม่ fork process ต่อ request
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['created'], 1)
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class ProfileLifecycleQueryTestCase(TestCase):
+    def test_create_user_writes_profile_once(self):
+        """
+        ทดสอบว่าการสร้างผู้ใช้ INSERT Profile เพียงครั้งเดียวและไม่มี UPDATE ตามมา
+        """
+        with CaptureQueriesContext(connection) as queries:
+            user = User.objects.create_user(email='lifecycle@example.com', password='testpassword')
+        # create_user บันทึกใน transaction.atomic (savepoint ภายใน TestCase)
+        statements = [query['sql'] for query in queries.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 3)  # INSERT user, INSERT profile, INSERT identifier index
+        self.assertEqual(sum('main_profile' in sql for sql in statements), 1)
+        self.assertTrue(Profile.objects.filter(user=user).exists())
+
+    def test_update_user_does_not_touch_profile(self):
+        """
+        ทดสอบว่าการแก้ไขผู้ใช้ไม่บันทึก Profile ซ้ำ
+        """
+        user = User.objects.create_user(email='lifecycle2@example.com', password='testpassword')
+        user = User.objects.get(pk=user.pk)
+        user.first_name = 'Changed'
+        with self.assertNumQueries(1):
+            user.save()
+        with self.assertNumQueries(1):
+            user.save(update_fields=['last_login'])
+
+    def test_login_does_not_touch_profile(self):
+        """
+        ทดสอบว่าการ login ซ้ำไม่มี query ที่เกี่ยวกับ Profile
+        """
+        user = User.objects.create_user(email='lifecycle3@example.com', password='testpassword')
+        client = APIClient()
+        credentials = {'email': user.email, 'password': 'testpassword'}
+        client.post('/api/token/', credentials)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(client.post('/api/token/', credentials).status_code, 200)
+        self.assertFalse(any('main_profile' in query['sql'] for query in queries.captured_queries))
+        forget_login_methods(user.pk)
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class UserListPaginationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(email='listadmin@example.com', password='adminpassword')
+        for i in range(5):
+            User.objects.create_user(
+                email=f'list{i}@example.com', password='testpassword', is_active=i % 2 == 0,
+                date_joined=timezone.now() - datetime.timedelta(days=i),
+            )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.admin).access_token}')
+
+    def test_cursor_pages_cover_all_users(self):
+        """
+        ทดสอบว่าการไล่ cursor ทีละหน้าได้ผู้ใช้ครบทุกคนเรียงตาม id
+        """
+        ids, url = [], '/api/users/?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 2)
+            ids += [user['id'] for user in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(ids, list(User.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_page_size_is_capped(self):
+        """
+        ทดสอบว่า page_size ไม่เกินค่าสูงสุดที่กำหนด
+        """
+        with mock.patch.object(UserCursorPagination, 'max_page_size', 3):
+            response = self.client.get('/api/users/?page_size=1000')
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_filters(self):
+        """
+        ทดสอบตัวกรอง is_active, is_staff และช่วง date_joined
+        """
+        response = self.client.get('/api/users/?is_active=false')
+        self.assertEqual(len(response.data['results']), 2)
+        response = self.client.get('/api/users/?is_staff=true')
+        self.assertEqual([user['email'] for user in response.data['results']], [self.admin.email])
+
+        after = (timezone.now() - datetime.timedelta(days=2, hours=12)).isoformat()
+        response = self.client.get('/api/users/', {'date_joined_after': after, 'ordering': '-date_joined'})
+        self.assertEqual(len(response.data['results']), 4)  # admin, list0, list1, list2
+        self.assertEqual(self.client.get('/api/users/?is_active=maybe').status_code, 400)
+
+    def test_impossible_dates_are_rejected(self):
+        """
+        ทดสอบว่าวันที่ที่รูปแบบถูกแต่ไม่มีอยู่จริงได้ 400 ไม่ใช่ 500
+        """
+        for name, value in (('date_joined_after', '2024-02-30'), ('date_joined_before', '2024-13-01T00:00:00')):
+            response = self.client.get('/api/users/', {name: value})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(name, response.data)
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class UserExportTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(email='exportadmin@example.com', password='adminpassword')
+        cls.user = User.objects.create_user(email='export@example.com', national_id='1234567890123', password='testpassword')
+        Profile.objects.filter(user=cls.user).update(bio='Exported bio')
+        LoginMethod.objects.create(user=cls.user, login_type=LoginMethod.NATIONAL_ID, identifier='1234567890123')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.admin).access_token}')
+
+    def test_export_ndjson(self):
+        """
+        ทดสอบการส่งออก NDJSON แบบ streaming พร้อม Profile และ LoginMethod
+        """
+        response = self.client.get('/api/users/export/', {'fields': 'id,email,bio,login_methods'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['email'] for row in rows], [self.admin.email, self.user.email])
+        self.assertEqual(set(rows[1]), {'id', 'email', 'bio', 'login_methods'})
+        self.assertEqual(rows[1]['bio'], 'Exported bio')
+        self.assertEqual(rows[1]['login_methods'], [{'login_type': 'national_id', 'identifier': '1234567890123'}])
+
+    def test_export_csv(self):
+        """
+        ทดสอบการส่งออก CSV ตามฟิลด์ที่เลือก
+        """
+        response = self.client.get('/api/users/export/', {'output': 'csv', 'fields': 'email,national_id'})
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines, ['email,national_id', 'exportadmin@example.com,', 'export@example.com,1234567890123'])
+
+    def test_export_query_count_is_per_chunk(self):
+        """
+        ทดสอบว่าจำนวน query ขึ้นกับจำนวนชุด ไม่ใช่จำนวนแถว
+        """
+        with self.assertNumQueries(2):  # ผู้ใช้ + Profile (join) และ LoginMethod (prefetch) ต่อหนึ่งชุด
+            list(render_export('ndjson', parse_export_fields(None), chunk_size=100))
+
+    def test_export_rejects_unknown_field(self):
+        """
+        ทดสอบว่าฟิลด์ที่ไม่รู้จักได้ 400 และผู้ใช้ทั่วไปเข้าถึงไม่ได้
+        """
+        self.assertEqual(self.client.get('/api/users/export/', {'fields': 'password'}).status_code, 400)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+        self.assertEqual(self.client.get('/api/users/export/').status_code, 403)
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class PayloadCacheTestCase(TestCase):
+    def setUp(self):
+        caches['api'].clear()
+        cache_metrics.reset()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='cached@example.com', password='testpassword')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def test_profile_list_is_cached(self):
+        """
+        ทดสอบว่า request ที่สองอ่านจาก cache โดยไม่ query ฐานข้อมูล
+        """
+        first = self.client.get('/api/profile/')
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/profile/')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(cache_metrics.snapshot(), {'profile.hit': 1, 'profile.miss': 1})
+
+    def test_no_stale_profile_after_update(self):
+        """
+        ทดสอบว่าหลังแก้ไข Profile ผ่าน API ข้อมูลที่อ่านได้เป็นค่าใหม่ทันที
+        """
+        profile = Profile.objects.get(user=self.user)
+        self.client.get('/api/profile/')
+        response = self.client.patch(f'/api/profile/{profile.id}/', {'bio': 'Fresh bio'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/profile/').data[0]['bio'], 'Fresh bio')
+
+    def test_no_stale_write_from_slow_reader(self):
+        """
+        ทดสอบว่า payload ที่ถูกสร้างก่อนการแก้ไขแต่เขียนลง cache หลังการแก้ไขจะไม่ถูกอ่าน
+        """
+        def slow_build():
+            stale = list(ProfileSerializer(Profile.objects.filter(user=self.user), many=True).data)
+            profile = Profile.objects.get(user=self.user)
+            profile.bio = 'Updated meanwhile'
+            profile.save()  # invalidate ระหว่างที่ request แรกยังไม่เขียน cache
+            return stale
+
+        profile_cache.get_or_set(self.user.id, slow_build)
+        self.assertEqual(self.client.get('/api/profile/').data[0]['bio'], 'Updated meanwhile')
+
+    def test_evicted_generation_does_not_revive_old_payloads(self):
+        """
+        ทดสอบว่าเมื่อ key ของ generation ถูก evict payload ของ generation ก่อนหน้าจะไม่กลับมาถูกใช้
+        """
+        generation_key = profile_cache._generation_key(self.user.id)
+        self.assertEqual(profile_cache.get_or_set(self.user.id, lambda: 'first'), 'first')
+        profile_cache.invalidate(self.user.id)
+        self.assertEqual(profile_cache.get_or_set(self.user.id, lambda: 'second'), 'second')
+
+        caches['api'].delete(generation_key)
+        self.assertEqual(profile_cache.get_or_set(self.user.id, lambda: 'third'), 'third')
+        caches['api'].delete(generation_key)
+        profile_cache.invalidate(self.user.id)
+        self.assertEqual(profile_cache.get_or_set(self.user.id, lambda: 'fourth'), 'fourth')
+
+    def test_login_methods_invalidated(self):
+        """
+        ทดสอบว่ารายการ LoginMethod ที่ cache ไว้ถูกล้างเมื่อเพิ่มหรือลบ LoginMethod
+        """
+        self.assertEqual(self.client.get('/api/login/').data, [])
+        method = LoginMethod.objects.create(user=self.user, login_type=LoginMethod.EMAIL, identifier=self.user.email)
+        self.assertEqual(len(self.client.get('/api/login/').data), 1)
+        method.delete()
+        self.assertEqual(self.client.get('/api/login/').data, [])
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class ConditionalRequestTestCase(TestCase):
+    def setUp(self):
+        caches['api'].clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='conditional@example.com', password='testpassword')
+        self.profile = Profile.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def test_user_retrieve_not_modified(self):
+        """
+        ทดสอบว่า GET ซ้ำด้วย If-None-Match ได้ 304 และเมื่อผู้ใช้เปลี่ยนจะได้ 200 พร้อม ETag ใหม่
+        """
+        url = f'/api/users/{self.user.id}/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        self.user.first_name = 'Changed'
+        self.user.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_profile_list_not_modified_without_queries(self):
+        """
+        ทดสอบว่า 304 ของรายการ profile ตัดสินจาก cache โดยไม่ query
+        """
+        etag = self.client.get('/api/profile/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/profile/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_if_match_prevents_lost_update(self):
+        """
+        ทดสอบว่าการแก้ไขด้วย ETag เก่าได้ 412 และไม่เขียนทับค่าที่ถูกแก้ไปก่อนหน้า
+        """
+        url = f'/api/profile/{self.profile.id}/'
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.patch(url, {'bio': 'First writer'}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        response = self.client.patch(url, {'bio': 'Second writer'}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(Profile.objects.get(pk=self.profile.pk).bio, 'First writer')
+
+    def test_concurrent_saves_get_distinct_versions(self):
+        """
+        ทดสอบว่าการบันทึกสองครั้งจาก instance ที่โหลดเวอร์ชันเดียวกันได้ row_version ต่างกัน (ETag ไม่ซ้ำ)
+        """
+        first = Profile.objects.get(pk=self.profile.pk)
+        second = Profile.objects.get(pk=self.profile.pk)
+        first.bio = 'First'
+        first.save()
+        first_version = first.row_version
+        second.bio = 'Second'
+        second.save()
+        self.assertEqual(second.row_version, first_version + 1)
+        self.assertEqual(Profile.objects.get(pk=self.profile.pk).row_version, second.row_version)
+
+
+def make_image(width=800, height=600, fmt='JPEG', color=(200, 80, 40)):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test', AVATAR_PROCESSING_MODE='inline')
+class AvatarVariantTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        caches['api'].clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='avatar@example.com', password='testpassword')
+        self.profile = Profile.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def test_upload_generates_variants_after_commit(self):
+        """
+        ทดสอบว่าการอัปโหลดตอบกลับโดยยังไม่มีภาพย่อ และภาพย่อถูกสร้างหลัง commit ครบทุกขนาด
+        """
+        upload = SimpleUploadedFile('photo.jpg', make_image(), content_type='image/jpeg')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f'/api/profile/{self.profile.id}/', {'avatar': upload}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['avatar_variants'], {})
+
+        variants = self.client.get(f'/api/profile/{self.profile.id}/').data['avatar_variants']
+        self.assertEqual(set(variants), {'64', '128', '512'})
+        profile = Profile.objects.get(pk=self.profile.pk)
+        for size, name in profile.avatar_variants.items():
+            with profile.avatar.storage.open(name) as stored:
+                self.assertEqual(Image.open(stored).size, (int(size), int(size)))
+
+    def test_identical_variants_share_files(self):
+        """
+        ทดสอบว่าชื่อไฟล์ภาพย่อมาจาก hash ของเนื้อหา ภาพเดียวกันจึงได้ไฟล์เดียวกัน
+        """
+        other = User.objects.create_user(email='avatar2@example.com', password='testpassword').profile
+        for profile in (self.profile, other):
+            with self.captureOnCommitCallbacks(execute=True):
+                profile.avatar = SimpleUploadedFile('same.jpg', make_image(), content_type='image/jpeg')
+                profile.save()
+        self.profile.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.profile.avatar_variants, other.avatar_variants)
+
+    def test_saving_without_new_avatar_keeps_variants(self):
+        """
+        ทดสอบว่าการแก้ไขฟิลด์อื่นไม่ล้างภาพย่อและไม่สั่งสร้างใหม่
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.avatar = SimpleUploadedFile('photo.jpg', make_image(), content_type='image/jpeg')
+            self.profile.save()
+        profile = Profile.objects.get(pk=self.profile.pk)
+        variants = profile.avatar_variants
+        profile.bio = 'New bio'
+        with self.captureOnCommitCallbacks() as callbacks:
+            profile.save()
+        self.assertEqual(callbacks, [])
+        self.assertEqual(Profile.objects.get(pk=profile.pk).avatar_variants, variants)
+
+
+def make_png_header(width, height):
+    """
+    PNG ที่ IHDR ระบุขนาดภาพตามต้องการ ตามด้วย IDAT สั้น ๆ (ไม่มีข้อมูล pixel ครบจริง)
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IDAT', zlib.compress(b'\0' * 1024))
+
+
+@override_settings(
+    PASSWORD_HASH_PROFILE='test', AVATAR_PROCESSING_MODE='inline',
+    AVATAR_MAX_UPLOAD_SIZE=200 * 1024, AVATAR_MAX_DIMENSION=2000,
+)
+class AvatarUploadLimitTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        caches['api'].clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='upload@example.com', password='testpassword')
+        self.profile = Profile.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def feed(self, handler, data, chunk_size=64 * 1024):
+        """
+        ส่งข้อมูลเข้า handler ทีละ chunk แบบเดียวกับ MultiPartParser
+        """
+        handler.handle_raw_input(None, {}, None, None)
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file('avatar', 'photo.png', 'image/png', None)
+        for start in range(0, len(data), chunk_size):
+            handler.receive_data_chunk(data[start:start + chunk_size], start)
+        handler.file_complete(len(data))
+
+    def test_oversized_stream_aborts_at_limit(self):
+        """
+        ทดสอบว่าไฟล์ขนาดใหญ่ถูกหยุดทันทีที่เกินขีดจำกัด ไม่ได้อ่านจนจบ
+        """
+        handler = AvatarUploadHandler()
+        data = make_image(fmt='PNG') + b'\0' * (50 * 1024 * 1024)
+        with self.assertRaises(StopUpload):
+            self.feed(handler, data)
+        self.assertEqual(handler.error[0], 'size')
+        self.assertLessEqual(handler.received, 200 * 1024 + 64 * 1024)
+
+    def test_huge_dimensions_rejected_from_header(self):
+        """
+        ทดสอบว่าภาพที่ header ระบุขนาดเกินกำหนดถูกปฏิเสธตั้งแต่ chunk แรก
+        """
+        handler = AvatarUploadHandler()
+        with self.assertRaises(StopUpload):
+            self.feed(handler, make_png_header(100000, 100000) + b'\0' * (150 * 1024))
+        self.assertEqual(handler.error[0], 'dimensions')
+        self.assertEqual(handler.received, 64 * 1024)
+
+    def test_valid_image_streams_to_temp_file(self):
+        """
+        ทดสอบว่าภาพที่ถูกต้องถูกเขียนลง temp file ไม่ได้เก็บไว้ในหน่วยความจำ
+        """
+        handler = AvatarUploadHandler()
+        data = make_image(fmt='PNG')
+        self.feed(handler, data)
+        self.assertIsNone(handler.error)
+        self.assertIsInstance(handler.file, TemporaryUploadedFile)
+        handler.file.seek(0)
+        self.assertEqual(handler.file.read(), data)
+        handler.file.close()
+
+    def test_api_rejects_oversized_upload_with_413(self):
+        """
+        ทดสอบว่า API ตอบ 413 และไม่บันทึก avatar เมื่อไฟล์ใหญ่เกินกำหนด
+        """
+        upload = SimpleUploadedFile('big.png', make_image(fmt='PNG') + b'\0' * (1024 * 1024), content_type='image/png')
+        response = self.client.patch(f'/api/profile/{self.profile.id}/', {'avatar': upload}, format='multipart')
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Profile.objects.get(pk=self.profile.pk).avatar)
+
+    def test_api_rejects_huge_dimensions_with_400(self):
+        """
+        ทดสอบว่า API ตอบ 400 ที่ฟิลด์ avatar เมื่อขนาดภาพเกินกำหนด
+        """
+        upload = SimpleUploadedFile('bomb.png', make_png_header(50000, 50000), content_type='image/png')
+        response = self.client.patch(f'/api/profile/{self.profile.id}/', {'avatar': upload}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('avatar', response.data)
+        self.assertFalse(Profile.objects.get(pk=self.profile.pk).avatar)
+
+    def test_api_rejects_non_image(self):
+        """
+        ทดสอบว่าไฟล์ที่ไม่ใช่ภาพถูกปฏิเสธด้วย 400
+        """
+        upload = SimpleUploadedFile('notes.png', b'not an image' * 100, content_type='image/png')
+        response = self.client.patch(f'/api/profile/{self.profile.id}/', {'avatar': upload}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('avatar', response.data)
+
+    def test_api_accepts_valid_avatar_with_other_fields(self):
+        """
+        ทดสอบว่าภาพที่อยู่ในขีดจำกัดอัปโหลดได้ตามปกติพร้อมฟิลด์อื่น
+        """
+        upload = SimpleUploadedFile('photo.jpg', make_image(), content_type='image/jpeg')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f'/api/profile/{self.profile.id}/', {'avatar': upload, 'bio': 'hello'}, format='multipart'
+            )
+        self.assertEqual(response.status_code, 200)
+        profile = Profile.objects.get(pk=self.profile.pk)
+        self.assertTrue(profile.avatar)
+        self.assertEqual(profile.bio, 'hello')
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test', AVATAR_PROCESSING_MODE='inline')
+class ContentAddressedAvatarTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        caches['api'].clear()
+        self.profiles = [
+            User.objects.create_user(email=f'cas{i}@example.com', password='testpassword').profile for i in range(2)
+        ]
+
+    def set_avatar(self, profile, content, filename='photo.jpg'):
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.avatar = SimpleUploadedFile(filename, content, content_type='image/jpeg')
+            profile.save()
+        profile.refresh_from_db()
+        return profile
+
+    def ref_count(self, name):
+        return StoredFile.objects.filter(name=name).values_list('ref_count', flat=True).first()
+
+    def test_identical_uploads_share_one_file(self):
+        """
+        ทดสอบว่าไฟล์เนื้อหาเดียวกันได้ชื่อเดียวกันตาม hash และถูกนับการอ้างอิงสองครั้ง
+        """
+        content = make_image()
+        first = self.set_avatar(self.profiles[0], content, 'a.jpg')
+        second = self.set_avatar(self.profiles[1], content, 'B.JPG')
+        self.assertEqual(first.avatar.name, second.avatar.name)
+        self.assertRegex(first.avatar.name, r'^avatars/[0-9a-f]{32}\.jpg$')
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'avatars'))), 2)  # ไฟล์ต้นฉบับ + โฟลเดอร์ภาพย่อ
+        self.assertEqual(self.ref_count(first.avatar.name), 2)
+        for name in first.avatar_variants.values():
+            self.assertEqual(self.ref_count(name), 2)
+
+    def test_replaced_avatar_collected_when_unreferenced(self):
+        """
+        ทดสอบว่าไฟล์เดิมยังอยู่ตราบที่มี Profile อื่นใช้ และถูกลบพร้อมภาพย่อเมื่อไม่มีใครใช้แล้ว
+        """
+        content = make_image()
+        first = self.set_avatar(self.profiles[0], content)
+        second = self.set_avatar(self.profiles[1], content)
+        old_files = first.stored_files()
+        storage = first.avatar.storage
+
+        self.set_avatar(first, make_image(color=(10, 20, 30)))
+        self.assertTrue(all(storage.exists(name) for name in old_files))
+        self.assertEqual(self.ref_count(old_files[0]), 1)
+
+        self.set_avatar(second, make_image(color=(10, 20, 30)))
+        self.assertFalse(any(storage.exists(name) for name in old_files))
+        self.assertFalse(StoredFile.objects.filter(name__in=old_files).exists())
+
+    def test_reupload_before_collection_keeps_file(self):
+        """
+        ทดสอบว่าไฟล์ที่รอถูกลบแต่ถูกอัปโหลดซ้ำก่อน collect_files ทำงาน ยังอยู่และถูกนับการอ้างอิง
+        """
+        content = make_image()
+        profile = self.set_avatar(self.profiles[0], content)
+        name = profile.avatar.name
+        storage = profile.avatar.storage
+        with self.captureOnCommitCallbacks() as callbacks:
+            profile.avatar = SimpleUploadedFile('other.jpg', make_image(color=(10, 20, 30)), content_type='image/jpeg')
+            profile.save()
+        self.assertEqual(self.ref_count(name), 0)
+
+        self.assertEqual(storage.save('avatars/again.jpg', ContentFile(content)), name)
+        for callback in callbacks:
+            callback()
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(self.ref_count(name), 1)
+
+    def test_deleting_profile_releases_files(self):
+        """
+        ทดสอบว่าการลบผู้ใช้ (และ Profile) ลบไฟล์ avatar ที่ไม่มีใครใช้แล้ว
+        """
+        profile = self.set_avatar(self.profiles[0], make_image())
+        names = profile.stored_files()
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.user.delete()
+        self.assertFalse(any(profile.avatar.storage.exists(name) for name in names))
+        self.assertFalse(StoredFile.objects.exists())
+
+    def test_avatar_served_with_immutable_cache_control(self):
+        """
+        ทดสอบว่าไฟล์ avatar ถูกส่งพร้อม Cache-Control แบบ immutable
+        """
+        profile = self.set_avatar(self.profiles[0], make_image())
+        response = self.client.get(profile.avatar.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test', PASSWORD_REHASH_MODE='off')
+class AsyncViewTestCase(TestCase):
+    def setUp(self):
+        caches['api'].clear()
+        self.client = AsyncClient()
+        self.user = User.objects.create_user(email='async@example.com', password='testpassword')
+        self.auth = {'authorization': f'Bearer {UserRefreshToken.for_user(self.user).access_token}'}
+
+    async def test_login_hashes_off_the_event_loop(self):
+        """
+        ทดสอบว่า login แบบ async ออก token และตรวจรหัสผ่านใน thread ของ hash executor
+        """
+        from . import hashers
+        threads = []
+        verify = hashers._verify
+
+        def tracking_verify(*args):
+            threads.append(threading.current_thread().name)
+            return verify(*args)
+
+        with mock.patch.object(hashers, '_verify', tracking_verify):
+            response = await self.client.post(
+                '/api/async/token/', {'email': 'async@example.com', 'password': 'testpassword'},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.json())
+        self.assertTrue(threads[0].startswith('password-hash'))
+
+    async def test_login_rejects_bad_credentials(self):
+        """
+        ทดสอบว่ารหัสผ่านผิดได้ 400 ในรูปแบบเดียวกับ view แบบ sync
+        """
+        response = await self.client.post(
+            '/api/async/token/', {'email': 'async@example.com', 'password': 'wrong'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('non_field_errors', response.json())
+
+    async def test_login_sheds_load_when_hash_queue_full(self):
+        """
+        ทดสอบว่าเมื่อคิว hash เต็ม login ได้ 503 พร้อม Retry-After แทนการรอคิว
+        """
+        with mock.patch('main.hashers.get_hash_executor', return_value=BoundedHashExecutor(1, 0)):
+            response = await self.client.post(
+                '/api/async/token/', {'email': 'async@example.com', 'password': 'testpassword'},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    async def test_requires_token(self):
+        response = await self.client.get('/api/async/profile/')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_writes_skip_csrf_checks(self):
+        """
+        ทดสอบว่า client ที่ถูกตรวจ CSRF (เช่น browser) เขียนผ่าน async view ได้เหมือน view ของ DRF
+        """
+        client = AsyncClient(enforce_csrf_checks=True)
+        response = await client.post(
+            '/api/async/token/', {'email': 'nobody@example.com', 'password': 'guess'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        response = await client.patch('/api/async/profile/', {'bio': 'csrf'}, content_type='application/json', headers=self.auth)
+        self.assertEqual(response.status_code, 200)
+
+    async def test_token_without_claims(self):
+        """
+        ทดสอบว่า token ที่ออกก่อนมี claim perms_version (ต้องอ่านผู้ใช้จากฐานข้อมูล) ใช้กับ async view ได้
+        """
+        token = await sync_to_async(lambda: UserRefreshToken.for_user(self.user).access_token)()
+        for claim in ('perms_version', 'is_active', 'is_staff', 'is_superuser'):
+            del token[claim]
+        response = await self.client.get('/api/async/profile/', headers={'authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 200)
+
+    async def test_profile_conditional_get_and_patch(self):
+        """
+        ทดสอบว่า profile แบบ async ตอบ ETag, 304 และบันทึกการแก้ไขได้
+        """
+        response = await self.client.get('/api/async/profile/', headers=self.auth)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = await self.client.get('/api/async/profile/', headers={**self.auth, 'if-none-match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = await self.client.patch(
+            '/api/async/profile/', {'bio': 'async bio'}, content_type='application/json', headers=self.auth
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['bio'], 'async bio')
+        self.assertNotEqual(response['ETag'], etag)
+        response = await self.client.get('/api/async/profile/', headers=self.auth)
+        self.assertEqual(response.json()['bio'], 'async bio')
+
+    async def test_profile_conditional_patch(self):
+        """
+        ทดสอบว่า PATCH ที่ If-Match ตรงกันบันทึกและตอบ 200 พร้อม ETag ใหม่ ส่วน ETag เก่าได้ 412
+        """
+        etag = (await self.client.get('/api/async/profile/', headers=self.auth))['ETag']
+        response = await self.client.patch(
+            '/api/async/profile/', {'bio': 'matched'}, content_type='application/json',
+            headers={**self.auth, 'if-match': etag},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['bio'], 'matched')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('Last-Modified', response)
+
+        response = await self.client.patch(
+            '/api/async/profile/', {'bio': 'stale'}, content_type='application/json',
+            headers={**self.auth, 'if-match': etag},
+        )
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual((await Profile.objects.aget(user=self.user)).bio, 'matched')
+
+    @override_settings(AVATAR_MAX_UPLOAD_SIZE=100 * 1024)
+    async def test_profile_avatar_upload_limit(self):
+        """
+        ทดสอบว่า multipart ใน view แบบ async ผ่าน AvatarUploadHandler เช่นเดียวกับ view แบบ sync
+        """
+        upload = SimpleUploadedFile('big.png', make_image(fmt='PNG') + b'\0' * (512 * 1024), content_type='image/png')
+        response = await self.client.patch(
+            '/api/async/profile/', encode_multipart(BOUNDARY, {'avatar': upload}),
+            content_type=MULTIPART_CONTENT, headers=self.auth,
+        )
+        self.assertEqual(response.status_code, 413)
+
+    async def test_login_method_endpoints(self):
+        """
+        ทดสอบการสร้าง ดู แก้ไข และลบ LoginMethod ผ่าน view แบบ async
+        """
+        response = await self.client.post(
+            '/api/async/login/', {'login_type': 'email', 'identifier': 'alt@example.com'},
+            content_type='application/json', headers=self.auth,
+        )
+        self.assertEqual(response.status_code, 201)
+        pk = response.json()['id']
+
+        response = await self.client.get('/api/async/login/', headers=self.auth)
+        self.assertEqual([item['identifier'] for item in response.json()], ['alt@example.com'])
+
+        response = await self.client.patch(
+            f'/api/async/login/{pk}/', {'identifier': 'other@example.com'}, content_type='application/json',
+            headers=self.auth,
+        )
+        self.assertEqual(response.json()['identifier'], 'other@example.com')
+
+        response = await self.client.delete(f'/api/async/login/{pk}/', headers=self.auth)
+        self.assertEqual(response.status_code, 204)
+        response = await self.client.get(f'/api/async/login/{pk}/', headers=self.auth)
+        self.assertEqual(response.status_code, 404)
+
+
+class SQLitePragmaTestCase(TestCase):
+    # TestCase อยู่ใน transaction จึงทดสอบได้เฉพาะ pragma ที่เปลี่ยนระหว่าง transaction ได้
+    @override_settings(SQLITE_PRAGMAS={'cache_size': -1234, 'wal_autocheckpoint': 500})
+    def test_pragmas_applied_to_connection(self):
+        """
+        ทดสอบว่า pragma ใน SQLITE_PRAGMAS ถูกตั้งให้ connection ของ SQLite
+        """
+        from .signals import apply_sqlite_pragmas
+        apply_sqlite_pragmas(sender=type(connection), connection=connection)
+        with connection.cursor() as cursor:
+            self.assertEqual(cursor.execute('PRAGMA cache_size').fetchone()[0], -1234)
+            self.assertEqual(cursor.execute('PRAGMA wal_autocheckpoint').fetchone()[0], 500)
+
+    @override_settings(SQLITE_PRAGMAS={})
+    def test_default_profile_leaves_connection_untouched(self):
+        from .signals import apply_sqlite_pragmas
+        with CaptureQueriesContext(connection) as queries:
+            apply_sqlite_pragmas(sender=type(connection), connection=connection)
+        self.assertEqual(len(queries), 0)
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test', DATABASE_REPLICAS=['replica1'])
+class ReplicaRoutingTestCase(TestCase):
+    """
+    ใช้ไฟล์ SQLite เปล่าเป็น replica: ข้อมูลที่อ่านได้จาก replica จึงว่างเสมอ ส่วน primary มีข้อมูลจริง
+    replica ถูกเพิ่มหลัง setUpClass จึงไม่ถูกครอบด้วย transaction ของ TestCase (มีแค่ schema ไม่มีการเขียน)
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.replica_dir = tempfile.mkdtemp()
+        connections.settings['replica1'] = dict(
+            connections.settings['default'], NAME=os.path.join(cls.replica_dir, 'replica.sqlite3'), TEST={}
+        )
+        with connections['replica1'].schema_editor() as editor:
+            for model in apps.get_models():
+                editor.create_model(model)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica1'].close()
+        del connections['replica1']
+        del connections.settings['replica1']
+        shutil.rmtree(cls.replica_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        caches['api'].clear()
+        routers.health.reset()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='replica@example.com', password='testpassword')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def read_user(self):
+        """
+        GET ที่ไม่ผ่าน payload cache: 404 เมื่ออ่านจาก replica (ว่าง) และ 200 เมื่ออ่านจาก primary
+        """
+        return self.client.get(f'/api/users/{self.user.id}/').status_code
+
+    def test_get_reads_from_replica(self):
+        """
+        ทดสอบว่า GET อ่านจาก replica ส่วนโค้ดนอก request อ่านจาก primary
+        """
+        self.assertEqual(self.read_user(), 404)
+        self.assertTrue(Profile.objects.filter(user=self.user).exists())
+
+    def test_cached_payloads_built_from_primary(self):
+        """
+        ทดสอบว่า payload ที่ cache ไว้ถูกสร้างจาก primary แม้ request จะอ่านจาก replica
+        (payload จาก replica ที่ล่าช้าจะถูกส่งให้ทุก request จนหมดอายุ)
+        """
+        self.assertEqual(self.read_user(), 404)
+        self.assertEqual(len(self.client.get('/api/profile/').data), 1)
+        LoginMethod.objects.create(user=self.user, login_type=LoginMethod.EMAIL, identifier=self.user.email)
+        self.assertEqual(len(self.client.get('/api/login/').data), 1)
+        self.assertEqual(self.client.get('/api/async/profile/').status_code, 200)
+        self.assertEqual(self.read_user(), 404)
+
+    def test_reads_pinned_to_primary_after_write(self):
+        """
+        ทดสอบ read-your-writes: หลัง PATCH ผู้ใช้อ่านจาก primary จนกว่า pin จะหมดอายุ
+        """
+        profile = Profile.objects.get(user=self.user)
+        response = self.client.patch(f'/api/profile/{profile.id}/', {'bio': 'written'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.read_user(), 200)
+
+        caches['api'].delete(f'db-pin:{self.user.id}')
+        del self.client.cookies[settings.REPLICA_PIN_COOKIE]
+        self.assertEqual(self.read_user(), 404)
+
+    def test_pin_reaches_other_workers(self):
+        """
+        ทดสอบว่า pin ไปกับ cookie: worker อื่นที่ไม่เห็น pin ใน cache ของ worker ที่เขียน (locmem) ยังอ่านจาก primary
+        """
+        profile = Profile.objects.get(user=self.user)
+        response = self.client.patch(f'/api/profile/{profile.id}/', {'bio': 'written'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.cookies[settings.REPLICA_PIN_COOKIE]['max-age'], settings.REPLICA_PIN_SECONDS)
+
+        caches['api'].clear()  # เหมือน request ถัดไปไปถึง process อื่น
+        self.assertEqual(self.read_user(), 200)
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        """
+        ทดสอบว่า replica ที่ lag เกิน REPLICA_MAX_LAG หรือเชื่อมต่อไม่ได้จะไม่ถูกใช้
+        """
+        with mock.patch('main.routers.replica_lag', return_value=30.0):
+            self.assertEqual(self.read_user(), 200)
+
+        routers.health.reset()
+        with mock.patch('main.routers.replica_lag', side_effect=OSError('down')):
+            self.assertEqual(self.read_user(), 200)
+
+    def test_lag_checks_are_cached(self):
+        with mock.patch('main.routers.replica_lag', return_value=0.0) as lag:
+            for _ in range(3):
+                self.read_user()
+        self.assertEqual(lag.call_count, 1)
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        caches['api'].clear()
+        registry.reset()
+        self.user = User.objects.create_user(email='metrics@example.com', password='testpassword')
+        self.token = str(UserRefreshToken.for_user(self.user).access_token)
+
+    def client_for(self):
+        # สร้าง client ภายใน enforce_query_budgets() เพื่อให้ middleware ถูกโหลดตาม setting
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        return client
+
+    @enforce_query_budgets()
+    def test_server_timing_header(self):
+        """
+        ทดสอบว่า response มี Server-Timing ที่บอกจำนวน query, เวลา DB, serializer และเวลารวม
+        """
+        response = self.client_for().get('/api/login/')
+        self.assertEqual(response.status_code, 200)
+        timing = response['Server-Timing']
+        self.assertIn('desc="1 queries"', timing)
+        for metric in ('db;dur=', 'serializer;dur=', 'total;dur='):
+            self.assertIn(metric, timing)
+
+    @enforce_query_budgets()
+    def test_metrics_endpoint(self):
+        client = self.client_for()
+        client.get('/api/login/')
+        client.get('/api/login/')
+        body = client.get('/api/metrics/').content.decode()
+        self.assertIn('msoapi_requests_total{view="login-list",method="GET",status="200"} 2', body)
+        self.assertIn('msoapi_request_duration_seconds_count{view="login-list",method="GET"} 2', body)
+        self.assertIn('msoapi_db_queries_total{view="login-list"} 1', body)  # ครั้งที่สองมาจาก cache
+
+        self.assertEqual(client.get('/api/metrics/', REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+    @enforce_query_budgets()
+    def test_query_budget_exceeded(self):
+        """
+        ทดสอบว่า view ที่ใช้ query เกิน query_budgets ทำให้เทสต์ล้ม
+        """
+        client = self.client_for()
+        with mock.patch.object(LoginMethodViewSet, 'query_budgets', {'list': 0}):
+            with self.assertRaises(QueryBudgetExceeded):
+                client.get('/api/login/')
+
+    def test_disabled_by_default(self):
+        """
+        ทดสอบว่าเมื่อปิด instrumentation จะไม่มี header และไม่เก็บสถิติ
+        """
+        response = self.client_for().get('/api/login/')
+        self.assertNotIn('Server-Timing', response)
+        self.assertNotIn('login-list', registry.render())
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test', LOGIN_IDENTIFIER_ATTEMPTS=5, LOGIN_IP_FAILURES=50,
+                   LOGIN_THROTTLE_WINDOW=300, LOGIN_LOCKOUT_BASE=60, LOGIN_LOCKOUT_MAX=3600)
+class LoginThrottleTestCase(TestCase):
+    def setUp(self):
+        login_throttle.reset()
+        self.addCleanup(login_throttle.reset)
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='victim@example.com', password='testpassword')
+        self.now = 1_000_000.0
+        clock = mock.Mock(time=lambda: self.now, monotonic=lambda: self.now)
+        patcher = mock.patch('main.throttling.time', clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def login(self, password='wrongpassword', email='victim@example.com', **extra):
+        return self.client.post('/api/token/', {'email': email, 'password': password}, format='json', **extra)
+
+    def test_identifier_burst_is_locked_before_hashing(self):
+        """
+        จำลองการเดารหัสผ่านของบัญชีเดียว: ครั้งที่เกินกำหนดได้ 429 โดยไม่ตรวจรหัสผ่าน
+        แม้จะส่งรหัสผ่านที่ถูกต้องในระหว่างที่ถูกล็อก
+        """
+        for _ in range(5):
+            self.assertEqual(self.login().status_code, 400)
+        with mock.patch.object(User, 'check_password') as check_password:
+            response = self.login()
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '60')
+            self.assertEqual(self.login(password='testpassword').status_code, 429)
+        check_password.assert_not_called()
+
+        self.now += 61
+        self.assertEqual(self.login(password='testpassword').status_code, 200)
+
+    def test_lockout_doubles_on_repeat(self):
+        for expected in ('60', '120', '240'):
+            responses = [self.login() for _ in range(6)]
+            self.assertEqual(responses[-1].status_code, 429)
+            self.assertEqual(responses[-1]['Retry-After'], expected)
+            self.now += int(expected) + 1
+
+    def test_success_resets_identifier_attempts(self):
+        for _ in range(4):
+            self.login()
+        self.assertEqual(self.login(password='testpassword').status_code, 200)
+        for _ in range(4):
+            self.assertEqual(self.login().status_code, 400)
+
+    def test_sliding_window(self):
+        """
+        ทดสอบว่าความพยายามใน window ก่อนหน้ายังถูกนับตามสัดส่วนเวลาที่เหลือ
+        """
+        self.now = 300_000.0 + 299  # ปลาย window
+        for _ in range(5):
+            self.login()
+        self.now += 30  # 29 วินาทีใน window ใหม่: ยังนับ window ก่อนหน้า ~90%
+        self.assertEqual(self.login().status_code, 429)
+
+    @override_settings(LOGIN_IP_FAILURES=10)
+    def test_ip_burst_across_identifiers(self):
+        """
+        จำลอง credential stuffing จาก IP เดียวหลายบัญชี: IP ถูกปฏิเสธ แต่ IP อื่นยัง login ได้
+        """
+        for i in range(10):
+            self.assertEqual(self.login(email=f'user{i}@example.com').status_code, 400)
+        self.assertEqual(self.login(email='other@example.com').status_code, 429)
+        self.assertEqual(self.login(password='testpassword', REMOTE_ADDR='10.0.0.2').status_code, 200)
+
+    @override_settings(LOGIN_THROTTLE_STORE='cache')
+    def test_shared_cache_store(self):
+        caches['api'].clear()
+        login_throttle.reset()
+        for _ in range(5):
+            self.login()
+        self.assertEqual(self.login().status_code, 429)
+
+    @override_settings(LOGIN_THROTTLE_ENABLED=False)
+    def test_disabled(self):
+        for _ in range(10):
+            self.assertEqual(self.login().status_code, 400)
+
+    async def test_async_login_is_throttled(self):
+        client = AsyncClient()
+        data = {'email': 'victim@example.com', 'password': 'wrongpassword'}
+        for _ in range(5):
+            response = await client.post('/api/async/token/', data, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        response = await client.post('/api/async/token/', data, content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+
+
+class LocalCounterStoreTestCase(TestCase):
+    def test_lru_eviction_and_expiry(self):
+        store = LocalCounterStore(max_entries=2)
+        store.incr('a', 60)
+        store.incr('b', 60)
+        store.get_many(['a'])  # a ถูกใช้ล่าสุด
+        store.incr('c', 60)
+        self.assertEqual(store.get_many(['a', 'b', 'c']), {'a': 1, 'c': 1})
+
+        with mock.patch('main.throttling.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(store.get_many(['a', 'c']), {})
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class IdentifierFilterTestCase(TestCase):
+    def setUp(self):
+        login_throttle.reset()
+        identifier_filter.reset()
+        self.addCleanup(identifier_filter.reset)
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='known@example.com', password='testpassword')
+        self.client.post('/api/token/', {'email': 'known@example.com', 'password': 'testpassword'}, format='json')
+
+    def test_unknown_identifier_skips_lookup_but_hashes(self):
+        """
+        ทดสอบว่า login ด้วย identifier ที่ไม่มีอยู่ไม่ query เลย แต่ยัง hash รหัสผ่านเพื่อให้ใช้เวลาเท่ากัน
+        """
+        with mock.patch('main.hashers.make_password', wraps=make_password) as dummy_hash:
+            with self.assertNumQueries(0):
+                response = self.client.post('/api/token/', {'email': 'nobody@example.com', 'password': 'guess'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        dummy_hash.assert_called_once_with('guess')
+
+    def test_new_identifiers_are_known_immediately(self):
+        user = User.objects.create_user(phone_number='+66812345678', password='testpassword')
+        LoginMethod.objects.create(user=user, login_type=LoginMethod.EMAIL, identifier='Alias@Example.com')
+        self.assertEqual(UserIdentifier.objects.resolve_login('+66 81 234 5678'), user)
+        self.assertEqual(UserIdentifier.objects.resolve_login('alias@example.com'), user)
+
+    def test_catches_up_with_rows_from_other_processes(self):
+        """
+        ทดสอบว่าแถวที่ process อื่นเพิ่ม (ไม่ผ่าน signal ของ process นี้) ถูกพบทันทีที่ generation กลางเปลี่ยน
+        """
+        other = User.objects.create_user(email='other@example.com', password='testpassword')
+        UserIdentifier.objects.bulk_create([UserIdentifier(user=other, identifier='elsewhere@example.com')])
+        identifier_filter.publish()  # เหมือน on_commit ของ process ที่เขียน
+        self.assertEqual(UserIdentifier.objects.resolve_login('elsewhere@example.com'), other)
+        self.assertEqual(UserIdentifier.objects.resolve_many(['elsewhere@example.com', 'nobody@example.com']),
+                         {'elsewhere@example.com': other.id})
+
+    def test_unpublished_rows_found_after_sync_interval(self):
+        """
+        ทดสอบว่าแถวที่ไม่ได้แจ้งผ่าน generation กลาง (process อื่นบน cache แยก) ถูกตอบว่าไม่มีจากหน่วยความจำ
+        จนกว่าจะครบ IDENTIFIER_FILTER_SYNC_INTERVAL
+        """
+        other = User.objects.create_user(email='other@example.com', password='testpassword')
+        UserIdentifier.objects.bulk_create([UserIdentifier(user=other, identifier='elsewhere@example.com')])
+        with self.assertNumQueries(0):
+            self.assertIsNone(UserIdentifier.objects.resolve_login('elsewhere@example.com'))
+        with override_settings(IDENTIFIER_FILTER_SYNC_INTERVAL=0):
+            self.assertEqual(UserIdentifier.objects.resolve_login('elsewhere@example.com'), other)
+
+    def test_concurrent_miss_does_not_wait_for_sync(self):
+        """
+        ทดสอบว่าระหว่างที่ thread อื่นกำลัง sync คำถามที่ต้อง sync จะไม่รอ แต่ให้การค้นหาตามปกติตัดสิน
+        """
+        identifier_filter.publish()
+        with identifier_filter._sync_lock:
+            self.assertTrue(identifier_filter.might_contain('nobody@example.com'))
+        self.assertFalse(identifier_filter.might_contain('nobody@example.com'))
+
+    def test_rows_committed_below_the_synced_id_are_found(self):
+        """
+        ทดสอบว่าแถวที่ได้ id ก่อนแต่ commit หลังแถวที่ id สูงกว่าถูก sync ไปแล้ว (เช่นการนำเข้าที่นาน) ยังถูกพบ
+        """
+        other = User.objects.create_user(email='late@example.com', password='testpassword')
+        top = UserIdentifier.objects.order_by('-id').values_list('id', flat=True).first()
+        UserIdentifier.objects.bulk_create([UserIdentifier(id=top + 10, user=other, identifier='early@example.com')])
+        identifier_filter.publish()
+        self.assertIsNone(UserIdentifier.objects.resolve_login('missing@example.com'))  # sync เห็น id top + 10
+
+        UserIdentifier.objects.bulk_create([UserIdentifier(id=top + 5, user=other, identifier='slow@example.com')])
+        identifier_filter.publish()
+        self.assertEqual(UserIdentifier.objects.resolve_login('slow@example.com'), other)
+        with override_settings(IDENTIFIER_FILTER_GAP_TIMEOUT=0):
+            identifier_filter.sync()
+        self.assertEqual(identifier_filter._gaps, [])
+
+    def test_imported_users_can_log_in(self):
+        rows = iter_rows(io.BytesIO(b'email,password\nimported@example.com,importpassword\n'), 'csv')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(UserImporter(chunk_size=10).run(rows).created, 1)
+        response = self.client.post('/api/token/', {'email': 'imported@example.com', 'password': 'importpassword'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_changed_identifiers_count_as_removed(self):
+        identifier_filter.sync()
+        self.user.email = 'renamed@example.com'
+        self.user.save()
+        self.assertEqual(identifier_filter._removed, 1)
+
+    async def test_async_login_unknown_identifier(self):
+        response = await AsyncClient().post(
+            '/api/async/token/', {'email': 'nobody@example.com', 'password': 'guess'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f'user{i}@example.com')
+        self.assertTrue(all(f'user{i}@example.com' in bloom for i in range(1000)))
+        false_positives = sum(f'stranger{i}@example.com' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class RevokedTokenTestCase(TestCase):
+    def setUp(self):
+        recently_revoked.clear()
+        self.addCleanup(recently_revoked.clear)
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='refresh@example.com', password='testpassword')
+        self.refresh = str(UserRefreshToken.for_user(self.user))
+
+    def test_refresh_rotates_and_revokes(self):
+        with enforce_query_budgets():
+            response = APIClient().post('/api/token/refresh/', {'refresh': self.refresh}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.data)
+        self.assertNotEqual(response.data['refresh'], self.refresh)
+        self.assertTrue(RevokedToken.objects.filter(jti=UserRefreshToken(self.refresh)['jti']).exists())
+
+        response = self.client.post('/api/token/refresh/', {'refresh': response.data['refresh']}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_replay_is_rejected(self):
+        self.client.post('/api/token/refresh/', {'refresh': self.refresh}, format='json')
+        recently_revoked.clear()  # เหมือน replay ไปยัง process อื่น
+        response = self.client.post('/api/token/refresh/', {'refresh': self.refresh}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_recent_replay_is_rejected_without_queries(self):
+        self.client.post('/api/token/refresh/', {'refresh': self.refresh}, format='json')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/token/refresh/', {'refresh': self.refresh}, format='json')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(len(queries), 0)
+
+    def test_inactive_user_is_rejected(self):
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        response = self.client.post('/api/token/refresh/', {'refresh': self.refresh}, format='json')
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(RevokedToken.objects.exists())
+
+    def test_invalid_token_is_rejected(self):
+        response = self.client.post('/api/token/refresh/', {'refresh': 'not-a-token'}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_prune_deletes_only_expired_entries(self):
+        now = timezone.now()
+        RevokedToken.objects.bulk_create(
+            [RevokedToken(jti=f'expired-{i}', expires_at=now - datetime.timedelta(minutes=1)) for i in range(5)]
+            + [RevokedToken(jti='live', expires_at=now + datetime.timedelta(days=1))]
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(RevokedToken.objects.prune(batch_size=2), 5)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('DELETE')]), 3)
+        self.assertEqual(list(RevokedToken.objects.values_list('jti', flat=True)), ['live'])
+        self.assertFalse(RevokedToken.objects.revoke('live', now))
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class TokenEpochTestCase(TestCase):
+    def setUp(self):
+        caches['api'].clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='epoch@example.com', password='testpassword')
+        self.refresh = UserRefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.refresh.access_token}')
+
+    def test_password_change_revokes_tokens(self):
+        self.assertEqual(self.client.get('/api/profile/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.set_password('newpassword')
+            self.user.save(update_fields=['password'])
+        self.assertEqual(self.client.get('/api/profile/').status_code, 401)
+        response = APIClient().post('/api/token/refresh/', {'refresh': str(self.refresh)}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+        login = APIClient().post('/api/token/', {'email': 'epoch@example.com', 'password': 'newpassword'}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {login.data["access"]}')
+        self.assertEqual(self.client.get('/api/profile/').status_code, 200)
+
+    def test_deactivation_revokes_tokens(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.user.token_epoch, 1)
+        self.assertEqual(self.client.get('/api/profile/').status_code, 401)
+
+    def test_other_changes_keep_tokens(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.user.first_name = 'Somchai'
+            self.user.is_staff = True
+            self.user.save()
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.user.token_epoch, 0)
+        self.assertEqual(token_epochs.get(self.user.id), 0)
+
+    def test_rolled_back_revocation_is_not_published(self):
+        """
+        ทดสอบว่า epoch ที่เพิ่มใน transaction ที่ rollback ไม่ถูกเขียนลง cache (token ที่ออกไปยังใช้ได้)
+        """
+        self.assertEqual(token_epochs.get(self.user.id), 0)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    self.user.set_password('newpassword')
+                    self.user.save()
+                    raise IntegrityError()
+            except IntegrityError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(token_epochs.get(self.user.id), 0)
+        self.assertEqual(self.client.get('/api/profile/').status_code, 200)
+
+    def test_revoke_everywhere(self):
+        with enforce_query_budgets():
+            response = self.client.post('/api/token/revoke/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(User.objects.get(pk=self.user.pk).token_epoch, 1)
+        self.assertEqual(self.client.get('/api/profile/').status_code, 401)
+
+    def test_epoch_check_is_cached(self):
+        """
+        ทดสอบว่า epoch ถูกอ่านจากฐานข้อมูลครั้งเดียวเมื่อ cache ว่าง จากนั้นไม่ query อีก
+        """
+        caches['api'].clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(token_epochs.get(self.user.id), 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(token_epochs.get(self.user.id), 0)
+
+    def test_deleted_user_is_rejected(self):
+        self.user.delete()
+        self.assertIsNone(token_epochs.get(self.refresh['user_id']))
+        self.assertEqual(self.client.get('/api/profile/').status_code, 401)
+
+    async def test_async_view_rejects_revoked_token(self):
+        client = AsyncClient()
+        auth = {'authorization': f'Bearer {self.refresh.access_token}'}
+        self.assertEqual((await client.get('/api/async/profile/', headers=auth)).status_code, 200)
+        await sync_to_async(User.objects.revoke_tokens)(self.user.id)
+        self.assertEqual((await client.get('/api/async/profile/', headers=auth)).status_code, 401)
+
+
+@skipUnless(jwt.algorithms.has_crypto, "cryptography is not installed")
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class KeyRingTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+        cls.key_dir = tempfile.mkdtemp()
+
+        def write(name, key, public=False):
+            if public:
+                data = key.public_key().public_bytes(
+                    serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo,
+                )
+            else:
+                data = key.private_bytes(
+                    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+                )
+            path = os.path.join(cls.key_dir, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            return path
+
+        old, new = ed25519.Ed25519PrivateKey.generate(), ed25519.Ed25519PrivateKey.generate()
+        cls.old_key = write('old.pem', old)
+        cls.old_public = write('old.pub', old, public=True)
+        cls.new_key = write('new.pem', new)
+        cls.rsa_key = write('rsa.pem', rsa.generate_private_key(public_exponent=65537, key_size=2048))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.key_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        caches['api'].clear()
+        self.user = User.objects.create_user(email='keyring@example.com', password='testpassword')
+        self.use_keys(self.old_key)
+        self.addCleanup(key_ring.reset)
+
+    def use_keys(self, *paths):
+        override = override_settings(JWT_KEY_FILES=list(paths))
+        override.enable()
+        self.addCleanup(override.disable)
+        key_ring.reset()
+
+    def get_profile(self, token):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        return client.get('/api/profile/')
+
+    def test_tokens_verify_against_jwks(self):
+        """
+        ทดสอบว่าบริการอื่นตรวจ token ได้เองด้วย JWKS โดยไม่ต้องเรียก API
+        """
+        response = APIClient().post('/api/token/', {'email': 'keyring@example.com', 'password': 'testpassword'}, format='json')
+        access = response.data['access']
+        header = jwt.get_unverified_header(access)
+        self.assertEqual(header['alg'], 'EdDSA')
+
+        jwks = json.loads(self.client.get('/api/.well-known/jwks.json').content)
+        key = jwt.PyJWKSet.from_dict(jwks)[header['kid']]
+        self.assertEqual(jwt.decode(access, key.key, algorithms=['EdDSA'])['user_id'], str(self.user.id))
+        self.assertEqual(self.get_profile(access).status_code, 200)
+
+    def test_rotation_keeps_previous_key_for_verification(self):
+        token = str(UserRefreshToken.for_user(self.user).access_token)
+        self.use_keys(self.new_key, self.old_public)
+        new_token = str(UserRefreshToken.for_user(self.user).access_token)
+        self.assertNotEqual(jwt.get_unverified_header(new_token)['kid'], jwt.get_unverified_header(token)['kid'])
+        self.assertEqual(self.get_profile(token).status_code, 200)
+        self.assertEqual(len(json.loads(self.client.get('/api/.well-known/jwks.json').content)['keys']), 2)
+
+        self.use_keys(self.new_key)
+        self.assertEqual(self.get_profile(token).status_code, 401)
+
+    def test_rsa_key(self):
+        self.use_keys(self.rsa_key)
+        token = UserRefreshToken.for_user(self.user).access_token
+        self.assertEqual(jwt.get_unverified_header(str(token))['alg'], 'RS256')
+        self.assertEqual(self.get_profile(token).status_code, 200)
+
+    def test_legacy_hs256_tokens(self):
+        self.use_keys()
+        token = str(UserRefreshToken.for_user(self.user).access_token)
+        self.use_keys(self.old_key)
+        self.assertEqual(self.get_profile(token).status_code, 401)
+        with override_settings(JWT_ACCEPT_LEGACY_HS256=True):
+            self.assertEqual(self.get_profile(token).status_code, 200)
+
+    def test_jwks_is_cacheable(self):
+        response = self.client.get('/api/.well-known/jwks.json')
+        self.assertIn('max-age=', response['Cache-Control'])
+        response = self.client.get('/api/.well-known/jwks.json', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_verification_does_not_parse_keys(self):
+        token = str(UserRefreshToken.for_user(self.user).access_token)
+        with mock.patch('main.keyring.SigningKey.from_pem') as from_pem:
+            self.assertEqual(self.get_profile(token).status_code, 200)
+        from_pem.assert_not_called()
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class UserLookupTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(email='lookupadmin@example.com', password='adminpassword')
+        self.users = [
+            User.objects.create_user(email=f'lookup{i}@example.com', national_id=f'{i:013d}', password='testpassword')
+            for i in range(3)
+        ]
+        Profile.objects.filter(user=self.users[0]).update(bio='First bio')
+        identifier_filter.sync()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.admin).access_token}')
+
+    def lookup(self, data, **params):
+        return self.client.post(f"/api/users/lookup/?{'&'.join(f'{k}={v}' for k, v in params.items())}", data, format='json')
+
+    def test_results_follow_request_order_and_report_misses(self):
+        first, second, third = self.users
+        response = self.lookup({
+            'ids': [third.id, 999999, first.id],
+            'identifiers': ['LOOKUP1@example.com', 'nobody@example.com', '0000000000002'],
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([record and record['id'] for record in response.data['ids']], [third.id, None, first.id])
+        self.assertEqual([record and record['id'] for record in response.data['identifiers']], [second.id, None, third.id])
+        self.assertEqual(response.data['missing'], {'ids': [999999], 'identifiers': ['nobody@example.com']})
+        self.assertNotIn('password', response.data['ids'][0])
+        self.assertNotIn('profile', response.data['ids'][0])
+
+    def test_expand_profile(self):
+        response = self.lookup({'ids': [self.users[0].id]}, expand='profile')
+        self.assertEqual(response.data['ids'][0]['profile']['bio'], 'First bio')
+        self.assertEqual(self.lookup({'ids': [1]}, expand='groups').status_code, 400)
+
+    def test_query_count_is_constant(self):
+        """
+        ทดสอบว่าจำนวน query ไม่ขึ้นกับจำนวนผู้ใช้ที่ค้นหา
+        """
+        def count(users, extra=(), expand='profile'):
+            data = {'ids': [user.id for user in users], 'identifiers': [user.email for user in users] + list(extra)}
+            with CaptureQueriesContext(connection) as queries, enforce_query_budgets():
+                response = self.lookup(data, expand=expand)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['missing']['ids'] + response.data['missing']['identifiers'], list(extra))
+            return len(queries)
+
+        few = count(self.users[:1])
+        self.users += [User.objects.create_user(email=f'more{i}@example.com', password='testpassword') for i in range(20)]
+        self.assertEqual(count(self.users), few)
+        self.assertEqual(few, 2)
+
+        # identifier ที่ไม่อยู่ใน filter หลังมีการเขียนจาก process อื่น: sync หนึ่งครั้ง ไม่ว่าจะไม่พบกี่รายการ
+        def count_with_misses(users, misses):
+            identifier_filter.publish()
+            return count(users, [f'nobody{i}@example.com' for i in range(misses)], expand='profile,login_methods')
+
+        self.assertEqual(count_with_misses(self.users[:1], 1), 4)
+        self.assertEqual(count_with_misses(self.users, 10), 4)
+
+    def test_out_of_range_ids_are_rejected(self):
+        response = self.lookup({'ids': [2 ** 70]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ids', response.data)
+
+    def test_limits_and_permissions(self):
+        self.assertEqual(self.lookup({}).status_code, 400)
+        with override_settings(USER_LOOKUP_MAX_ITEMS=2):
+            self.assertEqual(self.lookup({'ids': [1, 2], 'identifiers': ['a@example.com']}).status_code, 400)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.users[0]).access_token}')
+        self.assertEqual(self.lookup({'ids': [self.users[1].id]}).status_code, 403)
+
+
+@override_settings(PASSWORD_HASH_PROFILE='test')
+class SparseFieldsetTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(email='fieldsadmin@example.com', password='adminpassword')
+        self.user = User.objects.create_user(email='fields@example.com', password='testpassword', first_name='Fields')
+        Profile.objects.filter(user=self.user).update(bio='Sparse bio')
+        LoginMethod.objects.create(user=self.user, login_type=LoginMethod.EMAIL, identifier='fields@example.com')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.admin).access_token}')
+        self.user_client = APIClient()
+        self.user_client.credentials(HTTP_AUTHORIZATION=f'Bearer {UserRefreshToken.for_user(self.user).access_token}')
+
+    def test_fields_selects_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/users/{self.user.id}/?fields=id,first_name')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'id': self.user.id, 'first_name': 'Fields'})
+        self.assertIn('ETag', response)
+        self.assertNotIn('"password"', queries[-1]['sql'])
+        self.assertNotIn('"last_name"', queries[-1]['sql'])
+        self.assertNotIn('"national_id"', queries[-1]['sql'])
+
+        response = self.client.get(f'/api/users/{self.user.id}/?fields=id', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)  # ETag ขึ้นกับฟิลด์ที่เลือก
+
+    def test_expand_user_relations(self):
+        with CaptureQueriesContext(connection) as queries, enforce_query_budgets():
+            response = self.client.get(f'/api/users/{self.user.id}/?fields=id&expand=profile,login_methods')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'id', 'profile', 'login_methods'})
+        self.assertEqual(response.data['profile']['bio'], 'Sparse bio')
+        self.assertEqual([method['identifier'] for method in response.data['login_methods']], ['fields@example.com'])
+        self.assertEqual(len(queries), 2)
+
+    def test_expanded_list_query_count_is_constant(self):
+        def count():
+            with CaptureQueriesContext(connection) as queries, enforce_query_budgets():
+                response = self.client.get('/api/users/?expand=profile,login_methods&fields=id,email')
+            self.assertEqual(response.status_code, 200)
+            return len(queries), response.data['results']
+
+        few, _ = count()
+        for i in range(10):
+            user = User.objects.create_user(email=f'sparse{i}@example.com', password='testpassword')
+            LoginMethod.objects.create(user=user, login_type=LoginMethod.EMAIL, identifier=user.email)
+        many, results = count()
+        self.assertEqual(many, few)
+        self.assertEqual(len(results), 12)
+        self.assertTrue(all(set(record) == {'id', 'email', 'profile', 'login_methods'} for record in results))
+
+    def test_profile_expand_and_cache_variants(self):
+        with CaptureQueriesContext(connection) as queries, enforce_query_budgets():
+            response = self.user_client.get('/api/profile/?fields=bio&expand=user,login_methods')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 2)  # Profile กับผู้ใช้ด้วย join และ LoginMethod
+        self.assertEqual(response.data[0]['bio'], 'Sparse bio')
+        self.assertEqual(response.data[0]['user']['email'], 'fields@example.com')
+        self.assertNotIn('password', response.data[0]['user'])
+        self.assertEqual(len(response.data[0]['login_methods']), 1)
+        self.assertIsInstance(self.user_client.get('/api/profile/').data[0]['user'], int)
+
+        # payload ที่ฝัง LoginMethod ต้องถูก invalidate เมื่อ LoginMethod เปลี่ยน
+        LoginMethod.objects.create(user=self.user, login_type=LoginMethod.PHONE_NUMBER, identifier='0812345678')
+        response = self.user_client.get('/api/profile/?fields=bio&expand=user,login_methods')
+        self.assertEqual(len(response.data[0]['login_methods']), 2)
+
+    def test_avatar_fields_load_their_columns(self):
+        profile = Profile.objects.get(user=self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.user_client.get(f'/api/profile/{profile.id}/?fields=avatar_url,avatar_variants')
+        self.assertEqual(response.data, {'avatar_url': None, 'avatar_variants': {}})
+        self.assertNotIn('"bio"', queries[-1]['sql'])
+
+    def test_unknown_names_are_rejected(self):
+        self.assertEqual(self.client.get('/api/users/?fields=id,password').status_code, 400)
+        self.assertEqual(self.client.get('/api/users/?fields=').status_code, 400)
+        self.assertEqual(self.client.get('/api/users/?expand=groups').status_code, 400)
+        self.assertEqual(self.user_client.get('/api/profile/?expand=profile').status_code, 400)
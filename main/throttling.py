@@ -0,0 +1,231 @@
+# main/throttling.py
+
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.exceptions import Throttled
+from rest_framework.throttling import BaseThrottle
+
+from .models import canonical_identifier
+
+
+class LocalCounterStore:
+    """
+    ตัวนับในหน่วยความจำของ process (ไม่มี I/O) จำกัดจำนวน key ด้วย LRU
+    key ที่หมดอายุจะถูกลบเมื่อถูกอ่าน ส่วน key ที่ไม่มีใครอ่านจะถูกไล่ออกตามลำดับการใช้งาน
+    """
+    blocking = False
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, value, ttl, now):
+        self._entries[key] = [value, now + ttl]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def incr(self, key, ttl):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None:
+                self._put(key, 1, ttl, now)
+                return 1
+            entry[0] += 1
+            return entry[0]
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return {key: entry[0] for key in keys if (entry := self._live(key, now)) is not None}
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._put(key, value, ttl, time.monotonic())
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CacheCounterStore:
+    """
+    ตัวนับบน Django cache (เช่น RedisCache) เพื่อให้ทุก worker ใช้ตัวนับชุดเดียวกัน
+    ใช้ add + incr ซึ่งเป็น atomic บน Redis ส่วน LocMemCache ใช้แทน Redis ได้ในเครื่องเดียว
+    """
+    blocking = True
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def incr(self, key, ttl):
+        if self.cache.add(key, 1, ttl):
+            return 1
+        try:
+            return self.cache.incr(key)
+        except ValueError:  # key หมดอายุระหว่าง add กับ incr
+            self.cache.set(key, 1, ttl)
+            return 1
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class LoginThrottle:
+    """
+    จำกัดการ login ก่อนตรวจรหัสผ่าน (ก่อนเสียเวลา hash):
+
+    - identifier: นับทุกครั้งที่พยายาม login แบบ sliding window (ล้างเมื่อ login สำเร็จ)
+      เมื่อเกิน LOGIN_IDENTIFIER_ATTEMPTS จะถูกล็อก LOGIN_LOCKOUT_BASE วินาที และเพิ่มเป็นสองเท่า
+      ทุกครั้งที่ถูกล็อกซ้ำภายใน LOGIN_LOCKOUT_RESET (สูงสุด LOGIN_LOCKOUT_MAX)
+    - IP: นับเฉพาะครั้งที่ล้มเหลว เมื่อเกิน LOGIN_IP_FAILURES ใน window จะถูกปฏิเสธจนกว่าจะลดลง
+
+    ใช้ sliding window counter (ตัวนับของ window ปัจจุบันและก่อนหน้า ถ่วงน้ำหนักตามเวลา)
+    จึงใช้หน่วยความจำคงที่ต่อ key และ I/O ไม่เกินสองครั้งต่อการตรวจ
+    identifier ถูก hash ก่อนใช้เป็น key เพื่อไม่ให้ข้อมูลส่วนบุคคลอยู่ใน store
+    """
+    prefix = 'login-throttle'
+
+    def __init__(self):
+        self._store = None
+
+    @property
+    def store(self):
+        if self._store is None:
+            if settings.LOGIN_THROTTLE_STORE == 'cache':
+                self._store = CacheCounterStore(settings.LOGIN_THROTTLE_CACHE)
+            else:
+                self._store = LocalCounterStore(settings.LOGIN_THROTTLE_MAX_KEYS)
+        return self._store
+
+    def reset(self):
+        """
+        ล้างตัวนับทั้งหมดและเลือก store ใหม่ตาม setting (ใช้ในเทสต์)
+        """
+        if self._store is not None:
+            self._store.clear()
+        self._store = None
+
+    @staticmethod
+    def client_ip(request):
+        # ใช้ X-Forwarded-For ตาม NUM_PROXIES ของ DRF เหมือน throttle อื่น ๆ
+        return BaseThrottle().get_ident(request)
+
+    def _subject(self, identifier):
+        identifier = canonical_identifier(identifier)
+        return hashlib.sha256(identifier.encode()).hexdigest()[:32] if identifier else None
+
+    def _window_keys(self, scope, subject, now):
+        window = settings.LOGIN_THROTTLE_WINDOW
+        bucket = int(now // window)
+        return f'{self.prefix}:{scope}:{subject}:{bucket}', f'{self.prefix}:{scope}:{subject}:{bucket - 1}'
+
+    def _estimate(self, current, previous, now):
+        window = settings.LOGIN_THROTTLE_WINDOW
+        return previous * (1 - (now % window) / window) + current
+
+    def _retry_after(self, now):
+        window = settings.LOGIN_THROTTLE_WINDOW
+        return max(math.ceil(window - now % window), 1)
+
+    def check(self, identifier, ip):
+        """
+        raise Throttled (429 พร้อม Retry-After) ถ้า identifier ถูกล็อก หรือ IP/identifier เกินกำหนด
+        และนับความพยายามครั้งนี้ให้ identifier
+        """
+        if not settings.LOGIN_THROTTLE_ENABLED:
+            return
+        store = self.store
+        now = time.time()
+        subject = self._subject(identifier)
+        lock_key = f'{self.prefix}:lock:{subject}'
+        ip_keys = self._window_keys('ip', ip, now)
+
+        values = store.get_many([*ip_keys, lock_key] if subject else ip_keys)
+        locked_until = values.get(lock_key)
+        if locked_until is not None and locked_until > now:
+            raise Throttled(wait=math.ceil(locked_until - now))
+        if self._estimate(values.get(ip_keys[0], 0), values.get(ip_keys[1], 0), now) >= settings.LOGIN_IP_FAILURES:
+            raise Throttled(wait=self._retry_after(now))
+        if subject is None:
+            return
+
+        current_key, previous_key = self._window_keys('id', subject, now)
+        current = store.incr(current_key, 2 * settings.LOGIN_THROTTLE_WINDOW)
+        previous = store.get_many([previous_key]).get(previous_key, 0)
+        if self._estimate(current, previous, now) > settings.LOGIN_IDENTIFIER_ATTEMPTS:
+            raise Throttled(wait=self._lock(subject, now))
+
+    def _lock(self, subject, now):
+        store = self.store
+        strikes = store.incr(f'{self.prefix}:strikes:{subject}', settings.LOGIN_LOCKOUT_RESET)
+        duration = min(settings.LOGIN_LOCKOUT_BASE * 2 ** (strikes - 1), settings.LOGIN_LOCKOUT_MAX)
+        store.set(f'{self.prefix}:lock:{subject}', now + duration, duration)
+        # เริ่มนับใหม่หลังปลดล็อก ไม่ให้ความพยายามเดิมทำให้ถูกล็อกซ้ำทันที
+        store.delete_many(self._window_keys('id', subject, now))
+        return duration
+
+    def failed(self, ip):
+        if settings.LOGIN_THROTTLE_ENABLED:
+            self.store.incr(self._window_keys('ip', ip, time.time())[0], 2 * settings.LOGIN_THROTTLE_WINDOW)
+
+    def succeeded(self, identifier):
+        subject = self._subject(identifier)
+        if not settings.LOGIN_THROTTLE_ENABLED or subject is None:
+            return
+        self.store.delete_many([*self._window_keys('id', subject, time.time()), f'{self.prefix}:strikes:{subject}'])
+
+    async def acheck(self, identifier, ip):
+        return await self._acall(self.check, identifier, ip)
+
+    async def afailed(self, ip):
+        return await self._acall(self.failed, ip)
+
+    async def asucceeded(self, identifier):
+        return await self._acall(self.succeeded, identifier)
+
+    async def _acall(self, func, *args):
+        # store ในหน่วยความจำไม่มี I/O เรียกตรงได้ ส่วน cache (เช่น Redis) ส่งไป thread
+        if self.store.blocking:
+            return await sync_to_async(func)(*args)
+        return func(*args)
+
+
+login_throttle = LoginThrottle()
@@ -0,0 +1,74 @@
+# main/tokens.py
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from .keyring import token_backend
+
+
+class KeyRingTokenMixin:
+    """
+    ลงชื่อและตรวจ token ด้วย KeyRingTokenBackend แทน TokenBackend ของ SIMPLE_JWT
+    """
+
+    def get_token_backend(self):
+        return token_backend
+
+
+class UserAccessToken(KeyRingTokenMixin, AccessToken):
+    pass
+
+
+class UserRefreshToken(KeyRingTokenMixin, RefreshToken):
+    """
+    Refresh token ที่ฝังข้อมูลสิทธิ์ของผู้ใช้ไว้ใน claim
+    เพื่อให้ LazyTokenUser ตอบคำถามทั่วไปได้โดยไม่ต้องดึงข้อมูลจากฐานข้อมูล
+    (access token ที่สร้างจาก refresh token จะคัดลอก claim เหล่านี้ไปด้วย)
+    """
+    access_token_class = UserAccessToken
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token['is_active'] = user.is_active
+        token['is_staff'] = user.is_staff
+        token['is_superuser'] = user.is_superuser
+        token['perms_version'] = user.perms_version
+        token['token_epoch'] = user.token_epoch
+        return token
+
+
+class RecentlyRevoked:
+    """
+    LRU ของ jti ที่ process นี้เพิ่งเพิกถอน (สูงสุด TOKEN_DENYLIST_LRU_SIZE รายการ)
+    การใช้ refresh token ซ้ำ (replay) ใน process เดียวกันจึงถูกปฏิเสธโดยไม่ต้องแตะฐานข้อมูล
+    jti ที่ไม่อยู่ในนี้ยังต้องตรวจกับ RevokedToken เสมอ
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jtis = OrderedDict()
+
+    def add(self, jti):
+        with self._lock:
+            self._jtis[jti] = None
+            self._jtis.move_to_end(jti)
+            while len(self._jtis) > settings.TOKEN_DENYLIST_LRU_SIZE:
+                self._jtis.popitem(last=False)
+
+    def __contains__(self, jti):
+        with self._lock:
+            if jti not in self._jtis:
+                return False
+            self._jtis.move_to_end(jti)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._jtis.clear()
+
+
+recently_revoked = RecentlyRevoked()
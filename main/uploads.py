@@ -0,0 +1,122 @@
+# main/uploads.py
+
+import io
+import warnings
+
+from django.conf import settings
+from django.core.files.uploadhandler import StopFutureHandlers, StopUpload, TemporaryFileUploadHandler
+from PIL import Image
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+# ส่วนเผื่อของ multipart (boundary, header ของแต่ละ part และฟิลด์อื่นในฟอร์ม)
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class AvatarTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Avatar upload is too large.'
+    default_code = 'avatar_too_large'
+
+
+class AvatarUploadHandler(TemporaryFileUploadHandler):
+    """
+    Upload handler สำหรับฟิลด์ avatar: เขียนลง temp file ทีละ chunk และตรวจขนาดไฟล์
+    กับขนาดภาพ (อ่านจาก header) ระหว่างที่ข้อมูลกำลังเข้ามา หากเกินกำหนดจะหยุดอ่าน body ทันที
+    ฟิลด์อื่นจะถูกส่งต่อให้ handler ถัดไปตามปกติ
+    """
+    field_name = 'avatar'
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.active = False
+        self.error = None
+        self.request_length = None
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        self.request_length = content_length
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        self.active = field_name == self.field_name
+        if not self.active:
+            return
+        if self.request_length and self.request_length > settings.AVATAR_MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD:
+            self.reject('size', f'Avatar must be at most {settings.AVATAR_MAX_UPLOAD_SIZE} bytes.')
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.received = 0
+        self.header = bytearray()
+        self.checked = False
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        self.received += len(raw_data)
+        if self.received > settings.AVATAR_MAX_UPLOAD_SIZE:
+            self.reject('size', f'Avatar must be at most {settings.AVATAR_MAX_UPLOAD_SIZE} bytes.')
+        if not self.checked:
+            self.header += raw_data
+            self.sniff()
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+        if not self.checked:
+            self.sniff(final=True)
+        self.header = None
+        return super().file_complete(file_size)
+
+    def sniff(self, final=False):
+        """
+        อ่านขนาดภาพจาก header ที่ได้รับมาแล้ว (Image.open อ่านเฉพาะ header ไม่ decode pixel)
+        ถ้ายังระบุไม่ได้จะรอ chunk ถัดไป จนกว่าจะเกิน AVATAR_HEADER_SNIFF_BYTES หรือไฟล์จบ
+        """
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+                width, height = Image.open(io.BytesIO(self.header)).size
+        except Image.DecompressionBombError:
+            self.reject('dimensions', 'Avatar image dimensions are too large.')
+        except Exception:
+            if final or len(self.header) >= settings.AVATAR_HEADER_SNIFF_BYTES:
+                self.reject('format', 'Upload a valid image.')
+            return
+        limit = settings.AVATAR_MAX_DIMENSION
+        if width > limit or height > limit:
+            self.reject('dimensions', f'Avatar must be at most {limit}x{limit} pixels.')
+        self.checked = True
+        self.header = None
+
+    def reject(self, reason, message):
+        self.error = (reason, message)
+        self.active = False
+        if getattr(self, 'file', None) is not None:
+            self.file.close()
+        raise StopUpload(connection_reset=True)
+
+    def raise_for_error(self):
+        if self.error is None:
+            return
+        reason, message = self.error
+        if reason == 'size':
+            raise AvatarTooLarge(message)
+        raise ValidationError({'avatar': [message]})
+
+
+class AvatarUploadMixin:
+    """
+    ใส่ AvatarUploadHandler ไว้หน้าสุดของ upload handler และแปลงการปฏิเสธไฟล์เป็น 413/400
+    ก่อนถึง serializer
+    """
+    def initialize_request(self, request, *args, **kwargs):
+        self.avatar_upload = AvatarUploadHandler(request)
+        request.upload_handlers.insert(0, self.avatar_upload)
+        return super().initialize_request(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in ('POST', 'PUT', 'PATCH'):
+            request.data  # parse body ตอนนี้ เพื่อให้ handler ตรวจไฟล์เสร็จก่อนถึง serializer
+            self.avatar_upload.raise_for_error()
@@ -1,7 +1,10 @@
 # main/urls.py
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import UserViewSet, ProfileViewSet, LoginMethodViewSet, CustomTokenObtainPairView, UserCreate 
+from .async_views import AsyncTokenObtainPairView, AsyncProfileDetail, AsyncLoginMethodList, AsyncLoginMethodDetail
+from .instrumentation import metrics_view
+from .keyring import jwks_view
+from .views import UserViewSet, ProfileViewSet, LoginMethodViewSet, CustomTokenObtainPairView, CustomTokenRefreshView, RevokeTokensView, UserCreate, UserImportView, UserExportView, UserLookupView
 
 
 router = DefaultRouter()
@@ -10,7 +13,19 @@ router.register(r'profile', ProfileViewSet, basename='profile')
 router.register(r'login', LoginMethodViewSet, basename='login')
 
 urlpatterns = [
+    path('users/import/', UserImportView.as_view(), name='user_import'),  # ต้องอยู่ก่อน router เพื่อไม่ให้ชนกับ users/{pk}/
+    path('users/export/', UserExportView.as_view(), name='user_export'),
+    path('users/lookup/', UserLookupView.as_view(), name='user_lookup'),
+    path('metrics/', metrics_view, name='metrics'),
+    path('.well-known/jwks.json', jwks_view, name='jwks'),
     path('', include(router.urls)),
     path('token/', CustomTokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('token/refresh/', CustomTokenRefreshView.as_view(), name='token_refresh'),
+    path('token/revoke/', RevokeTokensView.as_view(), name='token_revoke'),
     path('users/register/', UserCreate.as_view()),  # ยังคงใช้ UserCreate แยกต่างหาก
+    # view แบบ async สำหรับ deploy บน ASGI (msoapi/asgi.py)
+    path('async/token/', AsyncTokenObtainPairView.as_view(), name='async_token_obtain_pair'),
+    path('async/profile/', AsyncProfileDetail.as_view(), name='async_profile'),
+    path('async/login/', AsyncLoginMethodList.as_view(), name='async_login_list'),
+    path('async/login/<int:pk>/', AsyncLoginMethodDetail.as_view(), name='async_login_detail'),
 ]
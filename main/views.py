@@ -1,12 +1,56 @@
 from django.shortcuts import get_object_or_404
 from rest_framework import generics, permissions, status, viewsets
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
-from rest_framework_simplejwt.views import TokenObtainPairView
-from .serializers import CustomUserSerializer, ProfileSerializer, LoginMethodSerializer,TokenObtainPairSerializer
-from .models import CustomUser, Profile, LoginMethod
-from rest_framework_simplejwt.tokens import RefreshToken
+from django.conf import settings
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from .serializers import CustomUserSerializer, ProfileSerializer, LoginMethodSerializer,TokenObtainPairSerializer, TokenRefreshSerializer, UserLookupSerializer
+from .models import CustomUser, Profile, LoginMethod, UserIdentifier, canonical_identifier
+from .tokens import UserRefreshToken
+from .login_tracking import record_login_method
+from .routers import pin_to_primary
+from .throttling import login_throttle
+from .importers import IMPORT_FORMATS, UserImporter, iter_rows
+from .exporters import EXPORT_FORMATS, parse_export_fields, render_export
+from .cache import profile_cache, login_method_cache
+from .conditional import ConditionalRetrieveMixin, conditional_response, version_state
+from django.http import StreamingHttpResponse
+from django.views.static import serve
 from django.db import IntegrityError
-from rest_framework.exceptions import PermissionDenied , NotFound
+from rest_framework.exceptions import PermissionDenied , NotFound, ValidationError
+from django.utils.dateparse import parse_date, parse_datetime
+from .pagination import UserCursorPagination
+from .uploads import AvatarUploadMixin
+from .fieldsets import SparseFieldsetMixin, parse_names
+
+class CachedListMixin:
+    """
+    ตอบ list จาก payload ที่ cache ไว้ต่อผู้ใช้ (ถูก invalidate โดย signal ใน main/signals.py)
+    conditional = True จะเก็บ ETag/Last-Modified ไว้กับ payload เพื่อตอบ 304 ได้โดยไม่ query
+    """
+    payload_cache = None
+    conditional = False
+
+    def payload_variant(self):
+        return 'default'
+
+    def payload_version(self, objects, data):
+        return version_state(objects)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        def build():
+            objects = list(queryset)
+            entry = {'data': list(self.get_serializer(objects, many=True).data)}
+            if self.conditional:
+                entry['etag'], entry['last_modified'] = self.payload_version(objects, entry['data'])
+            return entry
+
+        entry = self.payload_cache.get_or_set(request.user.id, build, variant=self.payload_variant())
+        if self.conditional:
+            return conditional_response(request, entry['etag'], entry['last_modified'], lambda: entry['data'])
+        return Response(entry['data'])
 
 class UserCreate(generics.CreateAPIView):
     """
@@ -15,14 +59,49 @@ class UserCreate(generics.CreateAPIView):
     queryset = CustomUser.objects.all()
     serializer_class = CustomUserSerializer
     permission_classes = [permissions.AllowAny]
+    # ตรวจ identifier ซ้ำ (UniqueIdentifierMixin) และบันทึกผู้ใช้, Profile, index ใน savepoint
+    query_budgets = {'post': 7}
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(SparseFieldsetMixin, ConditionalRetrieveMixin, viewsets.ModelViewSet):
     """
     ViewSet สำหรับจัดการ CustomUser
+    list และ retrieve รองรับ ?fields=id,email,... และ ?expand=profile,login_methods (ดู main/fieldsets.py)
     """
     queryset = CustomUser.objects.all()
     serializer_class = CustomUserSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = UserCursorPagination
+    expansions = {'profile': ('select', 'profile'), 'login_methods': ('prefetch', 'login_methods')}
+    # ETag อ่าน row_version/updated_at และ pagination เรียงตาม id/date_joined
+    required_fields = ('id', 'row_version', 'updated_at', 'date_joined')
+    # จำนวน query สูงสุดต่อ action (ตรวจโดย InstrumentationMiddleware ดู main/instrumentation.py)
+    # list และ retrieve ใช้เพิ่มอีกหนึ่งเมื่อ ?expand=login_methods (prefetch)
+    # create ตรวจ identifier ซ้ำและบันทึกใน savepoint เหมือน UserCreate
+    query_budgets = {'list': 2, 'retrieve': 2, 'create': 7, 'update': 2, 'partial_update': 2}
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action != 'list':
+            return queryset
+
+        # ตัวกรองสำหรับหน้ารายชื่อ: ?is_active=, ?is_staff=, ?date_joined_after=, ?date_joined_before=
+        params = self.request.query_params
+        for name in ('is_active', 'is_staff'):
+            if name in params:
+                value = params[name].lower()
+                if value not in ('true', 'false', '1', '0'):
+                    raise ValidationError({name: 'Must be true or false.'})
+                queryset = queryset.filter(**{name: value in ('true', '1')})
+        for name, lookup in (('date_joined_after', 'date_joined__gte'), ('date_joined_before', 'date_joined__lt')):
+            if name in params:
+                try:
+                    value = parse_datetime(params[name]) or parse_date(params[name])
+                except ValueError:  # รูปแบบถูกแต่เป็นวันที่ที่ไม่มีอยู่จริง เช่น 2024-02-30
+                    value = None
+                if value is None:
+                    raise ValidationError({name: 'Must be an ISO 8601 date or datetime.'})
+                queryset = queryset.filter(**{lookup: value})
+        return queryset
 
     def get_permissions(self):
         if self.action == 'list':
@@ -32,23 +111,119 @@ class UserViewSet(viewsets.ModelViewSet):
         else:
             permission_classes = [permissions.IsAuthenticated]
         return [permission() for permission in permission_classes]
-class ProfileViewSet(viewsets.ModelViewSet): 
+class UserImportView(generics.GenericAPIView):
+    """
+    API endpoint สำหรับนำเข้าผู้ใช้จำนวนมากจากไฟล์ CSV หรือ JSON Lines (เฉพาะ admin)
+    ส่งไฟล์ในฟิลด์ 'file' และระบุ 'format' (csv หรือ jsonl) หากเดาจากนามสกุลไฟล์ไม่ได้
+    """
+    permission_classes = [permissions.IsAdminUser]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'detail': 'No file uploaded.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        fmt = request.data.get('format') or ('jsonl' if upload.name.endswith(('.jsonl', '.ndjson')) else 'csv')
+        if fmt not in IMPORT_FORMATS:
+            return Response({'detail': f'Unsupported format: {fmt}.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        importer = UserImporter(chunk_size=settings.USER_IMPORT_CHUNK_SIZE)
+        result = importer.run(iter_rows(upload.file, fmt))
+        return Response(result.as_dict(), status=status.HTTP_200_OK)
+
+class UserLookupView(generics.GenericAPIView):
+    """
+    API endpoint สำหรับค้นหาผู้ใช้หลายคนในครั้งเดียว (เฉพาะ admin เช่นบริการภายในที่แสดงรายชื่อผู้ใช้)
+    POST {"ids": [...], "identifiers": [...]} และ ?expand=profile,login_methods เพื่อรวม Profile/LoginMethod ของแต่ละคน
+    ผลลัพธ์เรียงตามลำดับที่ขอ (null เมื่อไม่พบ) และรายการที่ไม่พบอยู่ใน missing
+    """
+    permission_classes = [permissions.IsAdminUser]
+    serializer_class = UserLookupSerializer
+    expansions = UserViewSet.expansions
+    # index ของ identifier และผู้ใช้ (Profile มาด้วย join, LoginMethod อีกหนึ่ง) ไม่ขึ้นกับจำนวนที่ค้นหา
+    # บวก sync ของ identifier filter ไม่เกินหนึ่งครั้งเมื่อมี identifier ที่ไม่อยู่ใน filter (main/identifier_filter.py)
+    query_budgets = {'post': 4}
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids, identifiers = serializer.validated_data['ids'], serializer.validated_data['identifiers']
+        expand = parse_names(request.query_params.get('expand'))
+        unknown = set(expand) - set(self.expansions)
+        if unknown:
+            raise ValidationError({'expand': f"Unknown expansion(s): {', '.join(sorted(unknown))}."})
+
+        resolved = UserIdentifier.objects.resolve_many(identifiers)
+        users = CustomUser.objects.filter(pk__in=set(ids) | set(resolved.values())).order_by('pk')
+        for name in expand:
+            kind, lookup = self.expansions[name]
+            users = users.select_related(lookup) if kind == 'select' else users.prefetch_related(lookup)
+        users = list(users)
+
+        data = CustomUserSerializer(users, many=True, expand=expand, context=self.get_serializer_context()).data
+        records = dict(zip([user.pk for user in users], data))
+
+        by_id = [records.get(pk) for pk in ids]
+        by_identifier = [records.get(resolved.get(canonical_identifier(value))) for value in identifiers]
+        return Response({
+            'ids': by_id,
+            'identifiers': by_identifier,
+            'missing': {
+                'ids': [pk for pk, record in zip(ids, by_id) if record is None],
+                'identifiers': [value for value, record in zip(identifiers, by_identifier) if record is None],
+            },
+        })
+
+class UserExportView(generics.GenericAPIView):
+    """
+    API endpoint สำหรับส่งออกผู้ใช้ทั้งหมดพร้อม Profile และ LoginMethod แบบ streaming (เฉพาะ admin)
+    ?output=ndjson|csv และ ?fields=id,email,... สำหรับเลือกฟิลด์
+    """
+    permission_classes = [permissions.IsAdminUser]
+    content_types = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+    def get(self, request, *args, **kwargs):
+        fmt = request.query_params.get('output', 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            return Response({'detail': f'Unsupported output: {fmt}.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            fields = parse_export_fields(request.query_params.get('fields'))
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(
+            render_export(fmt, fields, chunk_size=settings.USER_EXPORT_CHUNK_SIZE),
+            content_type=f'{self.content_types[fmt]}; charset=utf-8',
+        )
+        response['Content-Disposition'] = f'attachment; filename="users.{fmt}"'
+        return response
+
+class ProfileViewSet(AvatarUploadMixin, SparseFieldsetMixin, CachedListMixin, ConditionalRetrieveMixin, viewsets.ModelViewSet): 
 
     """
     ViewSet สำหรับจัดการ Profile
+    list และ retrieve รองรับ ?fields=id,bio,... และ ?expand=user,login_methods (ดู main/fieldsets.py)
     """
+    queryset = Profile.objects.all()
     serializer_class = ProfileSerializer
     permission_classes = [permissions.IsAuthenticated]
+    payload_cache = profile_cache
+    conditional = True
+    expansions = {'user': ('select', 'user'), 'login_methods': ('prefetch', 'user__login_methods')}
+    required_fields = ('id', 'user', 'row_version', 'updated_at')
+    # list และ retrieve ใช้เพิ่มอีกสองเมื่อ ?expand=login_methods (prefetch ผู้ใช้และ LoginMethod)
+    query_budgets = {'list': 3, 'retrieve': 3, 'update': 2, 'partial_update': 2}
 
     def get_queryset(self):
-        return Profile.objects.filter(user=self.request.user)
+        return super().get_queryset().filter(user_id=self.request.user.id)
 
     def perform_create(self, serializer): 
 
-        serializer.save(user=self.request.user)
+        serializer.save(user_id=self.request.user.id)
         
         
-class ProfileDetail(generics.RetrieveUpdateAPIView):
+class ProfileDetail(AvatarUploadMixin, ConditionalRetrieveMixin, generics.RetrieveUpdateAPIView):
     """
     API endpoint สำหรับดูและแก้ไข profile ของผู้ใช้ที่ล็อกอินอยู่
     """
@@ -57,34 +232,54 @@ class ProfileDetail(generics.RetrieveUpdateAPIView):
 
     def get_object(self):
         try:
-            return self.request.user.profile
+            # ค้นหาด้วย user_id จาก token โดยตรง ไม่ต้องโหลด CustomUser ก่อน
+            return Profile.objects.get(user_id=self.request.user.id)
         except Profile.DoesNotExist: 
             raise NotFound("Profile not found. Please create one.")
-class LoginMethodViewSet(viewsets.ModelViewSet):
+
+    def retrieve(self, request, *args, **kwargs):
+        def build():
+            profile = self.get_object()
+            etag, last_modified = version_state([profile])
+            return {'etag': etag, 'last_modified': last_modified, 'data': dict(self.get_serializer(profile).data)}
+
+        entry = profile_cache.get_or_set(request.user.id, build, variant='detail')
+        return conditional_response(request, entry['etag'], entry['last_modified'], lambda: entry['data'])
+
+class LoginMethodViewSet(CachedListMixin, viewsets.ModelViewSet):
     """
     ViewSet สำหรับจัดการ LoginMethod
     """
     serializer_class = LoginMethodSerializer
     permission_classes = [permissions.IsAuthenticated]
+    payload_cache = login_method_cache
+    # create/update ตรวจ identifier ซ้ำ และบันทึกพร้อม UserIdentifier index ใน savepoint
+    query_budgets = {'list': 1, 'retrieve': 1, 'create': 9, 'update': 11, 'partial_update': 11, 'destroy': 6}
 
     def get_queryset(self):
-        return self.request.user.login_methods.all()
+        return LoginMethod.objects.filter(user_id=self.request.user.id)
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        serializer.save(user_id=self.request.user.id)
 
 class CustomTokenObtainPairView(TokenObtainPairView):
     """
     API endpoint สำหรับ login (ขอ JWT token) โดยใช้ email, national_id, หรือ phone_number
     """
     serializer_class = TokenObtainPairSerializer
+    query_budgets = {'post': 11}  # login ครั้งแรกด้วย identifier ใหม่ (บันทึก LoginMethod) ครั้งต่อไปใช้ 1-2
 
     def post(self, request, *args, **kwargs):
+        # ตรวจ rate limit / lockout ก่อน serializer ตรวจรหัสผ่าน
+        identifier = TokenObtainPairSerializer.identifier(request.data) if isinstance(request.data, dict) else None
+        ip = login_throttle.client_ip(request)
+        login_throttle.check(identifier, ip)
         serializer = self.get_serializer(data=request.data)
 
         try:
             serializer.is_valid(raise_exception=True)
         except Exception as e:
+            login_throttle.failed(ip)
             # ตรวจสอบว่า error เกิดจากการ login ผิดพลาดหรือไม่
             if 'no active account' in str(e).lower():
                 return Response({'detail': 'Invalid credentials.'}, status=status.HTTP_401_UNAUTHORIZED)
@@ -95,8 +290,9 @@ class CustomTokenObtainPairView(TokenObtainPairView):
 
         if not user.is_active:
             return Response({'detail': 'User account is disabled.'}, status=status.HTTP_401_UNAUTHORIZED)
+        login_throttle.succeeded(identifier)
 
-        refresh = RefreshToken.for_user(user)
+        refresh = UserRefreshToken.for_user(user)
         login_type_mapping = {
             'email': LoginMethod.EMAIL,
             'national_id': LoginMethod.NATIONAL_ID,
@@ -111,14 +307,12 @@ class CustomTokenObtainPairView(TokenObtainPairView):
         identifier = request.data.get(login_type)
 
         try:
-            # ปรับปรุงการสร้างหรือดึง LoginMethod object
-            login_method, _ = LoginMethod.objects.update_or_create(
-                user=user,
-                login_type=login_type,
-                defaults={'identifier': identifier}
-            )
+            # เขียน LoginMethod เฉพาะเมื่อยังไม่เคยบันทึกไว้ (หรือส่งเข้าคิวในโหมด deferred)
+            record_login_method(user, login_type, identifier)
         except IntegrityError:
             return Response({'detail': 'This identifier is already associated with another user.'}, status=status.HTTP_400_BAD_REQUEST)
+        # request นี้ไม่มี access token ให้ middleware ระบุผู้ใช้ จึง pin กับ primary ที่นี่
+        pin_to_primary(user.pk)
 
         data = {
             'refresh': str(refresh),
@@ -126,6 +320,26 @@ class CustomTokenObtainPairView(TokenObtainPairView):
         }
         return Response(data, status=status.HTTP_200_OK)
 
+class CustomTokenRefreshView(TokenRefreshView):
+    """
+    API endpoint สำหรับขอ token ใหม่ด้วย refresh token (rotate และเพิกถอน refresh token เดิม)
+    """
+    serializer_class = TokenRefreshSerializer
+    query_budgets = {'post': 4}  # ค้นหาผู้ใช้ และ insert ลง denylist ใน savepoint
+
+
+class RevokeTokensView(generics.GenericAPIView):
+    """
+    API endpoint สำหรับออกจากระบบทุกอุปกรณ์: ยกเลิก access และ refresh token ทั้งหมดของผู้ใช้ที่ล็อกอินอยู่
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    query_budgets = {'post': 4}  # ตรวจ epoch (เมื่อ cache miss) และ update/อ่าน token_epoch ใน transaction
+
+    def post(self, request, *args, **kwargs):
+        CustomUser.objects.revoke_tokens(request.user.id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 class LoginMethodList(generics.ListCreateAPIView):
     """
     API endpoint สำหรับดูและสร้างวิธีการ login ของผู้ใช้ที่ล็อกอินอยู่
@@ -134,10 +348,10 @@ class LoginMethodList(generics.ListCreateAPIView):
     serializer_class = LoginMethodSerializer
 
     def get_queryset(self):
-        return self.request.user.login_methods.all()
+        return LoginMethod.objects.filter(user_id=self.request.user.id)
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        serializer.save(user_id=self.request.user.id)
 
 class LoginMethodDetail(generics.RetrieveUpdateDestroyAPIView):
     """
@@ -147,13 +361,22 @@ class LoginMethodDetail(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = LoginMethodSerializer
 
     def get_queryset(self):
-        return self.request.user.login_methods.all().select_related('user')  # ใช้ select_related เพื่อเพิ่มประสิทธิภาพ
+        return LoginMethod.objects.filter(user_id=self.request.user.id).select_related('user')  # ใช้ select_related เพื่อเพิ่มประสิทธิภาพ
 
     def get_object(self):
         """
         Retrieve the LoginMethod object and check if it belongs to the authenticated user.
         """
         obj = super().get_object()
-        if obj.user != self.request.user:
+        if obj.user_id != self.request.user.id:
             raise PermissionDenied("You do not have permission to access this login method.")
         return obj
+
+
+def serve_avatar(request, path):
+    """
+    ส่งไฟล์ avatar/ภาพย่อพร้อม Cache-Control แบบ immutable (ชื่อไฟล์มาจาก hash ของเนื้อหา เนื้อหาจึงไม่เปลี่ยน)
+    """
+    response = serve(request, f'avatars/{path}', document_root=settings.MEDIA_ROOT)
+    response['Cache-Control'] = f'public, max-age={settings.AVATAR_CACHE_MAX_AGE}, immutable'
+    return response
@@ -37,14 +37,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'main.instrumentation.InstrumentationMiddleware',  # ทำงานเฉพาะเมื่อ INSTRUMENTATION_ENABLED
+    'main.middleware.WhiteNoiseMiddleware',  # whitenoise ที่รองรับ async (ดู main/middleware.py)
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
-    'django.middleware.common.CommonMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'main.routers.ReplicaRoutingMiddleware',  # อ่านจาก replica สำหรับ GET (เมื่อมี DB_REPLICAS)
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -73,12 +74,139 @@ WSGI_APPLICATION = 'msoapi.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_PROFILE เลือกฐานข้อมูล:
+#   sqlite             ไฟล์ db.sqlite3 แบบเดิม (ค่าเริ่มต้น)
+#   sqlite-wal         SQLite โหมด WAL พร้อม pragma สำหรับ deploy เครื่องเดียว (ดู SQLITE_PRAGMAS)
+#   postgresql         PostgreSQL พร้อม persistent connection (DB_CONN_MAX_AGE) และ health check
+#   postgresql-pooled  PostgreSQL ผ่าน connection pooler เช่น PgBouncer โหมด transaction
+#                      (ปิด server-side cursor เพราะ cursor ข้าม transaction ไม่ได้ใน pool)
+DB_PROFILE = os.getenv('DB_PROFILE', 'sqlite')
+
+if DB_PROFILE.startswith('postgresql'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'msoapi'),
+            'USER': os.getenv('DB_USER', 'msoapi'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '6432' if DB_PROFILE == 'postgresql-pooled' else '5432'),
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),  # วินาที, 0 = ปิดหลังทุก request
+            'CONN_HEALTH_CHECKS': True,  # ตรวจ connection ที่ค้างไว้ก่อนใช้ใน request ถัดไป
+            'DISABLE_SERVER_SIDE_CURSORS': DB_PROFILE == 'postgresql-pooled',
+            'OPTIONS': {
+                'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 5)),
+                'application_name': 'msoapi',
+            },
+        }
     }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            # เปิด connection ค้างไว้เพื่อไม่ต้องตั้ง pragma ใหม่ทุก request
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60 if DB_PROFILE == 'sqlite-wal' else 0)),
+            'OPTIONS': {
+                'timeout': int(os.getenv('DB_BUSY_TIMEOUT', 20)),  # วินาทีที่รอ lock ก่อน "database is locked"
+            },
+        }
+    }
+
+# DB_REPLICAS: replica สำหรับอ่าน คั่นด้วย comma (HOST ของ PostgreSQL หรือไฟล์ของ SQLite)
+# ตั้งชื่อ alias เป็น replica1, replica2, ... โดยคัดลอกค่าอื่นจาก default (main/routers.py)
+DATABASE_REPLICAS = []
+for _index, _location in enumerate(filter(None, (v.strip() for v in os.getenv('DB_REPLICAS', '').split(','))), 1):
+    _replica = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    _replica['HOST' if DB_PROFILE.startswith('postgresql') else 'NAME'] = _location
+    DATABASES[f'replica{_index}'] = _replica
+    DATABASE_REPLICAS.append(f'replica{_index}')
+
+DATABASE_ROUTERS = ['main.routers.ReplicaRouter']
+REPLICA_PATH_PREFIXES = ('/api/',)
+# หลังเขียนข้อมูล ผู้ใช้จะอ่านจาก primary นานเท่านี้ ควรมากกว่า REPLICA_MAX_LAG
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', 5))
+# cookie ที่พา pin ไปยัง worker อื่น (API_CACHE_BACKEND=locmem แยก pin ต่อ process)
+REPLICA_PIN_COOKIE = os.getenv('REPLICA_PIN_COOKIE', 'db-pin')
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 2))  # วินาที; replica ที่ช้ากว่านี้จะไม่ถูกใช้
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 1))  # วินาที
+
+# pragma ที่ตั้งให้ทุก connection ของ SQLite (main/signals.py) ใช้เฉพาะ DB_PROFILE=sqlite-wal
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # reader ไม่บล็อก writer และกลับกัน
+    'synchronous': 'NORMAL',  # fsync ตอน checkpoint แทนทุก commit (ปลอดภัยใน WAL)
+    'cache_size': -64000,  # 64 MB page cache ต่อ connection
+    'temp_store': 'MEMORY',
+    'mmap_size': 256 * 1024 * 1024,
+    'wal_autocheckpoint': 1000,
+} if DB_PROFILE == 'sqlite-wal' else {}
+
+
+# Cache
+# API_CACHE_BACKEND เลือก backend ของ cache สำหรับ payload ของ API: locmem, file หรือ redis
+# (redis ใช้ django.core.cache.backends.redis ต้องติดตั้ง redis-py; ใช้ locmem แทนได้ในการทดสอบ)
+_API_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'api',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('API_CACHE_LOCATION', str(BASE_DIR / 'cache')),
+    },
+    'redis': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('API_CACHE_LOCATION', 'redis://127.0.0.1:6379/1'),
+    },
 }
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'api': _API_CACHE_BACKENDS[os.getenv('API_CACHE_BACKEND', 'locmem')],
+}
+API_CACHE_ALIAS = 'api'
+API_CACHE_TIMEOUT = int(os.getenv('API_CACHE_TIMEOUT', 300))
+# token_epoch ของผู้ใช้ที่ cache ไว้ (main.cache.token_epochs) กับ cache แบบ locmem นี่คือเวลาสูงสุดที่ process อื่น
+# ยังยอมรับ token ที่ถูกเพิกถอนแล้ว ควรใช้ redis เมื่อรันหลาย worker
+TOKEN_EPOCH_CACHE_TIMEOUT = int(os.getenv('TOKEN_EPOCH_CACHE_TIMEOUT', 60))
+
+
+# Instrumentation (main/instrumentation.py): นับ query, เวลา DB/serializer ต่อ request
+# ส่งเป็น header Server-Timing และเปิดสถิติแบบ Prometheus ที่ /api/metrics/
+INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION_ENABLED', 'False') == 'True'
+# True: view ที่ใช้ query เกิน query_budgets จะ raise QueryBudgetExceeded (ใช้ในเทสต์), False: แค่ log
+QUERY_BUDGET_ENFORCE = os.getenv('QUERY_BUDGET_ENFORCE', 'False') == 'True'
+METRICS_ALLOWED_IPS = os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+
+# จำกัดการ login (main/throttling.py) ตรวจก่อน check_password เพื่อไม่ให้การเดารหัสผ่านใช้ CPU ของการ hash
+LOGIN_THROTTLE_ENABLED = os.getenv('LOGIN_THROTTLE_ENABLED', 'True') == 'True'
+# local: ตัวนับในหน่วยความจำของแต่ละ process (LRU), cache: ใช้ cache alias ร่วมกันทุก worker (เช่น redis)
+LOGIN_THROTTLE_STORE = os.getenv('LOGIN_THROTTLE_STORE', 'local')
+LOGIN_THROTTLE_CACHE = os.getenv('LOGIN_THROTTLE_CACHE', API_CACHE_ALIAS)
+LOGIN_THROTTLE_MAX_KEYS = int(os.getenv('LOGIN_THROTTLE_MAX_KEYS', 100_000))
+LOGIN_THROTTLE_WINDOW = int(os.getenv('LOGIN_THROTTLE_WINDOW', 300))  # วินาที
+LOGIN_IDENTIFIER_ATTEMPTS = int(os.getenv('LOGIN_IDENTIFIER_ATTEMPTS', 5))  # ต่อ identifier ต่อ window
+LOGIN_IP_FAILURES = int(os.getenv('LOGIN_IP_FAILURES', 50))  # ครั้งที่ล้มเหลวต่อ IP ต่อ window
+LOGIN_LOCKOUT_BASE = int(os.getenv('LOGIN_LOCKOUT_BASE', 60))  # ล็อกครั้งแรก (วินาที) เพิ่มเป็นสองเท่าทุกครั้งที่ถูกล็อกซ้ำ
+LOGIN_LOCKOUT_MAX = int(os.getenv('LOGIN_LOCKOUT_MAX', 3600))
+LOGIN_LOCKOUT_RESET = int(os.getenv('LOGIN_LOCKOUT_RESET', 86400))  # ลืมจำนวนครั้งที่ถูกล็อกหลังจากนี้
+
+# Bloom filter ของ identifier ที่มีอยู่ (main/identifier_filter.py): login ด้วย identifier ที่ไม่มีในระบบไม่ต้อง query
+IDENTIFIER_FILTER_ENABLED = os.getenv('IDENTIFIER_FILTER_ENABLED', 'True') == 'True'
+IDENTIFIER_FILTER_CAPACITY = int(os.getenv('IDENTIFIER_FILTER_CAPACITY', 100_000))  # ขยายเป็น 2 เท่าของจำนวนจริงอัตโนมัติ
+IDENTIFIER_FILTER_ERROR_RATE = float(os.getenv('IDENTIFIER_FILTER_ERROR_RATE', 0.01))
+# identifier ที่ process อื่นเพิ่มถูกตอบว่าไม่มีได้นานสุดเท่านี้ (วินาที) เมื่อ API_CACHE_BACKEND แยกกันต่อ process
+# (cache กลางเช่น redis: ทุก process เห็นทันทีหลัง commit) login ที่ไม่พบ identifier ใช้ query ไม่เกินหนึ่งครั้งต่อช่วงนี้
+IDENTIFIER_FILTER_SYNC_INTERVAL = float(os.getenv('IDENTIFIER_FILTER_SYNC_INTERVAL', 5))
+# id ที่ข้ามไปตอน sync (transaction ที่ยังไม่ commit) ถูกตรวจซ้ำนานเท่านี้ (วินาที) ควรยาวกว่า transaction ที่นานที่สุด
+IDENTIFIER_FILTER_GAP_TIMEOUT = float(os.getenv('IDENTIFIER_FILTER_GAP_TIMEOUT', 600))
+IDENTIFIER_FILTER_REBUILD_RATIO = float(os.getenv('IDENTIFIER_FILTER_REBUILD_RATIO', 0.1))  # สร้างใหม่เมื่อถูกลบเกินสัดส่วนนี้
+
+# denylist ของ refresh token ที่ถูก rotate แล้ว (main.models.RevokedToken) ลบแถวที่หมดอายุด้วยคำสั่ง prune_revoked_tokens
+# jti ที่เพิ่งเพิกถอนใน process นี้ถูกจำไว้ใน LRU เพื่อปฏิเสธการใช้ซ้ำโดยไม่ query
+TOKEN_DENYLIST_LRU_SIZE = int(os.getenv('TOKEN_DENYLIST_LRU_SIZE', 10_000))
 
 
 # Password validation
@@ -100,6 +228,67 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Password hashing
+# hasher ตัวแรกใช้สร้าง hash ใหม่ ตัวอื่นใช้ตรวจสอบ hash เดิม (เลือกตัวแรกได้ด้วย PASSWORD_HASHER)
+_PASSWORD_HASHERS = {
+    'pbkdf2_sha256': 'main.hashers.PBKDF2PasswordHasher',
+    'scrypt': 'main.hashers.ScryptPasswordHasher',
+    'argon2': 'main.hashers.Argon2PasswordHasher',
+}
+_preferred_hasher = os.getenv('PASSWORD_HASHER', 'pbkdf2_sha256')
+PASSWORD_HASHERS = [_PASSWORD_HASHERS[_preferred_hasher]] + [
+    path for name, path in _PASSWORD_HASHERS.items() if name != _preferred_hasher
+]
+
+# ค่า cost ของแต่ละ hasher แยกตาม environment (ค่าที่ไม่ได้กำหนดจะใช้ default ของ Django)
+PASSWORD_HASH_PROFILE = os.getenv('PASSWORD_HASH_PROFILE', 'production')
+PASSWORD_HASH_PROFILES = {
+    'production': {
+        'pbkdf2_sha256': {'iterations': 600000},
+        'scrypt': {'work_factor': 2 ** 14, 'block_size': 8, 'parallelism': 1},
+        'argon2': {'time_cost': 2, 'memory_cost': 102400, 'parallelism': 8},
+    },
+    'low': {
+        'pbkdf2_sha256': {'iterations': 260000},
+        'scrypt': {'work_factor': 2 ** 13, 'block_size': 8, 'parallelism': 1},
+        'argon2': {'time_cost': 2, 'memory_cost': 32768, 'parallelism': 4},
+    },
+    'test': {
+        'pbkdf2_sha256': {'iterations': 1000},
+        'scrypt': {'work_factor': 2 ** 8, 'block_size': 8, 'parallelism': 1},
+        'argon2': {'time_cost': 1, 'memory_cost': 1024, 'parallelism': 1},
+    },
+}
+
+# hash ที่ใช้พารามิเตอร์เก่าจะถูกอัปเกรดหลัง login สำเร็จ: 'async', 'inline' หรือ 'off'
+PASSWORD_REHASH_MODE = os.getenv('PASSWORD_REHASH_MODE', 'async')
+PASSWORD_REHASH_WORKERS = int(os.getenv('PASSWORD_REHASH_WORKERS', 2))
+
+# thread pool สำหรับตรวจรหัสผ่านจาก async view (main/async_views.py) งานที่รอเกิน QUEUE_SIZE จะได้ 503
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv('PASSWORD_HASH_QUEUE_SIZE', 256))
+
+
+# การบันทึก LoginMethod ตอน login: 'sync' เขียนเฉพาะเมื่อเปลี่ยน, 'deferred' บันทึกเป็นชุดพร้อม last_used
+LOGIN_METHOD_RECORDING = os.getenv('LOGIN_METHOD_RECORDING', 'sync')
+LOGIN_METHOD_CACHE_TIMEOUT = 60 * 60
+LOGIN_METHOD_FLUSH_INTERVAL = float(os.getenv('LOGIN_METHOD_FLUSH_INTERVAL', 5))
+LOGIN_METHOD_FLUSH_BATCH_SIZE = 500
+
+
+# การนำเข้าผู้ใช้จำนวนมาก: จำนวนแถวต่อ transaction (รหัสผ่าน hash ใน thread pool ของ PASSWORD_HASH_WORKERS)
+USER_IMPORT_CHUNK_SIZE = int(os.getenv('USER_IMPORT_CHUNK_SIZE', 1000))
+# จำนวนแถวที่อ่านจากฐานข้อมูลต่อครั้งตอนส่งออกผู้ใช้
+USER_EXPORT_CHUNK_SIZE = int(os.getenv('USER_EXPORT_CHUNK_SIZE', 2000))
+# จำนวน id/identifier สูงสุดต่อ request ของ /api/users/lookup/
+USER_LOOKUP_MAX_ITEMS = int(os.getenv('USER_LOOKUP_MAX_ITEMS', 500))
+
+
+# ขนาดหน้าของรายชื่อผู้ใช้ (ปรับได้ด้วย ?page_size= ไม่เกิน USER_LIST_MAX_PAGE_SIZE)
+USER_LIST_PAGE_SIZE = int(os.getenv('USER_LIST_PAGE_SIZE', 50))
+USER_LIST_MAX_PAGE_SIZE = int(os.getenv('USER_LIST_MAX_PAGE_SIZE', 500))
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.2/topics/i18n/
 
@@ -125,6 +314,20 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'  # กำหนดตำแหน่ง
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# ภาพย่อของ avatar ที่สร้างหลังอัปโหลด (AVATAR_PROCESSING_MODE: 'async' หรือ 'inline')
+AVATAR_VARIANT_SIZES = (64, 128, 512)
+AVATAR_VARIANT_FORMAT = os.getenv('AVATAR_VARIANT_FORMAT', 'WEBP')  # WEBP หรือ JPEG
+AVATAR_VARIANT_DIR = 'avatars/variants'
+AVATAR_PROCESSING_MODE = os.getenv('AVATAR_PROCESSING_MODE', 'async')
+AVATAR_WORKERS = int(os.getenv('AVATAR_WORKERS', 2))
+# ขีดจำกัดของไฟล์ avatar ที่ตรวจระหว่างอัปโหลด (main/uploads.py)
+AVATAR_MAX_UPLOAD_SIZE = int(os.getenv('AVATAR_MAX_UPLOAD_SIZE', 5 * 1024 * 1024))  # bytes
+AVATAR_MAX_DIMENSION = int(os.getenv('AVATAR_MAX_DIMENSION', 4096))  # pixels ต่อด้าน
+AVATAR_HEADER_SNIFF_BYTES = 256 * 1024
+# ไฟล์ avatar ตั้งชื่อตาม hash ของเนื้อหา (main/storage.py) จึงให้ CDN/เบราว์เซอร์ cache ได้ตลอดไป
+AVATAR_CACHE_MAX_AGE = int(os.getenv('AVATAR_CACHE_MAX_AGE', 365 * 24 * 60 * 60))  # seconds
+AVATAR_SERVE = os.getenv('AVATAR_SERVE', str(DEBUG)) == 'True'  # ให้ Django ส่งไฟล์ avatar เอง (เมื่อไม่มี web server ด้านหน้า)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -133,7 +336,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # rest fram work config
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'main.authentication.TokenUserAuthentication',  # ไม่ query ผู้ใช้จากฐานข้อมูลในทุก request
     ),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
@@ -171,6 +374,17 @@ SIMPLE_JWT = {
     'AUTH_HEADER_NAME': 'HTTP_AUTHORIZATION',         # ชื่อของ header สำหรับการส่ง token
     'USER_ID_FIELD': 'id',                            # ฟิลด์ที่ใช้ระบุผู้ใช้ใน token
     'USER_ID_CLAIM': 'user_id',                       # ชื่อของ claim ที่เก็บ ID ของผู้ใช้
-    'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),
+    'AUTH_TOKEN_CLASSES': ('main.tokens.UserAccessToken',),  # ลงชื่อ/ตรวจด้วย key ring (main/keyring.py)
     'TOKEN_TYPE_CLAIM': 'token_type',                 # ชื่อของ claim ที่เก็บประเภทของ token
-}
\ No newline at end of file
+    'TOKEN_USER_CLASS': 'main.authentication.LazyTokenUser',  # user ที่สร้างจาก claim ใน token
+}
+
+# Key ring สำหรับลงชื่อ JWT แบบ asymmetric (main/keyring.py, ต้องติดตั้ง cryptography)
+# ไฟล์ PEM คั่นด้วย , ไฟล์แรกคือ private key ที่ใช้ลงชื่อ (RSA -> RS256, Ed25519 -> EdDSA)
+# ไฟล์ที่เหลือคือกุญแจเก่าที่ยังใช้ตรวจ token ได้ (public key อย่างเดียวก็พอ) บริการอื่นตรวจ token ได้เองจาก /api/.well-known/jwks.json
+# การเปลี่ยนกุญแจ: สร้างกุญแจใหม่ด้วย generate_signing_key ใส่ไว้หน้าสุด แล้วลบกุญแจเก่าออกหลัง REFRESH_TOKEN_LIFETIME
+# ว่างไว้ = ใช้ HS256 กับ SECRET_KEY ตามเดิม
+JWT_KEY_FILES = [path for path in os.getenv('JWT_KEY_FILES', '').split(',') if path]
+# ยอมรับ token HS256 เดิม (ไม่มี kid) ระหว่างย้ายมาใช้ key ring จนกว่า refresh token เดิมจะหมดอายุ
+JWT_ACCEPT_LEGACY_HS256 = os.getenv('JWT_ACCEPT_LEGACY_HS256', 'False') == 'True'
+JWKS_MAX_AGE = int(os.getenv('JWKS_MAX_AGE', 300))  # Cache-Control ของ JWKS (วินาที)
\ No newline at end of file
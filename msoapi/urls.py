@@ -4,6 +4,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from main.views import serve_avatar
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 
 urlpatterns = [
@@ -15,6 +16,9 @@ urlpatterns = [
 
 ]
 
+if settings.AVATAR_SERVE:
+    urlpatterns.append(path(f"{settings.MEDIA_URL.strip('/')}/avatars/<path:path>", serve_avatar, name='avatar-file'))
+
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)